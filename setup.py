@@ -28,6 +28,10 @@ setup(
         'pandas',
         'pyyaml',
     ],
+    extras_require={
+        'cache': ['pyarrow'],
+        'fast': ['orjson'],
+    },
     python_requires='>=3.8',
     test_suite='nose.collector',
     tests_require=[
@@ -1,5 +1,24 @@
-# flake8: noqa
-from .s3loader import S3Loader
-from .jsonloader import JSONLoader
-from .datamodelloader import DatamodelLoader
-from .susddatabase import SUSDDatabase
+# loaders are imported on first use, so that importing the package, e.g. for the cli, does not import pandas, boto3,
+# sqlalchemy and networkx
+import importlib
+
+_modules = {
+    'S3Loader': 's3loader',
+    'JSONLoader': 'jsonloader',
+    'DatamodelLoader': 'datamodelloader',
+    'SUSDDatabase': 'susddatabase',
+}
+
+__all__ = list(_modules)
+
+
+def __getattr__(name):
+    if name not in _modules:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    value = getattr(importlib.import_module(f'.{_modules[name]}', __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
@@ -0,0 +1,214 @@
+import json
+import logging
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+from pathlib import Path
+
+import sqlalchemy
+
+from .datamodelloader import DatamodelLoader
+from .jsonloader import JSONLoader, Decoder, flatten_shard, orjson, source_size
+from .metrics import peak_rss
+from .susddatabase import SUSDDatabase
+from .synthetic import ExportGenerator
+
+logger = logging.getLogger(__name__)
+
+STAGES = ['parse', 'validate', 'staging', 'final']
+COMPARISONS = ['flatten', 'decoders']
+
+
+class Timer:
+
+    def __init__(self):
+        self.timings = {}
+
+    def __call__(self, stage, func, *args, **kwargs):
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        self.timings[stage] = time.perf_counter() - start
+        logger.info(f'{stage} took {self.timings[stage]:0.2f}s')
+        return result
+
+
+def parse(loader):
+    # parses and flattens all tables, returning the number of publications
+    if not loader.streaming:
+        loader.flatten()
+        return len(loader.publications)
+    return sum(len(chunk.flatten(['publications'])['publications']) for chunk in loader.iter_chunks())
+
+
+def best_time(func, repeat=3, setup=None):
+    # fastest of repeat calls of func, each after setup if given
+    timings = []
+    for i in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def compare_flatten(path, agency, version, repeat=3):
+    # times deriving all tables with the table properties, one pass over the records for each, against the single
+    # pass flattener, on the same records held in memory
+    loader = JSONLoader.from_path(str(path), agency, version)
+    return {
+        'properties': best_time(lambda: [getattr(loader, kind) for kind in JSONLoader.export_kinds], repeat,
+                                loader.invalidate),
+        'flatten': best_time(loader.flatten, repeat, loader.invalidate),
+    }
+
+
+def compare_decoders(path, agency, version, repeat=3):
+    # times decoding and flattening all publication shards with each installed json backend
+    json_files = JSONLoader.from_path(str(path), agency, version, streaming=True).json_files
+    return {backend: best_time(lambda: [flatten_shard(i, backend) for i in json_files], repeat)
+            for backend in Decoder.backends if backend != 'orjson' or orjson}
+
+
+def run_comparisons(comparisons, path, agency, version):
+    # timings of alternative implementations, reported but not compared to baselines
+    functions = {'flatten': compare_flatten, 'decoders': compare_decoders}
+    return {comparison: functions[comparison](path, agency, version) for comparison in comparisons}
+
+
+def run_benchmark(path, agency, version, conn_str, final_conn_str=None, staging_db=None, final_batch_size=None,
+                  final_parallelism=None, **loader_options):
+    # times each stage of loading the export below path/agency/version into the staging database at conn_str, and
+    # the final model at final_conn_str if given. Streamed loaders parse the export again in validation and staging.
+    timer = Timer()
+    loader = timer('load', JSONLoader.from_path, str(path), agency, version, conn_str=conn_str, **loader_options)
+    publications = timer('parse', parse, loader)
+    timer.timings['parse'] += timer.timings.pop('load')
+    timer('validate', loader.validate)
+    timer('staging', loader.load_db, force=True)
+    if final_conn_str:
+        staging_db = staging_db or sqlalchemy.engine.make_url(conn_str).database
+        datamodel = DatamodelLoader(SUSDDatabase.from_url(final_conn_str), staging_db)
+        timer('final', datamodel.copy_from_staging, agency, version, batch_size=final_batch_size,
+              parallelism=final_parallelism)
+        datamodel.delete_agency_run(agency, version)
+    return {
+        'publications': publications,
+        'input_bytes': sum(source_size(i) for i in loader.json_files),
+        'peak_rss_bytes': peak_rss(),
+        'stages': {stage: {'seconds': seconds, 'publications_per_second': publications / seconds if seconds else None}
+                   for stage, seconds in timer.timings.items()},
+    }
+
+
+def regressions(results, baseline, tolerance=0.2):
+    # stages with a throughput more than tolerance below their baseline, as (stage, baseline, observed)
+    slower = []
+    for stage, expected in baseline.items():
+        observed = results['stages'].get(stage, {}).get('publications_per_second')
+        if observed is not None and observed < expected * (1 - tolerance):
+            slower.append((stage, expected, observed))
+    return slower
+
+
+def load_baselines(path):
+    if not path or not Path(path).exists():
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_baselines(path, baselines):
+    with open(path, 'w') as f:
+        json.dump(baselines, f, indent=2, sort_keys=True)
+    logger.info(f'saved baselines to {path}')
+
+
+def parse_args(argv):
+    ap = ArgumentParser(description='time the ingestion of generated or existing exports')
+    ap.add_argument('-n', '--publications', type=int, nargs='+', default=[10000],
+                    help='sizes of the synthetic exports to generate and load')
+    ap.add_argument('--export', help='base directory of an existing export to load instead, with --agency and '
+                                     '--run-version')
+    ap.add_argument('-a', '--agency')
+    ap.add_argument('-r', '--run-version')
+    ap.add_argument('--data-dir', help='directory synthetic exports are written to and reused from, by default a '
+                                       'temporary one')
+    ap.add_argument('--shard-size', type=int, default=50000)
+    ap.add_argument('--seed', type=int, default=0)
+    ap.add_argument('-c', '--connection-string', help='staging database, by default sqlite in a temporary directory')
+    ap.add_argument('--final-connection-string',
+                    help='final database to time the staging to final copy in, on the server of the staging database')
+    ap.add_argument('--staging-db')
+    ap.add_argument('--final-batch-size', type=int)
+    ap.add_argument('--final-parallelism', type=int)
+    ap.add_argument('--chunk-size', type=int)
+    ap.add_argument('--workers', type=int)
+    ap.add_argument('--batch-size', type=int)
+    ap.add_argument('--db-parallelism', type=int)
+    ap.add_argument('--json-decoder', choices=Decoder.backends)
+    ap.add_argument('--baseline', help='json file of throughput baselines per export')
+    ap.add_argument('--save-baseline', action='store_true', help='store the results as baselines')
+    ap.add_argument('--tolerance', type=float, default=0.2,
+                    help='fraction of a baseline throughput a stage may be slower without being flagged')
+    ap.add_argument('--compare', nargs='+', choices=COMPARISONS, default=[],
+                    help='also time the table properties against the single pass flattener, or the json decoders '
+                         'against each other, on each export')
+    ap.add_argument('--report', help='write the results to this json file')
+    args = ap.parse_args(argv)
+    if args.final_batch_size and args.final_parallelism and args.final_parallelism > 1:
+        ap.error('--final-batch-size and --final-parallelism can not be combined, batches are committed as a whole')
+    return args
+
+
+def main_with_args(argv):
+    args = parse_args(argv)
+    options = {k: v for k, v in [('chunk_size', args.chunk_size), ('workers', args.workers),
+                                 ('batch_size', args.batch_size), ('db_parallelism', args.db_parallelism),
+                                 ('decoder', args.json_decoder)] if v}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        conn_str = args.connection_string or f'sqlite:///{tmpdir}/staging.db'
+        if args.export:
+            runs = [(f'{args.agency}/{args.run_version}', args.export, args.agency, args.run_version)]
+        else:
+            data_dir = Path(args.data_dir or tmpdir)
+            runs = []
+            for n in args.publications:
+                if not data_dir.joinpath('synthetic', str(n), 'stat', 'export_metadata.json').exists():
+                    ExportGenerator(n, seed=args.seed).write(data_dir, 'synthetic', str(n), shard_size=args.shard_size)
+                runs.append((f'synthetic/{n}', data_dir, 'synthetic', str(n)))
+        baselines = load_baselines(args.baseline)
+        results, slower = {}, {}
+        for name, path, agency, version in runs:
+            results[name] = run_benchmark(path, agency, version, conn_str, args.final_connection_string,
+                                          args.staging_db, args.final_batch_size, args.final_parallelism, **options)
+            for stage, stats in results[name]['stages'].items():
+                logger.info(f'{name} {stage}: {stats["seconds"]:0.2f}s, '
+                            f'{stats["publications_per_second"] or 0:0.0f} publications/s')
+            if args.compare:
+                results[name]['comparisons'] = run_comparisons(args.compare, path, agency, version)
+                for comparison, timings in results[name]['comparisons'].items():
+                    logger.info(f'{name} {comparison}: ' + ', '.join(f'{k} {v:0.3f}s' for k, v in timings.items()))
+            slower[name] = regressions(results[name], baselines.get(name, {}), args.tolerance)
+            for stage, expected, observed in slower[name]:
+                logger.error(f'{name} {stage} regressed: {observed:0.0f} publications/s, baseline {expected:0.0f}')
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.save_baseline:
+        if not args.baseline:
+            raise ValueError('need --baseline to save baselines to')
+        baselines.update({name: {stage: stats['publications_per_second'] for stage, stats in result['stages'].items()}
+                          for name, result in results.items()})
+        save_baselines(args.baseline, baselines)
+    return not any(slower.values())
+
+
+def main():
+    logging.basicConfig(format='%(asctime)-15s %(levelname)s %(message)s', level=logging.INFO)
+    sys.exit(0 if main_with_args(sys.argv[1:]) else 1)
+
+
+if __name__ == '__main__':
+    main()
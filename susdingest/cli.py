@@ -2,17 +2,30 @@
 
 import logging
 import logging.config
+import queue
 import sys
 import os
-import yaml
-from susdingest import S3Loader, JSONLoader, DatamodelLoader, SUSDDatabase
+from susdingest.lazy import LazyImport
+from susdingest.metrics import Metrics
+from susdingest.profiling import MODES, STAGES, Profiler, profile
+from susdingest.scheduler import RunScheduler
+from susdingest.shardcache import ShardCache
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlparse
 from pathlib import Path
-from sqlalchemy.engine.url import make_url as db_url
+
+MANIFEST_FILE = '.manifest.sqlite'
+
+# loaders are only imported once a run needs them, so that -h or a run without new data starts quickly
+S3Loader = LazyImport('susdingest.s3loader', 'S3Loader')
+JSONLoader = LazyImport('susdingest.jsonloader', 'JSONLoader')
+DatamodelLoader = LazyImport('susdingest.datamodelloader', 'DatamodelLoader')
+SUSDDatabase = LazyImport('susdingest.susddatabase', 'SUSDDatabase')
 
 
 def connstring_with_db(conn, db):
+    from sqlalchemy.engine.url import make_url as db_url
     url = db_url(conn)
     return url.set(database=db)
 
@@ -24,6 +37,15 @@ def parse_s3(bucket):
     return parsed.netloc, parsed.path[1:]
 
 
+def parse_size(size):
+    # byte sizes with an optional K, M, G or T suffix
+    units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+    size = str(size).strip().upper().rstrip('B')
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+
 def parse_args(argv):
     ap = ArgumentParser()
     ap.add_argument('--bucket', default=os.getenv('SUSD_BUCKET'))
@@ -32,7 +54,85 @@ def parse_args(argv):
     ap.add_argument('--final-db', default=os.getenv('SUSD_FINAL_DB'))
     ap.add_argument('--mirror', default=os.getenv('SUSD_MIRROR_DIR'))
     ap.add_argument('--log-config', default=os.getenv('SUSD_LOG_CONFIG'))
-    return ap.parse_args(argv)
+    ap.add_argument('--streaming', action='store_true', default=bool(os.getenv('SUSD_STREAMING')),
+                    help='parse and load publications one shard at a time to bound memory use')
+    ap.add_argument('--chunk-size', type=int, default=os.getenv('SUSD_CHUNK_SIZE'),
+                    help='stream publications in chunks of this many records (implies --streaming)')
+    ap.add_argument('--workers', type=int, default=os.getenv('SUSD_WORKERS'),
+                    help='number of worker processes used to parse publication shards')
+    ap.add_argument('--cache-dir', default=os.getenv('SUSD_CACHE_DIR'),
+                    help='directory to cache parsed publication tables in, reused when shards are reloaded')
+    ap.add_argument('--cache-size', type=parse_size, default=os.getenv('SUSD_CACHE_SIZE'),
+                    help='maximum size of the cache directory, e.g. 20G, least recently used entries are evicted')
+    ap.add_argument('--batch-size', type=int, default=os.getenv('SUSD_BATCH_SIZE'),
+                    help='number of rows per insert batch when loading staging tables')
+    ap.add_argument('--db-parallelism', type=int, default=os.getenv('SUSD_DB_PARALLELISM'),
+                    help='maximum number of staging tables loaded concurrently')
+    ap.add_argument('--strict-alias-validation', action='store_true',
+                    default=bool(os.getenv('SUSD_STRICT_ALIAS_VALIDATION')),
+                    help='fail validation if documents per alias differ from the export metadata')
+    ap.add_argument('--json-decoder', choices=['orjson', 'json'], default=os.getenv('SUSD_JSON_DECODER'),
+                    help='json backend for decoding publication shards, defaults to orjson if installed')
+    ap.add_argument('--no-manifest', action='store_true', default=bool(os.getenv('SUSD_NO_MANIFEST')),
+                    help='decide which objects to download by file existence instead of the mirror manifest')
+    ap.add_argument('--s3-concurrency', type=int, default=os.getenv('SUSD_S3_CONCURRENCY'),
+                    help='maximum number of objects downloaded concurrently')
+    ap.add_argument('--s3-adaptive', action='store_true', default=bool(os.getenv('SUSD_S3_ADAPTIVE')),
+                    help='reduce concurrent downloads when s3 throttles requests')
+    ap.add_argument('--s3-part-size', type=parse_size, default=os.getenv('SUSD_S3_PART_SIZE'),
+                    help='size of the ranged requests large objects are downloaded in, e.g. 16M')
+    ap.add_argument('--s3-multipart-threshold', type=parse_size, default=os.getenv('SUSD_S3_MULTIPART_THRESHOLD'),
+                    help='objects larger than this are downloaded in parts, e.g. 64M')
+    ap.add_argument('--s3-part-concurrency', type=int, default=os.getenv('SUSD_S3_PART_CONCURRENCY'),
+                    help='number of parts of a single object downloaded concurrently')
+    ap.add_argument('--s3-verify-etag', action='store_true', default=bool(os.getenv('SUSD_S3_VERIFY_ETAG')),
+                    help='check downloads against the md5 etag of objects uploaded in a single part')
+    ap.add_argument('--s3-list-concurrency', type=int, default=os.getenv('SUSD_S3_LIST_CONCURRENCY'),
+                    help='list agency and version prefixes of the bucket concurrently with this many threads')
+    ap.add_argument('--agencies', default=os.getenv('SUSD_AGENCIES'),
+                    help='comma separated agencies to download, all if not given')
+    ap.add_argument('--min-version', default=os.getenv('SUSD_MIN_VERSION'),
+                    help='only download run versions from this one on')
+    ap.add_argument('--max-version', default=os.getenv('SUSD_MAX_VERSION'),
+                    help='only download run versions up to and including this one')
+    ap.add_argument('--direct-from-s3', action='store_true', default=bool(os.getenv('SUSD_DIRECT_FROM_S3')),
+                    help='read exports straight from s3 instead of mirroring them, the mirror directory then only '
+                         'holds the manifest of objects seen')
+    ap.add_argument('--mirror-max-size', type=parse_size, default=os.getenv('SUSD_MIRROR_MAX_SIZE'),
+                    help='evict the least recently ingested runs from the mirror beyond this size, e.g. 500G')
+    ap.add_argument('--mirror-keep-versions', type=int, default=os.getenv('SUSD_MIRROR_KEEP_VERSIONS'),
+                    help='evict ingested runs from the mirror beyond this many of the latest versions of each agency')
+    ap.add_argument('--parallel-runs', type=int, default=os.getenv('SUSD_PARALLEL_RUNS'),
+                    help='number of agency versions ingested at once')
+    ap.add_argument('--parse-parallelism', type=int, default=os.getenv('SUSD_PARSE_PARALLELISM'),
+                    help='maximum number of runs parsing publications at once')
+    ap.add_argument('--load-parallelism', type=int, default=os.getenv('SUSD_LOAD_PARALLELISM'),
+                    help='maximum number of runs loading the staging or final database at once')
+    ap.add_argument('--final-batch-size', type=int, default=os.getenv('SUSD_FINAL_BATCH_SIZE'),
+                    help='copy publications from staging to the final tables this many at a time, each batch '
+                         'committed on its own so that a failed copy resumes after the last batch')
+    ap.add_argument('--final-parallelism', type=int, default=os.getenv('SUSD_FINAL_PARALLELISM'),
+                    help='run up to this many independent steps of the copy to the final tables at once, each on its '
+                         'own connection and committed on its own')
+    ap.add_argument('--report', default=os.getenv('SUSD_REPORT'),
+                    help='write a json report of the time, cpu, rows, bytes and memory of each stage to this file')
+    ap.add_argument('--prometheus-textfile', default=os.getenv('SUSD_PROMETHEUS_TEXTFILE'),
+                    help='write stage metrics to this file for the prometheus node exporter textfile collector')
+    ap.add_argument('--profile', default=os.getenv('SUSD_PROFILE'),
+                    help=f'comma separated stages to profile, some of {",".join(STAGES)} or all')
+    ap.add_argument('--profile-mode', default=os.getenv('SUSD_PROFILE_MODE'),
+                    help=f'comma separated profilers, some of {",".join(MODES)}, by default cprofile')
+    ap.add_argument('--profile-dir', default=os.getenv('SUSD_PROFILE_DIR'),
+                    help='directory profiles are written to, one per stage and agency version')
+    ap.add_argument('--pipeline', action='store_true', default=bool(os.getenv('SUSD_PIPELINE')),
+                    help='load each agency and version as soon as it is downloaded instead of after the whole bucket')
+    args = ap.parse_args(argv)
+    if args.direct_from_s3 and args.no_manifest:
+        ap.error('--direct-from-s3 needs the mirror manifest to find updated runs, it can not be used with '
+                 '--no-manifest')
+    if args.final_batch_size and args.final_parallelism and args.final_parallelism > 1:
+        ap.error('--final-batch-size and --final-parallelism can not be combined, batches are committed as a whole')
+    return args
 
 
 def require_args(args, keys):
@@ -41,44 +141,250 @@ def require_args(args, keys):
             raise ValueError(f'Missing required argument {key}')
 
 
-def ingest_latest(args):
-    require_args(args, ['bucket', 'mirror', 'connection_string', 'staging_db', 'final_db'])
-    bucket, prefix = parse_s3(args.bucket)
+def json_options(args):
+    # only pass options that differ from JSONLoader defaults
+    options = {}
+    if getattr(args, 'streaming', False):
+        options['streaming'] = True
+    if getattr(args, 'chunk_size', None):
+        options['chunk_size'] = int(args.chunk_size)
+    if getattr(args, 'workers', None):
+        options['workers'] = int(args.workers)
+    if getattr(args, 'batch_size', None):
+        options['batch_size'] = int(args.batch_size)
+    if getattr(args, 'db_parallelism', None):
+        options['db_parallelism'] = int(args.db_parallelism)
+    if getattr(args, 'strict_alias_validation', False):
+        options['strict_aliases'] = True
+    if getattr(args, 'json_decoder', None):
+        options['decoder'] = args.json_decoder
+    if getattr(args, 'cache_dir', None):
+        cache_size = getattr(args, 'cache_size', None)
+        options['cache'] = ShardCache(args.cache_dir, max_bytes=parse_size(cache_size) if cache_size else None)
+    return options
+
+
+def s3_options(args):
+    # only pass options that differ from S3Loader defaults
+    options = {}
+    if getattr(args, 's3_concurrency', None):
+        options['max_concurrent'] = int(args.s3_concurrency)
+    if getattr(args, 's3_adaptive', False):
+        options['adaptive'] = True
+    if getattr(args, 's3_part_size', None):
+        options['part_size'] = parse_size(args.s3_part_size)
+    if getattr(args, 's3_multipart_threshold', None):
+        options['multipart_threshold'] = parse_size(args.s3_multipart_threshold)
+    if getattr(args, 's3_part_concurrency', None):
+        options['part_concurrency'] = int(args.s3_part_concurrency)
+    if getattr(args, 's3_verify_etag', False):
+        options['verify_etag'] = True
+    if getattr(args, 's3_list_concurrency', None):
+        options['list_concurrency'] = int(args.s3_list_concurrency)
+    if getattr(args, 'agencies', None):
+        options['agencies'] = [i.strip() for i in args.agencies.split(',') if i.strip()]
+    if getattr(args, 'min_version', None):
+        options['min_version'] = args.min_version
+    if getattr(args, 'max_version', None):
+        options['max_version'] = args.max_version
+    return options
+
+
+def final_options(args, resume=False):
+    # resume continues the batched copy of a run whose earlier copy did not complete
+    options = {}
+    if getattr(args, 'final_batch_size', None):
+        options['batch_size'] = int(args.final_batch_size)
+        if resume:
+            options['resume'] = True
+    if getattr(args, 'final_parallelism', None):
+        options['parallelism'] = int(args.final_parallelism)
+    return options
+
+
+def metrics_option(metrics):
+    return {'metrics': metrics} if metrics else {}
+
+
+def observers(args):
+    # metrics and profiler of the ingestion as loader options, only those enabled by args
+    options = {}
+    if getattr(args, 'report', None) or getattr(args, 'prometheus_textfile', None):
+        options['metrics'] = Metrics()
+    if getattr(args, 'profile', None):
+        options['profiler'] = Profiler(args.profile.split(','), args.profile_dir or '.',
+                                       (args.profile_mode or 'cprofile').split(','))
+    return options
+
+
+def sync_s3(s3loader, profiler=None, **kwargs):
+    with profile(profiler, 's3_sync'):
+        return s3loader.load_s3(**kwargs)
+
+
+def ingest_run(args, s3loader, agency, version, force, staging_db, final_db, scheduler=None, observed=None):
+    # returns whether the run reached the final database. Runs resume after the last stage recorded in the manifest,
+    # staging is only skipped if its tables are still there. A run already staged before did not complete its copy
+    # to the final tables, which a batched copy resumes, otherwise the run is replaced in the final tables.
+    scheduler = scheduler or RunScheduler()
+    observed = observed or {}
+    run = (agency, version)
+    try:
+        if force:
+            s3loader.reset_run(agency, version)
+            Path(args.mirror).joinpath(agency, version, '.force_reload').unlink()
+        stages = s3loader.run_stages(agency, version)
+        resume = 'staged' in stages and 'final' not in stages
+        if 'staged' in stages and JSONLoader.staged(staging_db, agency, version):
+            logging.info(f'{agency}, {version} already loaded to staging, resuming with the final load')
+        else:
+            # streamed runs are parsed while they are loaded, and only count against the database limit
+            with scheduler.stage(run, 'parse'):
+                if getattr(args, 'direct_from_s3', False):
+                    loader = JSONLoader.from_s3(*parse_s3(args.bucket), agency, version, **json_options(args),
+                                                **observed)
+                else:
+                    loader = JSONLoader.from_path(args.mirror, agency, version, **json_options(args), **observed)
+                loader.with_validation()
+            with scheduler.stage(run, 'staging', limit='db'):
+                # tables of an earlier, partial staging load are replaced
+                loader.with_db(staging_db).load_db(force=force or 'staged' in stages, release=True)
+            for stage in ['parsed', 'validated', 'staged']:
+                s3loader.record_stage(agency, version, stage)
+    except Exception as e:
+        logging.getLogger('notify').error(f'failed to load data from JSON to staging for {agency}, {version}: {e}')
+        return False
+    try:
+        with scheduler.stage(run, 'final', limit='db'), \
+                profile(observed.get('profiler'), 'copy_from_staging', agency=agency, version=version):
+            DatamodelLoader(SUSDDatabase.from_url(final_db), args.staging_db,
+                            **metrics_option(observed.get('metrics'))).copy_from_staging(agency, version,
+                                                                                         **final_options(args, resume))
+        logging.getLogger('notify').info(f'completed load of {agency}, {version} to final table!')
+    except Exception as e:
+        logging.getLogger('notify').error(
+            f'failed to load from staging to final table for {agency}, {version}: {e}')
+        return False
+    s3loader.record_stage(agency, version, 'final')
+    return True
+
+
+def run_scheduler(args):
+    return RunScheduler(max_runs=int(getattr(args, 'parallel_runs', None) or 1),
+                        limits={'parse': int(getattr(args, 'parse_parallelism', None) or 0),
+                                'db': int(getattr(args, 'load_parallelism', None) or 0)})
+
+
+def unfinished_runs(s3loader):
+    unfinished = s3loader.unfinished_runs()
+    if unfinished:
+        logging.info(f'resuming unfinished datasets: {unfinished}')
+    return unfinished
+
+
+def force_reload_runs(mirror):
+    return [i.relative_to(mirror).parent.parts for i in Path(mirror).glob('*/*/.force_reload')]
+
+
+def ingest_pipelined(args, s3loader, scheduler, staging_db, final_db, observed=None):
+    # runs are loaded as soon as their download completes, while the rest of the bucket is still downloading
+    force_reload = force_reload_runs(args.mirror)
+    logging.info(f'datasets requested to force_load: {force_reload}')
+    completed = queue.Queue()
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        download = executor.submit(sync_s3, s3loader, (observed or {}).get('profiler'),
+                                   on_run_complete=lambda *run: completed.put(run),
+                                   download=not getattr(args, 'direct_from_s3', False))
+        download.add_done_callback(lambda f: completed.put(None))
+        for run in iter(completed.get, None):
+            logging.info(f'download of {run} complete, loading')
+            scheduler.submit(run, ingest_run, args, s3loader, *run, run in force_reload, staging_db, final_db,
+                             scheduler, observed)
+    try:
+        updated = download.result()
+    except Exception as e:
+        scheduler.wait()
+        logging.getLogger('notify').error(f'failed to load data from s3 {s3loader.bucket} to {args.mirror}: {e}')
+        raise e
+    logging.info(f'loaded from S3, found updated datasets: {updated}')
+    # runs reported by the download but not handed off, e.g. without on_run_complete support, forced reloads and
+    # runs left unfinished by an earlier invocation
+    for run in (set(updated) | set(force_reload) | set(unfinished_runs(s3loader))) - set(scheduler.futures):
+        scheduler.submit(run, ingest_run, args, s3loader, *run, run in force_reload, staging_db, final_db, scheduler,
+                         observed)
+
+
+def ingest_mirrored(args, s3loader, scheduler, staging_db, final_db, observed=None):
     try:
-        updated = S3Loader(bucket, prefix, args.mirror).load_s3()
+        updated = sync_s3(s3loader, (observed or {}).get('profiler'),
+                          download=not getattr(args, 'direct_from_s3', False))
     except Exception as e:
-        logging.getLogger('notify').error(f'failed to load data from s3 {bucket} to {args.mirror}: {e}')
+        logging.getLogger('notify').error(f'failed to load data from s3 {s3loader.bucket} to {args.mirror}: {e}')
         raise e
     logging.info(f'loaded from S3, found updated datasets: {updated}')
-    force_reload = [i.relative_to(args.mirror).parent.parts for i in Path(args.mirror).glob('*/*/.force_reload')]
+    force_reload = force_reload_runs(args.mirror)
     logging.info(f'datasets requested to force_load: {force_reload}')
+    for run in set(updated).union(set(force_reload)).union(unfinished_runs(s3loader)):
+        scheduler.submit(run, ingest_run, args, s3loader, *run, run in force_reload, staging_db, final_db, scheduler,
+                         observed)
+
+
+def write_reports(args, observed, scheduler):
+    if observed.get('profiler'):
+        observed['profiler'].close()
+    metrics = observed.get('metrics')
+    if not metrics:
+        return
+    runs = [{'agency': run[0], 'version': run[1],
+             'succeeded': bool(future.done() and not future.cancelled() and future.result()),
+             **{f'{name}_seconds': elapsed for name, elapsed in scheduler.timings.get(run, {}).items()}}
+            for run, future in scheduler.futures.items()]
+    if getattr(args, 'report', None):
+        metrics.write_json(args.report, runs=runs)
+    if getattr(args, 'prometheus_textfile', None):
+        metrics.write_prometheus(args.prometheus_textfile)
+
+
+def prune_mirror(args, s3loader, failed):
+    max_bytes = getattr(args, 'mirror_max_size', None)
+    keep_versions = getattr(args, 'mirror_keep_versions', None)
+    if max_bytes is None and keep_versions is None:
+        return
+    if args.no_manifest or getattr(args, 'direct_from_s3', False):
+        logging.warning('mirror retention needs the manifest of a mirror, not pruning')
+        return
+    # failed runs are kept for another attempt
+    s3loader.prune_mirror(max_bytes=parse_size(max_bytes) if max_bytes is not None else None,
+                          keep_versions=int(keep_versions) if keep_versions is not None else None, in_flight=failed)
+
+
+def ingest_latest(args):
+    require_args(args, ['bucket', 'mirror', 'connection_string', 'staging_db', 'final_db'])
+    bucket, prefix = parse_s3(args.bucket)
     staging_db = connstring_with_db(args.connection_string, args.staging_db)
     final_db = connstring_with_db(args.connection_string, args.final_db)
-    for agency, version in set(updated).union(set(force_reload)):
-        try:
-            if (agency, version) in force_reload:
-                force = True
-                Path(args.mirror).joinpath(agency, version, '.force_reload').unlink()
-            else:
-                force = False
-            JSONLoader.from_path(args.mirror, agency, version) \
-                      .with_validation().with_db(staging_db).load_db(force=force)
-        except Exception as e:
-            logging.getLogger('notify').error(f'failed to load data from JSON to staging for {agency}, {version}: {e}')
-            continue
-        try:
-            DatamodelLoader(SUSDDatabase.from_url(final_db), args.staging_db).copy_from_staging(agency, version)
-            logging.getLogger('notify').info(f'completed load of {agency}, {version} to final table!')
-        except Exception as e:
-            logging.getLogger('notify').error(
-                f'failed to load from staging to final table for {agency}, {version}: {e}')
-            continue
+    manifest = None if args.no_manifest else Path(args.mirror).joinpath(MANIFEST_FILE)
+    observed = observers(args)
+    s3loader = S3Loader(bucket, prefix, args.mirror, manifest=manifest, **s3_options(args),
+                        **metrics_option(observed.get('metrics')))
+    scheduler = run_scheduler(args)
+    try:
+        if getattr(args, 'pipeline', False):
+            ingest_pipelined(args, s3loader, scheduler, staging_db, final_db, observed)
+        else:
+            ingest_mirrored(args, s3loader, scheduler, staging_db, final_db, observed)
+        results = scheduler.wait()
+        scheduler.log_summary(results)
+        prune_mirror(args, s3loader, {run for run, result in results.items() if not result})
+    finally:
+        write_reports(args, observed, scheduler)
 
 
 def main_with_args(argv):
     args = parse_args(argv)
     if args.log_config:
         with open(args.log_config, 'r') as f:
+            import yaml
             conf = yaml.load(f, yaml.SafeLoader)
             conf['disable_existing_loggers'] = False
             logging.config.dictConfig(conf)
@@ -1,14 +1,75 @@
 import os
 import logging
+import re
+import time
 
+import networkx as nx
+import sqlalchemy as sqla
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from .metrics import measure
 from .susddatabase import SUSDDatabase
 
+STEP_MARKER = re.compile(r'^-- step: (\w+)\s*$', re.MULTILINE)
+EID_RANGE = re.compile(r'\{EID_RANGE:([\w.]+)\}')
+DEPENDS = re.compile(r'^-- depends:(.*)$', re.MULTILINE)
+STAGING_TABLE = re.compile(r'\{ELSEVIER_SCHEMA\}\.\{ELSEVIER_PREFIX\}(\w+)\s+(\w+)')
+
+
+def read_steps(path):
+    # (name, sql) of the steps of a script, each starting at a '-- step: name' line
+    with open(path, 'r') as f:
+        parts = STEP_MARKER.split(f.read())
+    return [(name, sql.strip()) for name, sql in zip(parts[1::2], parts[2::2])]
+
+
+def step_graph(steps):
+    # dependency graph of steps, a step without a '-- depends:' line depends on all steps before it
+    names = [name for name, sql in steps]
+    graph = nx.DiGraph()
+    graph.add_nodes_from(names)
+    for n, (name, sql) in enumerate(steps):
+        match = DEPENDS.search(sql)
+        depends = [i.strip() for i in match.group(1).split(',') if i.strip()] if match else names[:n]
+        unknown = set(depends) - set(names)
+        if unknown:
+            raise ValueError(f'step {name} depends on unknown steps {sorted(unknown)}')
+        graph.add_edges_from((i, name) for i in depends)
+    if not nx.is_directed_acyclic_graph(graph):
+        raise ValueError(f'steps have circular dependencies: {nx.find_cycle(graph)}')
+    return graph
+
+
+def eid_range_tables(steps):
+    # staging tables the eid ranges of the steps of a script filter on, by the aliases of their eid columns
+    tables = set()
+    for name, sql in steps:
+        aliases = {alias: table for table, alias in STAGING_TABLE.findall(sql)}
+        tables.update(aliases[i.split('.')[0]] for i in EID_RANGE.findall(sql) if i.split('.')[0] in aliases)
+    return sorted(tables)
+
+
+def sql_literal(value):
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+def eid_range(sql, lower=None, upper=None):
+    # restricts the eid ranges of sql to eids after lower up to and including upper, all eids by default
+    def predicate(match):
+        column = match.group(1)
+        bounds = ([f'{column} > {sql_literal(lower)}'] if lower is not None else []) + \
+                 ([f'{column} <= {sql_literal(upper)}'] if upper is not None else [])
+        return ' and '.join(bounds) or '1=1'
+    return EID_RANGE.sub(predicate, sql)
+
 
 class DatamodelLoader:
-    def __init__(self, DM_database: SUSDDatabase, JSON_database: str, JSON_schema: str = 'dbo'):
+    def __init__(self, DM_database: SUSDDatabase, JSON_database: str, JSON_schema: str = 'dbo', metrics=None):
         # DM_database is the database containing the data model
         # JSON_database is name of database containing the elsevier data, JSON_schema is the corresponding schem
+        # metrics, if given, records the time taken by each step of the final load
         self.DM_database = DM_database
+        self.metrics = metrics
         self.DM_SCHEMA = DM_database.SCHEMA
         self.ELSEVIER_SCHEMA = f"{JSON_database}.{JSON_schema}"
         self.file_path = os.path.abspath(os.path.dirname(__file__))
@@ -33,28 +94,146 @@ class DatamodelLoader:
         self.DM_database.execute_update(sql)
         return self.DM_database.get_run_id(AGENCY, VERSION)
 
-    def copy_from_staging(self, AGENCY, VERSION, if_exists='replace', write_sql_log=False):
+    def copy_steps(self, AGENCY, VERSION, RUN_ID):
+        # (name, sql) of the steps copying a run from staging
+        steps = []
+        for name, sql in read_steps(f'{self.file_path}/sql/insert_elsevier.sql'):
+            sql = sql.replace("{DATABASE}", self.DM_database.DATABASE)
+            sql = sql.replace("{SCHEMA}", self.DM_SCHEMA)
+            sql = sql.replace("{ELSEVIER_SCHEMA}", self.ELSEVIER_SCHEMA)
+            sql = sql.replace("{ELSEVIER_PREFIX}", self.json_prefix(AGENCY, VERSION))
+            sql = sql.replace("{ORG}", AGENCY)
+            sql = sql.replace("{VERSION}", VERSION)
+            sql = sql.replace("{RUN_ID}", str(RUN_ID))
+            steps.append((name, sql))
+        return steps
+
+    def execute_steps(self, steps, AGENCY, VERSION, lower=None, upper=None):
+        # runs steps for the publications with eids in (lower, upper] in a single transaction
+        with self.DM_database.transaction() as connection:
+            for name, sql in steps:
+                sql = eid_range(sql, lower, upper)
+                logging.debug(f'submitting step {name}\n{sql}')
+                with measure(self.metrics, 'final_insert', agency=AGENCY, version=VERSION, step=name) as record:
+                    rowcount = connection.execute(sqla.text(sql)).rowcount
+                    record.add(max(rowcount or 0, 0))
+
+    def execute_graph(self, steps, AGENCY, VERSION, parallelism):
+        # runs each step in a transaction and on a connection of its own as soon as the steps it depends on are
+        # committed, at most parallelism at once. After a failed step no further steps are started.
+        graph = step_graph(steps)
+        sql = dict(steps)
+        waiting = {name: set(graph.predecessors(name)) for name in graph}
+        running = {}
+        with ThreadPoolExecutor(max_workers=parallelism) as executor:
+            while waiting or running:
+                for name in [name for name, _ in steps if name in waiting and not waiting[name]]:
+                    del waiting[name]
+                    running[executor.submit(self.execute_steps, [(name, sql[name])], AGENCY, VERSION)] = name
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    future.result()
+                    logging.debug(f'completed step {name} of {AGENCY}, {VERSION}')
+                    for successor in graph.successors(name):
+                        waiting[successor].discard(name)
+
+    def index_staging_eids(self, AGENCY, VERSION):
+        # staging tables are written without indexes, so that without one on eid every batch would scan the staging
+        # tables in full. The indexes go with the staging tables when they are replaced.
+        prefix = self.json_prefix(AGENCY, VERSION)
+        database = self.ELSEVIER_SCHEMA.split('.')[0]
+        for table in eid_range_tables(read_steps(f'{self.file_path}/sql/insert_elsevier.sql')):
+            name, index = f'{self.ELSEVIER_SCHEMA}.{prefix}{table}', f'ix_{prefix}{table}_eid'
+            sql = f"""
+            IF NOT EXISTS (SELECT * FROM {database}.sys.indexes
+                            WHERE object_id=OBJECT_ID('{name}') AND name='{index}')
+               CREATE INDEX [{index}] ON {name}(eid)
+            """
+            logging.debug(f'indexing eid of staging table {name}')
+            self.DM_database.execute_update(sql)
+
+    def batch_bounds(self, AGENCY, VERSION, batch_size, after=None):
+        # last eid of each batch of batch_size staged publications after eid after, in database order
+        sql = f"""
+        SELECT max(eid) AS eid
+          FROM (SELECT eid, (row_number() over (order by eid) - 1) / {int(batch_size)} AS batch
+                  FROM {self.ELSEVIER_SCHEMA}.{self.json_prefix(AGENCY, VERSION)}publications
+                 WHERE {eid_range('{EID_RANGE:eid}', after)}) b
+         GROUP BY batch
+         ORDER BY batch
+        """
+        return self.DM_database.execute_query(sql).eid.tolist()
+
+    def copied_until(self, AGENCY, VERSION, RUN_ID):
+        # last eid of the publications of the run already copied, None if none are
+        sql = f"""
+        SELECT max(eid) AS eid
+          FROM {self.ELSEVIER_SCHEMA}.{self.json_prefix(AGENCY, VERSION)}publications
+         WHERE eid IN (SELECT external_id FROM {self.DM_SCHEMA}.publication WHERE run_id={RUN_ID})
+        """
+        eid = self.DM_database.execute_query(sql).eid.tolist()
+        return eid[0] if eid and eid[0] is not None and eid[0] == eid[0] else None
+
+    def copy_batches(self, steps, AGENCY, VERSION, RUN_ID, batch_size, resume=False):
+        # batches of publications are committed one at a time in eid order, so that with resume a copy continues
+        # after the last publication copied. Steps without an eid range are committed with the first batch.
+        batched = [i for i in steps if EID_RANGE.search(i[1])]
+        run_wide = [i for i in steps if not EID_RANGE.search(i[1])]
+        lower = self.copied_until(AGENCY, VERSION, RUN_ID) if resume else None
+        if lower is not None:
+            logging.info(f'resuming copy of {AGENCY}, {VERSION} to final tables after eid {lower}')
+        bounds = self.batch_bounds(AGENCY, VERSION, batch_size, after=lower)
+        if lower is None and not bounds:
+            self.execute_steps(run_wide, AGENCY, VERSION)
+        for n, upper in enumerate(bounds):
+            start = time.time()
+            self.execute_steps((run_wide if lower is None else []) + batched, AGENCY, VERSION, lower, upper)
+            logging.info(f'copied batch {n + 1}/{len(bounds)} of {AGENCY}, {VERSION} to final tables up to eid {upper} '
+                         f'in {time.time() - start:0.1f}s')
+            lower = upper
+
+    def copy_from_staging(self, AGENCY, VERSION, if_exists='replace', write_sql_log=False, batch_size=None,
+                          parallelism=None, resume=False):
+        # an existing run is replaced, unless resume continues an interrupted copy in batches. With batch_size,
+        # publications are copied and committed batch_size at a time. With parallelism, independent steps run
+        # concurrently, each committed on its own, and the run is deleted again if the copy fails.
         if if_exists not in ['fail', 'replace']:
             raise Exception("if_exists must have value in ('fail', 'replace')")
+        parallel = bool(parallelism and parallelism > 1)
+        if batch_size and parallel:
+            raise ValueError('batch_size and parallelism can not be combined, batches are committed as a whole')
         RUN_ID = self.DM_database.get_run_id(AGENCY, VERSION)
         if RUN_ID is not None:
             if if_exists == 'fail':
                 raise Exception(f"run exists for {AGENCY} / {VERSION}")
+            if not (resume and batch_size):
+                RUN_ID = self.replace_run(AGENCY, VERSION)
         else:
             RUN_ID = self.create_run(AGENCY, VERSION)
 
-        copy_file = f'{self.file_path}/sql/insert_elsevier.sql'
-        with open(copy_file, "r") as f:
-            copy_command = f.read()
-        copy_command = copy_command.replace("{DATABASE}", self.DM_database.DATABASE)
-        copy_command = copy_command.replace("{SCHEMA}", self.DM_SCHEMA)
-        copy_command = copy_command.replace("{ELSEVIER_SCHEMA}", self.ELSEVIER_SCHEMA)
-        copy_command = copy_command.replace("{ELSEVIER_PREFIX}", self.json_prefix(AGENCY, VERSION))
-        copy_command = copy_command.replace("{ORG}", AGENCY)
-        copy_command = copy_command.replace("{VERSION}", VERSION)
-        copy_command = copy_command.replace("{RUN_ID}", str(RUN_ID))
-        logging.debug(f'submitting following SQL script\n{copy_command}')
-        self.DM_database.execute_update(copy_command)
+        steps = self.copy_steps(AGENCY, VERSION, RUN_ID)
+        if batch_size:
+            self.index_staging_eids(AGENCY, VERSION)
+            self.copy_batches(steps, AGENCY, VERSION, RUN_ID, batch_size, resume)
+        elif parallel:
+            try:
+                self.execute_graph(steps, AGENCY, VERSION, parallelism)
+            except Exception:
+                logging.error(f'copy of {AGENCY}, {VERSION} failed, deleting the partially copied run')
+                try:
+                    self.delete_agency_run(AGENCY, VERSION)
+                except Exception as e:
+                    logging.error(f'could not delete the partially copied run {AGENCY}, {VERSION}: {e}')
+                raise
+        else:
+            self.execute_steps(steps, AGENCY, VERSION)
+
+    def replace_run(self, AGENCY, VERSION):
+        # deletes all data of an existing run and creates it again, returning its new id
+        logging.info(f'deleting {AGENCY}, {VERSION} from the final tables before copying it again')
+        self.delete_agency_run(AGENCY, VERSION)
+        return self.create_run(AGENCY, VERSION)
 
     def delete_agency_run(self, AGENCY, VERSION, write_sql_log=False):
         # delete all data for an agency run
@@ -0,0 +1,228 @@
+import json
+import logging
+import pandas as pd
+from itertools import chain
+from operator import itemgetter
+from . import schema
+
+logger = logging.getLogger(__name__)
+
+
+PUBLICATION_COLUMNS = ['doi',
+                       'publication_title', 'publication_type', 'publication_year', 'publication_month',
+                       'citation_count', 'field_weighted_citation_impact',
+                       'journal_publishername', 'journal_title', 'journal_scopus_source_id']
+
+
+def missing(value):
+    return value is None or (isinstance(value, float) and value != value)
+
+
+def flatten_dict(record, prefix=''):
+    # same column naming as pd.json_normalize: nested objects become dot separated columns, lists are left as is
+    if dict not in map(type, record.values()):
+        return {f'{prefix}{k}': v for k, v in record.items()} if prefix else dict(record)
+    row = {}
+    for key, value in record.items():
+        if isinstance(value, dict):
+            row.update(flatten_dict(value, f'{prefix}{key}.'))
+        else:
+            row[f'{prefix}{key}'] = value
+    return row
+
+
+def as_list(value):
+    # rows produced for a value as if by DataFrame.explode, where missing and empty lists give one missing row
+    if isinstance(value, list):
+        return value if value else [None]
+    return [value]
+
+
+def join(values, sep):
+    return values if missing(values) else sep.join(str(i) for i in values)
+
+
+def compact_dumps(value):
+    # nested values passed through to staging are stored as compact, ascii only json
+    return json.dumps(value, separators=(',', ':'))
+
+
+def dumps(value, encode=compact_dumps):
+    return value if missing(value) else encode(value)
+
+
+class TableBuffer:
+
+    def __init__(self, kind):
+        # rows are buffered with the columns as they appear, and typed by the schema of kind in the final frame
+        self.kind = kind
+        self.index = []
+        self.rows = []
+        self.columns = []
+        self.batches = []
+        self.template = {}
+        self.getter = None
+        self.ragged = False
+
+    def __len__(self):
+        return len(self.index)
+
+    def add_columns(self, keys):
+        # columns are kept in order of first appearance, as with json_normalize
+        new = [i for i in keys if i not in self.template]
+        if not new:
+            return
+        self.ragged = bool(self.rows)
+        self.columns.extend(new)
+        self.template = dict.fromkeys(self.columns)
+        getter = itemgetter(*self.columns)
+        self.getter = getter if len(self.columns) > 1 else lambda row: (getter(row),)
+
+    def append(self, eid, row):
+        full = self.template.copy()
+        full.update(row)
+        if len(full) > len(self.template):
+            self.add_columns(row)
+        self.rows.append(self.getter(full))
+        self.index.append(eid)
+
+    def to_batch(self):
+        # the buffered rows as a column oriented batch, e.g. for passing between processes
+        width = len(self.columns)
+        rows = self.rows if not self.ragged else [i + (None,) * (width - len(i)) for i in self.rows]
+        return self.index, {column: list(map(itemgetter(i), rows)) for i, column in enumerate(self.columns)}
+
+    def extend(self, batch):
+        self.batches.append(batch)
+
+    def to_frame(self):
+        batches = self.batches + [self.to_batch()]
+        seen = dict.fromkeys(i for _, batch in batches for i in batch)
+        declared = schema.columns(self.kind)
+        undeclared = [i for i in seen if i not in declared]
+        if undeclared:
+            logger.warning(f'dropping undeclared columns {undeclared} from {self.kind}')
+        data = {i: list(chain.from_iterable(batch.get(i, (None,) * len(index)) for index, batch in batches))
+                for i in declared if i in seen}
+        index = pd.Index(list(chain.from_iterable(index for index, _ in batches)), name='eid', dtype=object)
+        return pd.DataFrame(data, index=index).reindex(columns=declared).astype(schema.dtypes(self.kind))
+
+
+class RecordFlattener:
+    # builds the publication level staging tables from nested publication records, visiting each record once and
+    # appending rows to columnar buffers for every requested table
+
+    kinds = ['publications', 'dyads', 'authors', 'affiliations', 'topics', 'topicclusters', 'asjcs', 'ufcs']
+
+    def __init__(self, kinds=None, encode=None):
+        self.encode = encode or compact_dumps
+        self.buffers = {kind: TableBuffer(kind) for kind in self.kinds}
+        self.selected = [i for i in self.kinds if i in (kinds or self.kinds)]
+        self.handlers = [(self.buffers[kind], getattr(self, f'_{kind}')) for kind in self.selected]
+
+    def add(self, eid, record):
+        for buffer, handler in self.handlers:
+            handler(buffer, eid, record)
+
+    def add_records(self, records):
+        for eid, record in records:
+            self.add(eid, record)
+        return self
+
+    def batch(self):
+        return {kind: self.buffers[kind].to_batch() for kind in self.selected}
+
+    def extend(self, batch):
+        for kind in self.selected:
+            self.buffers[kind].extend(batch[kind])
+        return self
+
+    def tables(self):
+        return {kind: self.buffers[kind].to_frame() for kind in self.selected}
+
+    def _publications(self, buffer, eid, record):
+        row = {i: record.get(i) for i in PUBLICATION_COLUMNS}
+        row['journal_issn_isbn'] = join(record.get('journal_issn_isbn'), '|')
+        row['tested_expressions'] = dumps(record.get('expressions'), self.encode)
+        citescore = record.get('journal_citescore')
+        if isinstance(citescore, dict):
+            row.update({f'journal_{k}': v for k, v in flatten_dict(citescore).items()})
+        buffer.append(eid, row)
+
+    dyad_columns = {
+        'identified_dataset_name': 'alias',
+        'snippets': 'snippet',
+        'linked_alias.fuzzy_score': 'fuzzy_score',
+        'linked_alias.is_fuzzy': 'is_fuzzy',
+        'linked_alias.alias_id': 'alias_id',
+        'linked_alias.alias': None,
+        'models': None,
+    }
+
+    def _dyads(self, buffer, eid, record):
+        for dataset in as_list(record.get('identified_datasets')):
+            if not isinstance(dataset, dict):
+                continue
+            flat = flatten_dict(dataset)
+            base = {self.dyad_columns.get(k, k): v for k, v in flat.items()}
+            base.pop(None, None)
+            for snippet in as_list(flat.get('snippets')):
+                if snippet == '' or snippet == 'Not Available':
+                    snippet = None
+                for model in as_list(flat.get('models')):
+                    row = base.copy()
+                    row['snippet'] = snippet
+                    if isinstance(model, dict):
+                        row['model'] = model.get('model')
+                        row['score'] = model.get('score')
+                    buffer.append(eid, row)
+
+    def _authors(self, buffer, eid, record):
+        for author in as_list(record.get('authors')):
+            if not isinstance(author, dict):
+                continue
+            row = flatten_dict(author)
+            if 'affiliation_sequences' in row:
+                row['affiliation_sequences'] = dumps(row['affiliation_sequences'], self.encode)
+            if all(missing(i) for i in row.values()):
+                buffer.add_columns(row)
+                continue
+            buffer.append(eid, row)
+
+    def _affiliations(self, buffer, eid, record):
+        for affiliation in as_list(record.get('affiliations')):
+            if not isinstance(affiliation, dict):
+                continue
+            row = {k.replace('affiliation_text.', '', 1) if k.startswith('affiliation_text.') else k: v
+                   for k, v in flatten_dict(affiliation).items()}
+            row['affiliation_organization'] = join(row.get('affiliation_organization'), ', ')
+            ids = row.get('affiliation_ids')
+            row['affiliation_id'] = ids[0] if isinstance(ids, list) and ids else None
+            row['affiliation_ids'] = join(ids, '|')
+            row['affiliation_normalized'] = dumps(row.get('affiliation_normalized'), self.encode)
+            buffer.append(eid, row)
+
+    def _keywords_table(self, buffer, eid, value):
+        if not isinstance(value, dict):
+            return
+        row = flatten_dict(value)
+        if 'keywords' in row:
+            row['keywords'] = join(row['keywords'], '|')
+        buffer.append(eid, row)
+
+    def _topics(self, buffer, eid, record):
+        self._keywords_table(buffer, eid, record.get('topic'))
+
+    def _topicclusters(self, buffer, eid, record):
+        self._keywords_table(buffer, eid, record.get('topic_cluster'))
+
+    def _nested_list_table(self, buffer, eid, value):
+        for item in as_list(value):
+            if isinstance(item, dict):
+                buffer.append(eid, flatten_dict(item))
+
+    def _asjcs(self, buffer, eid, record):
+        self._nested_list_table(buffer, eid, record.get('asjcs'))
+
+    def _ufcs(self, buffer, eid, record):
+        self._nested_list_table(buffer, eid, record.get('unified_fingerprint_concepts'))
@@ -1,12 +1,96 @@
 import pandas as pd
 import sqlalchemy
+import gzip
 import json
 import logging
+import multiprocessing
+import os
 from argparse import ArgumentParser
-from pathlib import Path
+from collections import deque
+from concurrent.futures import FIRST_EXCEPTION, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from functools import partial, wraps
+from pathlib import Path, PurePosixPath
+from .flattener import RecordFlattener, compact_dumps, dumps
+from .metrics import measure, measure_each
+from .profiling import profile
+from .schema import apply_schema, columns, sql_types
+from .shardcache import ShardCache
+from .stagingwriter import StagingWriter, log_summary
+from .validation import Validator
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 logger = logging.getLogger(__name__)
 
+DEFAULT_DB_PARALLELISM = 4
+
+
+def open_source(source):
+    # local files by path, other sources such as an S3Source open themselves as binary streams
+    if isinstance(source, (str, Path)):
+        return open(source, 'rb')
+    return source.open()
+
+
+def source_size(source):
+    if isinstance(source, (str, Path)):
+        return os.path.getsize(source)
+    return getattr(source, 'size', None) or 0
+
+
+def orjson_dumps(value):
+    # orjson does not escape non ascii characters, such values are left to the standard library
+    text = orjson.dumps(value).decode()
+    return text if text.isascii() else compact_dumps(value)
+
+
+class Decoder:
+    # json backend for publication lines, orjson if it is installed and the standard library otherwise. Lines are
+    # decoded straight to records for the flattener, and both backends encode pass-through values identically.
+    backends = ['orjson', 'json']
+
+    def __init__(self, backend=None):
+        backend = backend or ('orjson' if orjson else 'json')
+        if backend not in self.backends:
+            raise ValueError(f'unknown json backend {backend}, expecting one of {self.backends}')
+        if backend == 'orjson' and not orjson:
+            raise ImportError('json backend orjson is not installed')
+        self.backend = backend
+        self.loads = orjson.loads if backend == 'orjson' else json.loads
+        self.dumps = orjson_dumps if backend == 'orjson' else compact_dumps
+
+    def records(self, json_file):
+        with open_source(json_file) as raw, gzip.open(raw, 'rb') as f:
+            for line in f:
+                if line.strip():
+                    record = self.loads(line)
+                    yield record.get('eid'), record
+
+
+def flatten_shard(json_file, decoder=None):
+    # run in worker processes, returns the flattened tables of one shard as a compact column oriented batch
+    decoder = Decoder(decoder)
+    return RecordFlattener(encode=decoder.dumps).add_records(decoder.records(json_file)).batch()
+
+
+def table(func):
+    # export tables are derived once and cached until the data changes or they are released, they may also be
+    # filled in all at once by flatten or by worker processes
+    @property
+    @wraps(func)
+    def wrapper(self):
+        kind = func.__name__
+        if kind not in self._tables:
+            if self.data is None and kind in RecordFlattener.kinds:
+                raise RuntimeError(f'table {kind} is not available, publication records are not held in memory')
+            with profile(self.profiler, f'table_{kind}', **self.labels()):
+                self._tables[kind] = apply_schema(kind, func(self))
+        return self._tables[kind]
+    return wrapper
+
 
 class JSONLoader:
     export_kinds = ['publications', 'dyads', 'authors', 'affiliations', 'topics', 'topicclusters', 'asjcs', 'ufcs',
@@ -14,7 +98,7 @@ class JSONLoader:
     sqlengine = None
 
     @classmethod
-    def from_path(cls, path, agency=None, run_version=None):
+    def from_path(cls, path, agency=None, run_version=None, **kwargs):
         if not isinstance(path, Path):
             path = Path(path)
         if agency or run_version:
@@ -24,39 +108,212 @@ class JSONLoader:
         else:
             agency = path.resolve().parent.name
             run_version = path.resolve().name
-        json_files = list(path.glob('json/publications/*.json.gz'))
+        json_files = sorted(path.glob('json/publications/*.json.gz'))
         if not json_files:
             raise RuntimeError('no publication data found under path {path}')
         metadata_file = path.joinpath('stat/export_metadata.json')
         if not metadata_file.exists():
             raise RuntimeError('no export metadata found under path {path}')
-        return cls(json_files, metadata_file=metadata_file, agency=agency, run_version=run_version)
+        return cls(json_files, metadata_file=metadata_file, agency=agency, run_version=run_version, **kwargs)
 
-    def __init__(self, json_files, metadata_file=None, agency=None, run_version=None, conn_str=None, force=None):
+    @classmethod
+    def from_s3(cls, bucket, prefix, agency, run_version, session_args=None, **kwargs):
+        # read an export straight from s3, shards are streamed and decompressed as they are parsed
+        # boto3 is only imported for exports read from S3
+        from .s3loader import S3Source, ensure_trailing_slash
+        run_prefix = f'{ensure_trailing_slash(prefix) if prefix else ""}{agency}/{run_version}/'
+        objects = {i.key: i for i in S3Source.list(bucket, run_prefix, session_args=session_args)}
+        json_files = [objects[i] for i in sorted(objects)
+                      if PurePosixPath(i).parent == PurePosixPath(run_prefix, 'json/publications') and
+                      i.endswith('.json.gz')]
+        if not json_files:
+            raise RuntimeError(f'no publication data found under s3://{bucket}/{run_prefix}')
+        metadata_file = objects.get(f'{run_prefix}stat/export_metadata.json')
+        if not metadata_file:
+            raise RuntimeError(f'no export metadata found under s3://{bucket}/{run_prefix}')
+        return cls(json_files, metadata_file=metadata_file, agency=agency, run_version=run_version, **kwargs)
+
+    def __init__(self, json_files, metadata_file=None, agency=None, run_version=None, conn_str=None, force=None,
+                 streaming=False, chunk_size=None, workers=None, cache=None, batch_size=None,
+                 db_parallelism=None, strict_aliases=False, decoder=None, metrics=None, profiler=None):
         self.agency = agency
         self.run_version = run_version
         self.conn_str = conn_str
         self.force = force
-        self.json_files = json_files
+        self.json_files = list(json_files)
+        # in streaming mode records are only read one shard (or chunk_size records) at a time, as tables are produced
+        self.streaming = streaming or bool(chunk_size)
+        self.chunk_size = chunk_size
+        # shards are decompressed, parsed and flattened in a pool of worker processes if workers is set
+        self.workers = workers
+        # flattened tables of each shard are reused from a ShardCache if given, skipping parsing on reloads
+        self.cache = cache
+        # json backend used when shards are decoded line by line, rather than by pandas
+        self.decoder = Decoder(decoder)
+        # rows per insert batch when writing to the staging database
+        self.batch_size = batch_size
+        # maximum number of staging tables written concurrently, each on its own connection
+        self.db_parallelism = db_parallelism
+        # per alias document counts must match the metadata only if strict_aliases is set
+        self.strict_aliases = strict_aliases
+        # metrics parsing and loading are recorded in, if given
+        self.metrics = metrics
+        # profiler the stages of loading are profiled with, if given
+        self.profiler = profiler
+        self.pending_validation = None
         self.metadata = None
         if metadata_file:
-            with open(metadata_file, 'r') as f:
+            with open_source(metadata_file) as f:
                 self.metadata = json.load(f)
-        self.load_json()
+        self.data = None
+        if not self.streaming:
+            self.load_json()
+
+    @property
+    def data(self):
+        return self._data
+
+    @data.setter
+    def data(self, data):
+        self._data = data
+        self.invalidate()
+
+    def invalidate(self, kinds=None):
+        # drop cached tables, all of them by default
+        if kinds is None:
+            self._tables = {}
+        for kind in kinds or []:
+            self._tables.pop(kind, None)
+
+    def read_json(self, json_file):
+        if not isinstance(json_file, (str, Path)):
+            with open_source(json_file) as raw, gzip.open(raw, 'rb') as f:
+                yield from self.read_json_lines(f, str(json_file))
+            return
+        yield from self.read_json_lines(json_file, str(json_file))
+
+    def read_json_lines(self, lines, src_file):
+        if self.chunk_size:
+            with pd.read_json(lines, lines=True, chunksize=self.chunk_size) as reader:
+                for chunk in reader:
+                    yield chunk.assign(src_file=src_file)
+        else:
+            yield pd.read_json(lines, lines=True).assign(src_file=src_file)
+
+    def map_shards(self, func, json_files):
+        # results are returned in shard order, independent of the number of workers, with at most one pending
+        # result per worker so that streaming stays bounded in memory. Workers are spawned rather than forked, as
+        # forking while other threads hold locks, such as those of concurrent runs, can deadlock the workers.
+        if not self.workers:
+            yield from map(func, json_files)
+            return
+        with ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+            pending = deque()
+            for json_file in json_files:
+                pending.append(executor.submit(func, json_file))
+                if len(pending) > self.workers:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+    def shard_batches(self):
+        # flattened batches of all shards in order, read from the cache where possible and parsed otherwise
+        cached = [i in self.cache for i in self.json_files] if self.cache else [False] * len(self.json_files)
+        parsed = self.map_shards(partial(flatten_shard, decoder=self.decoder.backend),
+                                 [i for i, hit in zip(self.json_files, cached) if not hit])
+        # hits of this run are kept when caching its misses, they may not have been read yet
+        hits = [i for i, hit in zip(self.json_files, cached) if hit]
+        for json_file, hit in zip(self.json_files, cached):
+            if hit:
+                logger.debug(f'using cached tables for {json_file}')
+                batch = self.cache.get(json_file)
+                if batch is None:
+                    logger.warning(f'cached tables for {json_file} are gone, parsing it again')
+                    batch = flatten_shard(json_file, decoder=self.decoder.backend)
+                yield batch
+                continue
+            batch = next(parsed)
+            if self.cache:
+                self.cache.put(json_file, batch, keep=hits)
+            yield batch
+
+    def labels(self):
+        return {'agency': self.agency, 'version': self.run_version}
 
     def load_json(self):
-        self.data = pd.concat([pd.read_json(i, lines=True).assign(src_file=str(i)) for i in self.json_files]) \
-                      .set_index('eid')
-        logger.debug('loaded {len(self.data)} records from json files')
+        with measure(self.metrics, 'parse', **self.labels()) as record, \
+                profile(self.profiler, 'load_json', **self.labels()):
+            record.add(0, sum(source_size(i) for i in self.json_files))
+            if self.workers or self.cache:
+                flattener = RecordFlattener()
+                for batch in self.shard_batches():
+                    flattener.extend(batch)
+                self.data = None
+                self._tables = flattener.tables()
+                record.add(len(self._tables['publications']))
+                logger.debug(f'loaded {len(self._tables["publications"])} records from json files by shard')
+                return
+            self.data = pd.concat([chunk for i in self.json_files for chunk in self.read_json(i)]).set_index('eid')
+            record.add(len(self.data))
+            logger.debug(f'loaded {len(self.data)} records from json files')
+
+    def chunk(self, json_files, data=None, tables=None):
+        chunk = JSONLoader(json_files, agency=self.agency, run_version=self.run_version, streaming=True,
+                           decoder=self.decoder.backend, metrics=self.metrics, profiler=self.profiler)
+        chunk.metadata = self.metadata
+        chunk.data = data
+        chunk._tables = tables or {}
+        return chunk
+
+    def iter_chunks(self):
+        if not self.streaming:
+            yield self
+            return
+        # streamed chunks are parsed as they are requested
+        yield from measure_each(self.metrics, 'parse', self.stream_chunks(), count=lambda chunk: chunk.source_counts,
+                                **self.labels())
+
+    def stream_chunks(self):
+        if self.workers or self.cache or not self.chunk_size:
+            for json_file, batch in zip(self.json_files, self.shard_batches()):
+                logger.debug(f'streaming records from {json_file}')
+                chunk = self.chunk([json_file], tables=RecordFlattener().extend(batch).tables())
+                chunk.source_counts = (len(chunk._tables['publications']), source_size(json_file))
+                yield chunk
+        else:
+            for json_file in self.json_files:
+                for n, records in enumerate(self.read_json(json_file)):
+                    logger.debug(f'streaming {len(records)} records from {json_file}')
+                    chunk = self.chunk([json_file], data=records.set_index('eid'))
+                    # compressed bytes are counted with the first chunk of the file
+                    chunk.source_counts = (len(records), source_size(json_file) if n == 0 else 0)
+                    yield chunk
+
+    def records(self):
+        columns = list(self.data.columns)
+        values = zip(*[self.data[i].tolist() for i in columns])
+        return zip(self.data.index, (dict(zip(columns, i)) for i in values))
+
+    def flatten(self, kinds=None):
+        # produce the requested tables (default all export kinds) in a single pass over the publication records
+        kinds = kinds or self.export_kinds
+        pending = [i for i in kinds if i not in self._tables and i in RecordFlattener.kinds]
+        if pending and self.data is not None:
+            with measure(self.metrics, 'flatten', **self.labels()) as record, \
+                    profile(self.profiler, 'flatten', **self.labels()):
+                flattener = RecordFlattener(pending, encode=self.decoder.dumps)
+                self._tables.update(flattener.add_records(self.records()).tables())
+                record.add(len(self.data))
+        return {i: getattr(self, i) for i in kinds}
 
     def normalize_col(self, column, explode=True):
         if explode:
             col = self.data.explode(column)[column].dropna()
         else:
             col = self.data[column].dropna()
-        return pd.json_normalize(col).set_index(col.index).convert_dtypes()
+        return pd.json_normalize(col).set_index(col.index)
 
-    @property
+    @table
     def publications(self):
         publications = self.data[
             ['doi',
@@ -70,12 +327,12 @@ class JSONLoader:
         else:
             publications['tested_expressions'] = self.data[
                 'expressions'
-            ].apply(lambda x: json.dumps(x) if x == x else x)
+            ].apply(lambda x: dumps(x, self.decoder.dumps))
         citescore = self.normalize_col('journal_citescore', explode=False) \
                         .rename(columns=lambda x: f'journal_{x}')
-        return publications.join(citescore).convert_dtypes()
+        return publications.join(citescore)
 
-    @property
+    @table
     def dyads(self):
         columns_map = {
             'snippets': 'snippet',
@@ -92,16 +349,16 @@ class JSONLoader:
                     .rename(columns=columns_map) \
                     .drop(columns=['linked_alias.alias', 'models'])
         dyads['snippet'] = dyads['snippet'].replace(['', 'Not Available'], pd.NA)
-        return dyads.convert_dtypes()
+        return dyads
 
-    @property
+    @table
     def authors(self):
         authors = self.normalize_col('authors')
         authors['affiliation_sequences'] = authors['affiliation_sequences'].apply(
-            lambda x: json.dumps(x) if x == x else x)
+            lambda x: dumps(x, self.decoder.dumps))
         return authors.dropna(how='all')
 
-    @property
+    @table
     def affiliations(self):
         affils = self.normalize_col('affiliations')
         rename = {i: i.replace('affiliation_text.', '') for i in affils.columns if i.startswith('affiliation_text.')}
@@ -113,40 +370,42 @@ class JSONLoader:
         affils['affiliation_ids'] = affils['affiliation_ids'].apply(
             lambda x: '|'.join(str(i) for i in x) if x == x else x)
         affils['affiliation_normalized'] = affils['affiliation_normalized'].apply(
-            lambda x: json.dumps(x) if x == x else x)
+            lambda x: dumps(x, self.decoder.dumps))
         return affils
 
-    @property
+    @table
     def asjcs(self):
         return self.normalize_col('asjcs')
 
-    @property
+    @table
     def topics(self):
         topics = self.normalize_col('topic', explode=False)
         topics['keywords'] = topics['keywords'].apply(lambda x: '|'.join(x))
         return topics
 
-    @property
+    @table
     def topicclusters(self):
         topicclusters = self.normalize_col('topic_cluster', explode=False)
         topicclusters['keywords'] = topicclusters['keywords'].apply(lambda x: '|'.join(x))
         return topicclusters
 
-    @property
+    @table
     def datasets(self):
         if not self.metadata:
             return pd.DataFrame([])
+        # the per alias document counts of the metadata are validated, not staged
         return pd.DataFrame(
             self.metadata['stats']['documents_per_alias']
-        )[['alias', 'alias_id', 'parent_alias_id', 'alias_type']].convert_dtypes()
+        )[columns('datasets')]
 
-    @property
+    @table
     def ufcs(self):
         return self.normalize_col('unified_fingerprint_concepts')
 
     def dump_csv(self):
-        for kind in self.export_kinds:
-            getattr(self, kind).to_csv(f'{kind}.csv')
+        for n, chunk in enumerate(self.iter_chunks()):
+            for kind, table in chunk.flatten([i for i in self.export_kinds if i != 'datasets' or n == 0]).items():
+                table.to_csv(f'{kind}.csv', mode='w' if n == 0 else 'a', header=n == 0)
 
     def start_sql(self):
         if not self.sqlengine:
@@ -155,45 +414,110 @@ class JSONLoader:
             logger.debug('creating sql engine')
             self.sqlengine = sqlalchemy.create_engine(self.conn_str)
 
+    def validator(self, raise_exception=True):
+        return Validator(self.metadata, raise_exception=raise_exception, strict_aliases=self.strict_aliases,
+                         name=f'{self.agency}_{self.run_version}')
+
     def validate(self, raise_exception=True):
-        if not self.metadata:
-            raise ValueError('need metadata to validate!')
-        uniq_docs = self.metadata['stats']['overall']['unique_documents_per_year']
-        year_counts_expected = pd.DataFrame(uniq_docs).convert_dtypes().set_index('publication_year')
-        year_counts_observed = self.publications.reset_index() \
-                                                .groupby('publication_year') \
-                                                .nunique()[['eid']].rename(columns={'eid': 'documents'})
-        year_counts_valid = year_counts_expected.join(year_counts_observed, rsuffix='_o', how='outer') \
-            .fillna(0).assign(diff=lambda x: x['documents'] - x['documents_o'])['diff'] \
-                      .apply(lambda x: x == 0).all()
-        logger.info(f'input validation of publications by year: {year_counts_valid}')
-        eid_no_duplicates = self.data.assign(c=1).groupby('eid').count().c.max() == 1
-        logger.info(f'input validation Eid uniqueness: {eid_no_duplicates}')
-        valid = year_counts_valid and eid_no_duplicates
-        if not valid and raise_exception:
-            raise AssertionError(f'input validation failed for {self.agency}_{self.run_version}!')
-        return valid
+        validator = self.validator(raise_exception)
+        for chunk in self.iter_chunks():
+            chunk.flatten(['publications', 'dyads'])
+            validator.add(chunk.publications, chunk.dyads)
+        return validator.check()
 
     def with_validation(self):
-        self.validate()
+        # streamed exports are validated while they are loaded rather than read twice
+        if self.streaming:
+            self.pending_validation = self.validator()
+        else:
+            self.validate()
         return self
 
+    @classmethod
+    def staged(cls, conn_str, agency, run_version):
+        # whether all staging tables of the run exist, e.g. to resume a run after its staging load
+        engine = sqlalchemy.create_engine(conn_str)
+        try:
+            with engine.connect() as connection:
+                tables = set(sqlalchemy.inspect(connection).get_table_names())
+        finally:
+            engine.dispose()
+        return all(f'{agency}_{run_version}_{kind}' in tables for kind in cls.export_kinds)
+
     def with_db(self, conn_str):
         self.conn_str = conn_str
         return self
 
-    def load_db(self, force=None):
+    def write_table(self, table, table_name, if_exists, created, stats, dtype=None):
+        # run in a thread on a connection of its own
+        with self.sqlengine.connect() as connection:
+            if if_exists == 'fail' and sqlalchemy.inspect(connection).has_table(table_name):
+                raise ValueError(f"Table '{table_name}' already exists.")
+            # from here on the table is owned by this run, and dropped if the run fails
+            created.add(table_name)
+            with measure(self.metrics, 'staging_write', table=table_name, **self.labels()) as record:
+                writer = StagingWriter(connection, batch_size=self.batch_size, stats=stats)
+                writer.write(table, table_name, if_exists, dtype=dtype)
+                record.add(len(table), table.memory_usage(index=True, deep=True).sum())
+
+    def drop_tables(self, table_names):
+        with self.sqlengine.connect() as connection:
+            for table_name in table_names:
+                logger.info(f'dropping partially loaded table {table_name}')
+                try:
+                    sqlalchemy.Table(table_name, sqlalchemy.MetaData()).drop(connection, checkfirst=True)
+                except Exception as e:
+                    logger.error(f'could not drop table {table_name}: {e}')
+
+    def load_db(self, force=None, release=False):
         if not (self.agency and self.run_version):
             raise ValueError('need agency and version info')
+        with profile(self.profiler, 'load_db', **self.labels()):
+            self._load_db(force, release)
+
+    def _load_db(self, force, release):
         force = self.force if force is None else force
         prefix = f'{self.agency}_{self.run_version}'
         self.start_sql()
-        with self.sqlengine.connect() as connection:
-            for kind in self.export_kinds:
-                table_name = f'{prefix}_{kind}'
-                logger.info(f'loading table {kind} to database with table name {table_name}')
-                getattr(self, kind).reset_index().to_sql(
-                    table_name, index=False, con=connection, if_exists='replace' if force else 'fail')
+        # sqlite only allows a single writer
+        parallelism = 1 if self.sqlengine.dialect.name == 'sqlite' else self.db_parallelism or DEFAULT_DB_PARALLELISM
+        created_kinds, created, stats = set(), set(), {}
+        try:
+            with ThreadPoolExecutor(max_workers=parallelism) as executor:
+                for chunk in self.iter_chunks():
+                    kinds = [i for i in self.export_kinds if i != 'datasets' or i not in created_kinds]
+                    chunk.flatten(kinds)
+                    if self.pending_validation:
+                        self.pending_validation.add(chunk.publications, chunk.dyads)
+                    futures = []
+                    for kind in kinds:
+                        table_name = f'{prefix}_{kind}'
+                        table = getattr(chunk, kind).reset_index()
+                        # tables follow the schema, so later chunks are appended to the table created by the first
+                        if kind in created_kinds:
+                            if_exists = 'append'
+                        else:
+                            logger.info(f'loading table {kind} to database with table name {table_name}')
+                            created_kinds.add(kind)
+                            if_exists = 'replace' if force else 'fail'
+                        futures.append(executor.submit(self.write_table, table, table_name, if_exists, created, stats,
+                                                       sql_types(kind)))
+                    done, pending = wait(futures, return_when=FIRST_EXCEPTION)
+                    for future in pending:
+                        future.cancel()
+                    wait(pending)
+                    for future in futures:
+                        if not future.cancelled() and future.exception():
+                            raise future.exception()
+                    if release:
+                        chunk.invalidate(kinds)
+            if self.pending_validation:
+                self.pending_validation.check()
+        except Exception:
+            logger.error(f'loading tables for {prefix} failed, removing tables created by this run')
+            self.drop_tables(sorted(created))
+            raise
+        log_summary(stats)
 
 
 if __name__ == '__main__':
@@ -206,12 +530,21 @@ if __name__ == '__main__':
     ap.add_argument('--to-db', action='store_true')
     ap.add_argument('--force', action='store_true')
     ap.add_argument('--to-csv', action='store_true')
+    ap.add_argument('--streaming', action='store_true')
+    ap.add_argument('--chunk-size', type=int)
+    ap.add_argument('--workers', type=int)
+    ap.add_argument('--cache-dir')
+    ap.add_argument('--batch-size', type=int)
+    ap.add_argument('--db-parallelism', type=int)
+    ap.add_argument('--json-decoder', choices=Decoder.backends)
     ap.add_argument('json_files', nargs='+')
     args = ap.parse_args()
 
     jl = JSONLoader(
         args.json_files, agency=args.agency, run_version=args.run_version, conn_str=args.connection_string,
-        force=args.force)
+        force=args.force, streaming=args.streaming, chunk_size=args.chunk_size, workers=args.workers,
+        cache=ShardCache(args.cache_dir) if args.cache_dir else None, batch_size=args.batch_size,
+        db_parallelism=args.db_parallelism, decoder=args.json_decoder)
     if args.dump:
         table = getattr(jl, args.dump)
         if args.filter:
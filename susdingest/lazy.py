@@ -0,0 +1,28 @@
+import importlib
+
+
+class LazyImport:
+    # stands in for an attribute of a module that is only imported when it is first used, e.g. a loader whose module
+    # pulls in pandas or boto3. Calls and attribute access go to the attribute itself.
+
+    def __init__(self, module, name):
+        self._module = module
+        self._name = name
+        self._value = None
+
+    def resolve(self):
+        if self._value is None:
+            self._value = getattr(importlib.import_module(self._module), self._name)
+        return self._value
+
+    def __call__(self, *args, **kwargs):
+        return self.resolve()(*args, **kwargs)
+
+    def __getattr__(self, attr):
+        # not called for the attributes set in __init__, unless they are missing, e.g. on unpickling
+        if attr in ('_module', '_name', '_value'):
+            raise AttributeError(attr)
+        return getattr(self.resolve(), attr)
+
+    def __repr__(self):
+        return f'LazyImport({self._module}.{self._name})'
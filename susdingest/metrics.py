@@ -0,0 +1,158 @@
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+
+def peak_rss():
+    # peak resident set size in bytes of this process or any of its finished worker processes, None if unknown
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes, except on macos
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) * scale
+
+
+def process_cpu():
+    # cpu seconds of this process and its finished worker processes
+    if resource is None:
+        return time.process_time()
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return time.process_time() + children.ru_utime + children.ru_stime
+
+
+class StageRecord:
+    # measurements of one stage, rows and bytes are counted by the code being measured
+
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+        self.rows = 0
+        self.bytes = 0
+        self.wall = None
+        self.cpu = None
+        self.peak_rss = None
+
+    def add(self, rows=0, nbytes=0):
+        self.rows += int(rows)
+        self.bytes += int(nbytes)
+        return self
+
+    def as_dict(self):
+        return {'stage': self.name, **self.labels, 'wall_seconds': self.wall, 'cpu_seconds': self.cpu,
+                'rows': self.rows, 'bytes': self.bytes, 'peak_rss_bytes': self.peak_rss}
+
+
+class Metrics:
+    # collects wall time, cpu time of the measuring thread, rows, bytes and the peak rss so far of named stages, from
+    # any thread. Work done in worker processes only shows up in the process totals of the report.
+
+    def __init__(self):
+        self.records = []
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.cpu_started = process_cpu()
+
+    def start(self, name, **labels):
+        record = StageRecord(name, {k: str(v) for k, v in labels.items() if v is not None})
+        record.wall, record.cpu = time.perf_counter(), time.thread_time()
+        return record
+
+    def finish(self, record):
+        record.wall = time.perf_counter() - record.wall
+        record.cpu = time.thread_time() - record.cpu
+        record.peak_rss = peak_rss()
+        with self.lock:
+            self.records.append(record)
+
+    @contextmanager
+    def stage(self, name, **labels):
+        record = self.start(name, **labels)
+        try:
+            yield record
+        finally:
+            self.finish(record)
+
+    def report(self, **extra):
+        with self.lock:
+            stages = [i.as_dict() for i in self.records]
+        return {'started': self.started, 'wall_seconds': time.time() - self.started,
+                'cpu_seconds': process_cpu() - self.cpu_started, 'peak_rss_bytes': peak_rss(), 'stages': stages,
+                **extra}
+
+    def write_json(self, path, **extra):
+        write_atomic(path, json.dumps(self.report(**extra), indent=2, default=str))
+        logger.info(f'wrote run report to {path}')
+
+    def write_prometheus(self, path):
+        # textfile collector format, totals per stage and labels
+        totals = {}
+        with self.lock:
+            for record in self.records:
+                key = (record.name, tuple(sorted(record.labels.items())))
+                total = totals.setdefault(key, {'wall_seconds': 0, 'cpu_seconds': 0, 'rows': 0, 'bytes': 0,
+                                                'peak_rss_bytes': 0})
+                total['wall_seconds'] += record.wall
+                total['cpu_seconds'] += record.cpu
+                total['rows'] += record.rows
+                total['bytes'] += record.bytes
+                total['peak_rss_bytes'] = max(total['peak_rss_bytes'], record.peak_rss or 0)
+        lines = []
+        for metric, kind in [('wall_seconds', 'counter'), ('cpu_seconds', 'counter'), ('rows', 'counter'),
+                             ('bytes', 'counter'), ('peak_rss_bytes', 'gauge')]:
+            lines.append(f'# TYPE susdingest_stage_{metric} {kind}')
+            for (name, labels), total in totals.items():
+                label_text = ','.join(f'{k}="{escape_label(v)}"' for k, v in (('stage', name),) + labels)
+                lines.append(f'susdingest_stage_{metric}{{{label_text}}} {total[metric]}')
+        lines.append('# TYPE susdingest_last_run_timestamp_seconds gauge')
+        lines.append(f'susdingest_last_run_timestamp_seconds {self.started}')
+        write_atomic(path, '\n'.join(lines) + '\n')
+        logger.info(f'wrote prometheus metrics to {path}')
+
+
+def escape_label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def write_atomic(path, text):
+    # readers such as the node exporter never see a partial file
+    tmp = f'{path}.tmp'
+    with open(tmp, 'w') as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+
+@contextmanager
+def measure(metrics, name, **labels):
+    # a stage of metrics, or an unrecorded one without metrics
+    if metrics is None:
+        yield StageRecord(name, labels)
+        return
+    with metrics.stage(name, **labels) as record:
+        yield record
+
+
+def measure_each(metrics, name, iterable, count=None, **labels):
+    # the items of iterable, recording the production of each as a stage with count(item) as (rows, bytes)
+    iterator = iter(iterable)
+    while True:
+        record = metrics.start(name, **labels) if metrics else None
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        if record:
+            record.add(*(count(item) if count else (0, 0)))
+            metrics.finish(record)
+        yield item
@@ -0,0 +1,106 @@
+import logging
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+# stages of the ingestion of a run, in order
+RUN_STAGES = ['downloaded', 'parsed', 'validated', 'staged', 'final']
+
+
+class MirrorManifest:
+    # persistent record of the s3 objects in the local mirror, with the etag, size and last modified time they were
+    # downloaded with, so that a sync only needs to compare the listing against it
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(str(self.path), check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS objects ('
+                'key TEXT PRIMARY KEY, etag TEXT, size INTEGER, last_modified TEXT, synced REAL)')
+            # objects evicted from the mirror by retention are kept with the time of eviction
+            columns = [i[1] for i in self.connection.execute('PRAGMA table_info(objects)')]
+            if 'evicted' not in columns:
+                self.connection.execute('ALTER TABLE objects ADD COLUMN evicted REAL')
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS runs ('
+                'agency TEXT, version TEXT, ingested REAL, PRIMARY KEY (agency, version))')
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS run_stages ('
+                'agency TEXT, version TEXT, stage TEXT, completed REAL, PRIMARY KEY (agency, version, stage))')
+
+    def entries(self):
+        # key: (etag, size) of all objects present in the mirror
+        with self.lock:
+            rows = self.connection.execute('SELECT key, etag, size FROM objects WHERE evicted IS NULL').fetchall()
+        return {key: (etag, size) for key, etag, size in rows}
+
+    def evicted(self):
+        # key: (etag, size) of the objects removed from the mirror by retention
+        with self.lock:
+            rows = self.connection.execute('SELECT key, etag, size FROM objects WHERE evicted IS NOT NULL').fetchall()
+        return {key: (etag, size) for key, etag, size in rows}
+
+    def record(self, key, etag, size, last_modified=None):
+        if last_modified is not None and not isinstance(last_modified, str):
+            last_modified = last_modified.isoformat()
+        with self.lock, self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO objects (key, etag, size, last_modified, synced) '
+                                    'VALUES (?, ?, ?, ?, ?)', (key, etag, size, last_modified, time.time()))
+
+    def evict(self, prefix):
+        # mark all objects under prefix as no longer present in the mirror
+        with self.lock, self.connection:
+            self.connection.execute("UPDATE objects SET evicted = ? WHERE substr(key, 1, ?) = ? AND evicted IS NULL",
+                                    (time.time(), len(prefix), prefix))
+
+    def record_ingested(self, agency, version):
+        with self.lock, self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO runs (agency, version, ingested) VALUES (?, ?, ?)',
+                                    (agency, version, time.time()))
+
+    def ingested(self):
+        # (agency, version): time of the last completed ingestion of the run
+        with self.lock:
+            rows = self.connection.execute('SELECT agency, version, ingested FROM runs').fetchall()
+        return {(agency, version): ingested for agency, version, ingested in rows}
+
+    def remove(self, key):
+        with self.lock, self.connection:
+            self.connection.execute('DELETE FROM objects WHERE key = ?', (key,))
+
+    def complete_stage(self, agency, version, stage):
+        if stage not in RUN_STAGES:
+            raise ValueError(f'unknown stage {stage}, expecting one of {RUN_STAGES}')
+        with self.lock, self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO run_stages (agency, version, stage, completed) '
+                                    'VALUES (?, ?, ?, ?)', (agency, version, stage, time.time()))
+        if stage == 'final':
+            self.record_ingested(agency, version)
+
+    def stages(self, agency, version):
+        # stage: completion time of the stages completed since the run last changed
+        with self.lock:
+            rows = self.connection.execute('SELECT stage, completed FROM run_stages WHERE agency = ? AND version = ?',
+                                           (agency, version)).fetchall()
+        return dict(rows)
+
+    def reset_stages(self, agency, version):
+        with self.lock, self.connection:
+            self.connection.execute('DELETE FROM run_stages WHERE agency = ? AND version = ?', (agency, version))
+
+    def unfinished(self):
+        # runs with progress recorded that have not reached the final stage
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT DISTINCT agency, version FROM run_stages EXCEPT "
+                "SELECT agency, version FROM run_stages WHERE stage = 'final'").fetchall()
+        return [tuple(i) for i in rows]
+
+    def close(self):
+        self.connection.close()
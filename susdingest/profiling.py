@@ -0,0 +1,127 @@
+import cProfile
+import logging
+import re
+import threading
+import tracemalloc
+from contextlib import contextmanager
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+MODES = ['cprofile', 'tracemalloc']
+# tables selects each table property as table_<kind> and the single pass flatten of all of them
+STAGES = ['s3_sync', 'load_json', 'tables', 'load_db', 'copy_from_staging']
+
+
+class Profiler:
+    # profiles chosen stages with cProfile and/or tracemalloc and writes a file per stage and run on close, e.g.
+    # agency_version_load_db.prof. Repeated calls of a stage for a run, such as for each streamed chunk, add up, and a
+    # stage nested in another profiled stage is profiled on its own. cProfile only profiles one thread at a time,
+    # stages of concurrent runs started while another run is profiled are not profiled.
+
+    def __init__(self, stages, directory='.', modes=('cprofile',)):
+        unknown = set(stages) - set(STAGES) - {'all'}
+        if unknown:
+            raise ValueError(f'unknown stages to profile {sorted(unknown)}, expecting some of {STAGES}')
+        unknown = set(modes) - set(MODES)
+        if unknown:
+            raise ValueError(f'unknown profiling modes {sorted(unknown)}, expecting some of {MODES}')
+        self.stages = set(stages)
+        self.directory = Path(directory)
+        self.modes = set(modes)
+        self.lock = threading.Lock()
+        # thread cProfile is active in, and its profiles of nested stages
+        self.owner = None
+        self.active = []
+        self.profiles = {}
+        # (traced bytes, snapshot) at the end of the call of each stage that held the most memory
+        self.snapshots = {}
+        self.tracing = 0
+        self.started_tracing = False
+
+    def wanted(self, stage):
+        return 'all' in self.stages or stage in self.stages or (
+            'tables' in self.stages and (stage == 'flatten' or stage.startswith('table_')))
+
+    @contextmanager
+    def stage(self, name, **labels):
+        if not self.wanted(name):
+            yield
+            return
+        key = tuple(str(v) for v in labels.values() if v is not None) + (name,)
+        profile = self.start_cprofile(key) if 'cprofile' in self.modes else None
+        tracing = 'tracemalloc' in self.modes and self.start_tracemalloc()
+        try:
+            yield
+        finally:
+            if tracing:
+                self.stop_tracemalloc(key)
+            if profile:
+                self.stop_cprofile(profile)
+
+    def start_cprofile(self, key):
+        with self.lock:
+            if self.owner not in (None, threading.get_ident()):
+                logger.debug(f'not profiling {key}, another thread is being profiled')
+                return None
+            profile = self.profiles.setdefault(key, cProfile.Profile())
+            if profile in self.active:
+                return None
+            self.owner = threading.get_ident()
+            if self.active:
+                self.active[-1].disable()
+            self.active.append(profile)
+            profile.enable()
+        return profile
+
+    def stop_cprofile(self, profile):
+        with self.lock:
+            profile.disable()
+            self.active.pop()
+            if self.active:
+                self.active[-1].enable()
+            else:
+                self.owner = None
+
+    def start_tracemalloc(self):
+        with self.lock:
+            if not self.tracing and not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self.started_tracing = True
+            self.tracing += 1
+        return True
+
+    def stop_tracemalloc(self, key):
+        snapshot = tracemalloc.take_snapshot()
+        size = sum(i.size for i in snapshot.statistics('filename'))
+        with self.lock:
+            if size >= self.snapshots.get(key, (0, None))[0]:
+                self.snapshots[key] = (size, snapshot)
+            self.tracing -= 1
+            if not self.tracing and self.started_tracing:
+                tracemalloc.stop()
+                self.started_tracing = False
+
+    def path(self, key, suffix):
+        return self.directory.joinpath(re.sub(r'[^\w.-]', '_', '_'.join(key)) + suffix)
+
+    def close(self):
+        # writes the profiles collected so far
+        self.directory.mkdir(parents=True, exist_ok=True)
+        with self.lock:
+            profiles, snapshots = dict(self.profiles), dict(self.snapshots)
+        for key, profile in profiles.items():
+            profile.dump_stats(self.path(key, '.prof'))
+        for key, (size, snapshot) in snapshots.items():
+            snapshot.dump(self.path(key, '.tracemalloc'))
+        logger.info(f'wrote {len(profiles)} profiles and {len(snapshots)} memory snapshots to {self.directory}')
+
+
+@contextmanager
+def profile(profiler, name, **labels):
+    # a stage of profiler, or nothing without profiler
+    if profiler is None:
+        yield
+        return
+    with profiler.stage(name, **labels):
+        yield
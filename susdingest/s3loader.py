@@ -1,26 +1,155 @@
 import boto3
+import hashlib
 import json
 import logging
+import os
+import shutil
+import threading
 import time
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, as_completed, wait
+from functools import lru_cache, partial
 from pathlib import Path, PosixPath
+from .metrics import measure
+from .mirrormanifest import MirrorManifest
 
 
 logger = logging.getLogger(__name__)
 
 
+PART_SUFFIX = '.part'
+THROTTLE_CODES = {'SlowDown', 'Throttling', 'ThrottlingException', 'RequestLimitExceeded', 'TooManyRequests', '503'}
+
+
 def ensure_trailing_slash(s):
     return s if s.endswith('/') else f'{s}/'
 
 
+def common_prefixes(client, bucket, prefix):
+    paginator = client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix, Delimiter='/'):
+        for i in page.get('CommonPrefixes', []):
+            yield i['Prefix']
+
+
+def is_throttle(error):
+    return isinstance(error, ClientError) and error.response.get('Error', {}).get('Code') in THROTTLE_CODES
+
+
+@lru_cache(maxsize=None)
+def s3_client(session_args=()):
+    # one client per process and credentials, clients are thread safe
+    return boto3.Session(**dict(session_args)).client('s3')
+
+
+class S3Source:
+    # a picklable reference to an object in s3, opened as a stream of its content so that exports can be read
+    # without a local mirror, also from worker processes
+
+    def __init__(self, bucket, key, size=None, etag=None, session_args=None):
+        self.bucket = bucket
+        self.key = key
+        self.size = size
+        self.etag = etag
+        self.session_args = tuple(sorted((session_args or {}).items()))
+
+    def __repr__(self):
+        return f's3://{self.bucket}/{self.key}'
+
+    def __eq__(self, other):
+        return isinstance(other, S3Source) and (self.bucket, self.key) == (other.bucket, other.key)
+
+    def __hash__(self):
+        return hash((self.bucket, self.key))
+
+    @property
+    def name(self):
+        return PosixPath(self.key).name
+
+    def open(self):
+        # the content as a binary stream, failing if the object changed since it was listed
+        conditions = {'IfMatch': self.etag} if self.etag else {}
+        return s3_client(self.session_args).get_object(Bucket=self.bucket, Key=self.key, **conditions)['Body']
+
+    @classmethod
+    def list(cls, bucket, prefix, session_args=None):
+        paginator = s3_client(tuple(sorted((session_args or {}).items()))).get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+            for i in page.get('Contents', []):
+                yield cls(bucket, i['Key'], size=i['Size'], etag=i['ETag'], session_args=session_args)
+
+
+class AdaptiveLimiter:
+    # limits concurrent transfers, halving the limit when s3 throttles and raising it by one again after a limit's
+    # worth of successful transfers (additive increase, multiplicative decrease)
+
+    def __init__(self, maximum, minimum=1):
+        self.maximum = maximum
+        self.minimum = minimum
+        self.limit = maximum
+        self.active = 0
+        self.successes = 0
+        self.condition = threading.Condition()
+
+    def __enter__(self):
+        with self.condition:
+            self.condition.wait_for(lambda: self.active < self.limit)
+            self.active += 1
+        return self
+
+    def __exit__(self, *exc):
+        with self.condition:
+            self.active -= 1
+            self.condition.notify_all()
+
+    def success(self):
+        with self.condition:
+            self.successes += 1
+            if self.successes >= self.limit and self.limit < self.maximum:
+                self.limit += 1
+                self.successes = 0
+                self.condition.notify_all()
+
+    def throttled(self):
+        with self.condition:
+            self.limit = max(self.minimum, self.limit // 2)
+            self.successes = 0
+        logger.warning(f'throttled by s3, reducing concurrent downloads to {self.limit}')
+
+
 class S3Loader:
 
     def __init__(self, bucket, source_prefix, dest_prefix, aws_id=None, aws_key=None, profile_name=None,
-                 credfile=None):
+                 credfile=None, manifest=None, max_concurrent=5, adaptive=False, part_size=None,
+                 multipart_threshold=None, part_concurrency=None, max_attempts=5, list_concurrency=None, agencies=None,
+                 min_version=None, max_version=None, verify_etag=False, metrics=None):
         self.bucket = bucket
         self.source_prefix = ensure_trailing_slash(source_prefix)
         self.dest_prefix = dest_prefix
-        self.max_concurrent = 5
+        self.max_concurrent = max_concurrent
+        # with adaptive set, concurrent downloads back off when throttled and botocore uses adaptive retries
+        self.adaptive = adaptive
+        self.max_attempts = max_attempts
+        self.limiter = None
+        # objects larger than multipart_threshold are fetched as parallel ranged requests of part_size bytes
+        transfer_options = {'multipart_threshold': multipart_threshold, 'multipart_chunksize': part_size,
+                            'max_concurrency': part_concurrency}
+        # check downloads against the md5 etag of single part uploads, besides their size
+        self.verify_etag = verify_etag
+        self.transfer_config = TransferConfig(**{k: v for k, v in transfer_options.items() if v})
+        # with any of these set, agency/ and agency/version/ prefixes are discovered first and each run is listed
+        # concurrently, limited to the given agencies and the inclusive range of versions
+        self.list_concurrency = list_concurrency
+        self.agencies = set(agencies) if agencies else None
+        self.min_version = min_version
+        self.max_version = max_version
+        # metrics the sync is recorded in, if given
+        self.metrics = metrics
+        # a MirrorManifest (or path to one) of the objects already mirrored, which are then compared by etag and size
+        # instead of checking that the mirror file exists
+        self.manifest = manifest
         self._creds = {}
         if aws_id or aws_key:
             if not aws_id or not aws_key:
@@ -38,35 +167,315 @@ class S3Loader:
             with open(credfile) as f:
                 self._creds = json.load(f)
 
-    def _download_object(self, s3object, dest_file):
+    def _download_range(self, s3object, part_file, start, end, etag, marker):
+        conditions = {'IfMatch': etag} if isinstance(etag, str) else {}
+        body = s3object.get(Range=f'bytes={start}-{end}', **conditions)['Body']
+        with open(part_file, 'r+b') as f:
+            f.seek(start)
+            for chunk in body.iter_chunks(1 << 20):
+                f.write(chunk)
+            if f.tell() != end + 1:
+                raise IOError(f'short read of bytes {start}-{end} of {s3object.key}')
+        marker.touch()
+
+    def _download_parts(self, s3object, part_file, size, etag):
+        # ranged requests written in place into part_file, with a marker per completed part in a .parts directory so
+        # that an interrupted download resumes from the parts still missing. Requests are conditional on the etag.
+        parts_dir = part_file.with_name(part_file.name + 's')
+        etag_file = parts_dir.joinpath('etag')
+        if parts_dir.exists() and not (etag_file.exists() and etag_file.read_text() == str(etag)):
+            shutil.rmtree(parts_dir)
+        if not parts_dir.exists() or not part_file.exists() or part_file.stat().st_size != size:
+            parts_dir.mkdir(parents=True, exist_ok=True)
+            etag_file.write_text(str(etag))
+            for marker in parts_dir.glob('[0-9]*'):
+                marker.unlink()
+            with open(part_file, 'wb') as f:
+                f.truncate(size)
+        part_size = self.transfer_config.multipart_chunksize
+        ranges = [(i, min(i + part_size, size) - 1) for i in range(0, size, part_size)]
+        missing = [(n, r) for n, r in enumerate(ranges) if not parts_dir.joinpath(f'{n:05d}').exists()]
+        if len(missing) < len(ranges):
+            logger.info(f'resuming download of {s3object.key}, {len(ranges) - len(missing)} of {len(ranges)} parts '
+                        'already complete')
+        with ThreadPoolExecutor(max_workers=self.transfer_config.max_request_concurrency) as executor:
+            futures = [executor.submit(self._download_range, s3object, part_file, start, end, etag,
+                                       parts_dir.joinpath(f'{n:05d}'))
+                       for n, (start, end) in missing]
+            done, pending = wait(futures, return_when=FIRST_EXCEPTION)
+            for future in pending:
+                future.cancel()
+            for future in done:
+                future.result()
+        shutil.rmtree(parts_dir)
+
+    def _transfer(self, s3object, part_file, size, etag):
+        if isinstance(size, int) and size > self.transfer_config.multipart_threshold:
+            self._download_parts(s3object, part_file, size, etag)
+        else:
+            s3object.download_file(str(part_file), Config=self.transfer_config)
+
+    def verify(self, s3object, part_file, size, etag):
+        if isinstance(size, int) and part_file.stat().st_size != size:
+            raise IOError(f'downloaded {part_file.stat().st_size} bytes of {s3object.key}, expected {size}')
+        # etags of multipart uploads are not a digest of the content, and neither are those of SSE-KMS objects
+        if self.verify_etag and isinstance(etag, str) and '-' not in etag:
+            digest = hashlib.md5()
+            with open(part_file, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    digest.update(chunk)
+            if digest.hexdigest() != etag.strip('"'):
+                part_file.unlink()
+                raise IOError(f'md5 of {s3object.key} does not match its etag {etag}')
+
+    def _download_object(self, s3object, dest_file, size=None, etag=None):
+        # objects are downloaded to a .part file next to dest_file that is only moved into place once verified
         logger.info(f'Downloading object {s3object.key} to {dest_file}')
-        s3object.download_file(str(dest_file))
+        part_file = dest_file.with_name(dest_file.name + PART_SUFFIX)
+        start = time.time()
+        for attempt in range(self.max_attempts):
+            try:
+                if self.limiter:
+                    with self.limiter:
+                        self._transfer(s3object, part_file, size, etag)
+                    self.limiter.success()
+                else:
+                    self._transfer(s3object, part_file, size, etag)
+                break
+            except ClientError as e:
+                if not (self.limiter and is_throttle(e)) or attempt == self.max_attempts - 1:
+                    raise
+                self.limiter.throttled()
+                time.sleep(0.5 * 2 ** attempt)
+        self.verify(s3object, part_file, size, etag)
+        part_file.replace(dest_file)
+        elapsed = time.time() - start
+        if isinstance(size, int):
+            logger.debug(f'Downloaded {s3object.key} ({size / 1e6:0.1f} MB) in {elapsed:0.2f}s, '
+                         f'{size / 1e6 / max(elapsed, 1e-6):0.1f} MB/s')
+
+    def session_config(self):
+        return Config(retries={'mode': 'adaptive' if self.adaptive else 'standard', 'max_attempts': self.max_attempts},
+                      max_pool_connections=max(10, self.max_concurrent * (self.transfer_config.max_request_concurrency
+                                                                          or 1)))
+
+    def open_manifest(self):
+        if isinstance(self.manifest, (str, os.PathLike)):
+            logger.debug(f'using mirror manifest {self.manifest}')
+            self.manifest = MirrorManifest(self.manifest)
+        return self.manifest
+
+    def is_mirrored(self, s3_object, dest_file, known):
+        if known is None:
+            return dest_file.exists()
+        if s3_object.key in known:
+            return known[s3_object.key] == (s3_object.e_tag, s3_object.size)
+        # files mirrored before the manifest existed are adopted if complete
+        if dest_file.exists() and dest_file.stat().st_size == s3_object.size:
+            self.manifest.record(s3_object.key, s3_object.e_tag, s3_object.size, s3_object.last_modified)
+            return True
+        return False
+
+    def is_filtered(self):
+        return bool(self.agencies or self.min_version or self.max_version)
+
+    def wanted_version(self, version):
+        return (not self.min_version or version >= self.min_version) and \
+               (not self.max_version or version <= self.max_version)
+
+    def run_prefixes(self, bucket, executor):
+        client = bucket.meta.client
+        agencies = [i for i in common_prefixes(client, self.bucket, self.source_prefix)
+                    if not self.agencies or PosixPath(i).name in self.agencies]
+        runs = []
+        for versions in executor.map(lambda i: list(common_prefixes(client, self.bucket, i)), agencies):
+            runs.extend(i for i in versions if self.wanted_version(PosixPath(i).name))
+        return agencies, runs
+
+    def list_objects(self, bucket):
+        # all objects under the source prefix, with each run's objects listed together
+        if not (self.list_concurrency or self.is_filtered()):
+            yield from bucket.objects.filter(Prefix=self.source_prefix).all()
+            return
+        with ThreadPoolExecutor(max_workers=self.list_concurrency or self.max_concurrent) as executor:
+            start = time.time()
+            agencies, runs = self.run_prefixes(bucket, executor)
+            logger.info(f'found {len(runs)} runs to list in {time.time() - start:0.2f}s')
+            if not self.is_filtered():
+                # objects outside of any run, e.g. directly under an agency
+                for prefix in [self.source_prefix] + agencies:
+                    yield from bucket.objects.filter(Prefix=prefix, Delimiter='/').all()
+            listings = [executor.submit(lambda i: list(bucket.objects.filter(Prefix=i).all()), i) for i in runs]
+            try:
+                for listing in as_completed(listings):
+                    yield from listing.result()
+            finally:
+                for listing in listings:
+                    listing.cancel()
+
+    def is_evicted(self, s3_object, run, evicted):
+        # evicted by retention and unchanged since, unless the run is to be reloaded
+        return evicted.get(s3_object.key) == (s3_object.e_tag, s3_object.size) and \
+            not (run and Path(self.dest_prefix, *run, '.force_reload').exists())
 
-    def load_s3(self, overwrite=False):
+    def record_ingested(self, agency, version):
+        if self.open_manifest():
+            self.manifest.record_ingested(agency, version)
+
+    def run_stages(self, agency, version):
+        # stages of the run completed so far, none without a manifest
+        return self.open_manifest().stages(agency, version) if self.open_manifest() else {}
+
+    def record_stage(self, agency, version, stage):
+        if self.open_manifest():
+            self.manifest.complete_stage(agency, version, stage)
+
+    def reset_run(self, agency, version):
+        if self.open_manifest():
+            self.manifest.reset_stages(agency, version)
+
+    def unfinished_runs(self):
+        return self.open_manifest().unfinished() if self.open_manifest() else []
+
+    def mirrored_runs(self):
+        # (agency, version): bytes used by the run in the mirror
+        runs = {}
+        for run_dir in Path(self.dest_prefix).glob('*/*'):
+            if run_dir.is_dir():
+                runs[run_dir.parts[-2:]] = sum(i.stat().st_size for i in run_dir.rglob('*') if i.is_file())
+        return runs
+
+    def evict_run(self, run):
+        # marked in the manifest first, so that an interrupted eviction leaves files that are pruned again rather than
+        # a manifest claiming files that are gone
+        logger.info(f'evicting {run} from the mirror')
+        self.manifest.evict(f'{self.source_prefix}{run[0]}/{run[1]}/')
+        shutil.rmtree(Path(self.dest_prefix, *run))
+
+    def prune_mirror(self, max_bytes=None, keep_versions=None, in_flight=()):
+        # evict runs from the mirror until at most keep_versions versions of each agency remain and it fits in
+        # max_bytes, least recently ingested first. Only runs that completed ingestion are evicted, never those in
+        # flight or with a pending .force_reload.
+        if not self.open_manifest():
+            logger.warning('mirror retention needs a manifest, not pruning')
+            return []
+        runs = self.mirrored_runs()
+        ingested = self.manifest.ingested()
+        protected = set(in_flight) | {i for i in runs if Path(self.dest_prefix, *i, '.force_reload').exists()}
+        candidates = [run for _, run in sorted((ingested[i], i) for i in runs if i in ingested and i not in protected)]
+        evict = []
+        if keep_versions is not None:
+            for agency in {i[0] for i in runs}:
+                versions = sorted(i for i in runs if i[0] == agency)
+                old = versions[:max(0, len(versions) - keep_versions)]
+                evict.extend(i for i in candidates if i in old)
+        size = sum(runs.values()) - sum(runs[i] for i in evict)
+        for run in candidates:
+            if max_bytes is None or size <= max_bytes:
+                break
+            if run not in evict:
+                evict.append(run)
+                size -= runs[run]
+        for run in evict:
+            self.evict_run(run)
+        if max_bytes is not None and size > max_bytes:
+            logger.warning(f'mirror uses {size / 1e9:0.2f} GB after pruning, more than the {max_bytes / 1e9:0.2f} GB '
+                           'allowed, the remaining runs are in flight or not ingested yet')
+        logger.info(f'evicted {len(evict)} runs, mirror uses {size / 1e9:0.2f} GB')
+        return evict
+
+    def _skip_download(self, s3object, dest_file, size=None, etag=None):
+        logger.debug(f'recording object {s3object.key} without downloading it')
+
+    def load_s3(self, overwrite=False, on_run_complete=None, download=True):
+        # on_run_complete, if given, is called from a download thread with (agency, version) as soon as every object of
+        # that run is mirrored. s3 lists keys in order, so a run's listing is complete once the next run's keys start.
+        # without download, changed objects are only recorded in the manifest and their runs reported, for runs that
+        # are read straight from s3
+        with measure(self.metrics, 's3_sync', bucket=self.bucket, prefix=self.source_prefix) as record:
+            return self._load_s3(record, overwrite, on_run_complete, download)
+
+    def _load_s3(self, record, overwrite, on_run_complete, download):
         sess = boto3.Session(**self._creds)
-        s3 = sess.resource('s3')
+        s3 = sess.resource('s3', config=self.session_config())
         bucket = s3.Bucket(self.bucket)
         obj_count, dl_count, skip_count, timing = 0, 0, 0, time.time()
+        dl_bytes = 0
+        self.limiter = AdaptiveLimiter(self.max_concurrent) if self.adaptive else None
         updated = set()
+        known = self.open_manifest().entries() if self.manifest else None
+        evicted = self.manifest.evicted() if self.manifest else {}
+        run_lock = threading.Lock()
+        run_pending, runs_listed = {}, set()
+
+        def complete(run):
+            # called with run_lock held, so on_run_complete should only hand the run off
+            runs_listed.add(run)
+            if run_pending.get(run) == 0 and run in updated:
+                run_pending.pop(run)
+                # changed data is ingested from the start
+                if self.manifest:
+                    self.manifest.reset_stages(*run)
+                    self.manifest.complete_stage(*run, 'downloaded')
+                if on_run_complete:
+                    logger.info(f'completed download of {run}')
+                    on_run_complete(*run)
+
+        def downloaded(s3_object, run, future):
+            if future.cancelled() or future.exception() is not None:
+                failed.set()
+                return
+            if self.manifest:
+                self.manifest.record(s3_object.key, s3_object.e_tag, s3_object.size, s3_object.last_modified)
+            with run_lock:
+                if run:
+                    run_pending[run] -= 1
+                    if run in runs_listed:
+                        complete(run)
+
         logger.info(f'listing and fetching objects from s3://{self.bucket}/{self.source_prefix} to {self.dest_prefix}')
         with ThreadPoolExecutor(max_workers=self.max_concurrent) as executor:
-            dlfutures = []
+            dlfutures = {}
+            # stop listing as soon as a download fails
+            failed = threading.Event()
+            objects = self.list_objects(bucket)
             try:
-                for s3_object in bucket.objects.filter(Prefix=self.source_prefix).all():
+                listing = None
+                for s3_object in objects:
+                    if failed.is_set():
+                        break
                     s3_file = PosixPath(s3_object.key)
                     s3_stem = s3_file.relative_to(self.source_prefix)
                     dest_file = Path(self.dest_prefix, s3_stem)
-                    if dest_file.exists() and not overwrite:
+                    run = s3_stem.parts[:2] if len(s3_stem.parts) > 2 else None
+                    if run != listing:
+                        with run_lock:
+                            if listing:
+                                complete(listing)
+                        listing = run
+                    if not overwrite and (self.is_mirrored(s3_object, dest_file, known) or
+                                          evicted and self.is_evicted(s3_object, run, evicted)):
                         skip_count += 1
                         continue
-                    if len(s3_stem.parts) > 2:
-                        updated.add(s3_stem.parts[:2])
-                    dest_file.parent.mkdir(parents=True, exist_ok=True)
-                    dlfutures.append(executor.submit(self._download_object, s3_object.Object(), dest_file))
+                    if download:
+                        dest_file.parent.mkdir(parents=True, exist_ok=True)
+                    if run:
+                        with run_lock:
+                            updated.add(run)
+                            run_pending[run] = run_pending.get(run, 0) + 1
+                    dlfuture = executor.submit(self._download_object if download else self._skip_download,
+                                               s3_object.Object(), dest_file, s3_object.size, s3_object.e_tag)
+                    dlfuture.add_done_callback(partial(downloaded, s3_object, run))
+                    dlfutures[dlfuture] = s3_object
                     obj_count += 1
+                if listing and not failed.is_set():
+                    with run_lock:
+                        complete(listing)
                 for dlfuture in as_completed(dlfutures):
                     dlfuture.result()
                     dl_count += 1
+                    s3_object = dlfutures[dlfuture]
+                    dl_bytes += s3_object.size if download and isinstance(s3_object.size, int) else 0
             except KeyboardInterrupt:
                 logger.warning('canceling downloads!')
             except Exception as e:
@@ -76,7 +485,11 @@ class S3Loader:
                 executor.shutdown(wait=False)
                 for future in dlfutures:
                     future.cancel()
+                objects.close()
 
         timing = time.time() - timing
         logger.info(f'total objects: {obj_count} downloaded: {dl_count}, files skipped: {skip_count} in {timing:0.2f}s')
+        if dl_bytes:
+            logger.info(f'downloaded {dl_bytes / 1e6:0.1f} MB at {dl_bytes / 1e6 / max(timing, 1e-6):0.1f} MB/s')
+        record.add(dl_count, dl_bytes)
         return updated
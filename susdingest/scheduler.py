@@ -0,0 +1,69 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+
+class RunScheduler:
+    # runs several ingestion runs at once, each in a thread of its own, with the stages of all runs limited
+    # separately, e.g. parsing by cpu and loading by database connections. A failed run does not affect the others.
+    # Time spent in and waiting for each stage is recorded per run.
+
+    def __init__(self, max_runs=1, limits=None):
+        self.max_runs = max_runs
+        self.limits = {name: threading.BoundedSemaphore(n) for name, n in (limits or {}).items() if n}
+        self.executor = ThreadPoolExecutor(max_workers=max_runs)
+        self.lock = threading.Lock()
+        self.futures = {}
+        self.timings = {}
+
+    def record(self, run, name, elapsed):
+        with self.lock:
+            timings = self.timings.setdefault(run, {})
+            timings[name] = timings.get(name, 0) + elapsed
+
+    @contextmanager
+    def stage(self, run, name, limit=None):
+        # limit names the limit the stage counts against, by default its own
+        semaphore = self.limits.get(limit or name)
+        start = time.time()
+        if semaphore:
+            semaphore.acquire()
+        started = time.time()
+        try:
+            yield
+        finally:
+            if semaphore:
+                semaphore.release()
+            self.record(run, 'waiting', started - start)
+            self.record(run, name, time.time() - started)
+
+    def _run(self, run, func, *args):
+        start = time.time()
+        try:
+            return func(*args)
+        except Exception as e:
+            logger.error(f'run {run} failed: {e}')
+            return False
+        finally:
+            self.record(run, 'total', time.time() - start)
+
+    def submit(self, run, func, *args):
+        # func returns whether the run succeeded
+        self.futures[run] = self.executor.submit(self._run, run, func, *args)
+        return self.futures[run]
+
+    def wait(self):
+        # run: result of all submitted runs
+        results = {run: future.result() for run, future in self.futures.items()}
+        self.executor.shutdown()
+        return results
+
+    def log_summary(self, results):
+        for run, result in results.items():
+            timings = self.timings.get(run, {})
+            stages = ', '.join(f'{name} {elapsed:0.1f}s' for name, elapsed in timings.items() if name != 'total')
+            logger.info(f'{"completed" if result else "failed"} {run} in {timings.get("total", 0):0.1f}s ({stages})')
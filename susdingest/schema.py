@@ -0,0 +1,116 @@
+import logging
+import sqlalchemy as sqla
+
+logger = logging.getLogger(__name__)
+
+# declared columns of the staging tables as (name, pandas dtype, sql type), in table order. Low cardinality text is
+# held as categorical, and string widths are generous compared to the final data model so that staging never
+# truncates, while free text is unbounded.
+STRING = 'string'
+CATEGORY = 'category'
+INT = 'Int64'
+SMALLINT = 'Int32'
+FLOAT = 'Float64'
+BOOL = 'boolean'
+
+EID = ('eid', STRING, sqla.Unicode(64))
+
+SCHEMA = {
+    'publications': [
+        ('doi', STRING, sqla.Unicode(256)),
+        ('publication_title', STRING, sqla.UnicodeText()),
+        ('publication_type', CATEGORY, sqla.Unicode(64)),
+        ('publication_year', SMALLINT, sqla.Integer()),
+        ('publication_month', SMALLINT, sqla.Integer()),
+        ('citation_count', SMALLINT, sqla.Integer()),
+        ('field_weighted_citation_impact', FLOAT, sqla.Float()),
+        ('journal_publishername', CATEGORY, sqla.Unicode(512)),
+        ('journal_title', STRING, sqla.Unicode(2048)),
+        ('journal_scopus_source_id', INT, sqla.BigInteger()),
+        ('journal_issn_isbn', STRING, sqla.Unicode(512)),
+        ('tested_expressions', STRING, sqla.UnicodeText()),
+        ('journal_citescore_year', SMALLINT, sqla.Integer()),
+        ('journal_citescore_value', FLOAT, sqla.Float()),
+    ],
+    'dyads': [
+        ('alias', STRING, sqla.Unicode(1024)),
+        ('snippet', STRING, sqla.UnicodeText()),
+        ('alias_id', INT, sqla.BigInteger()),
+        ('is_fuzzy', BOOL, sqla.Boolean()),
+        ('fuzzy_score', FLOAT, sqla.Float()),
+        ('model', CATEGORY, sqla.Unicode(64)),
+        ('score', FLOAT, sqla.Float()),
+    ],
+    'authors': [
+        ('given_name', STRING, sqla.Unicode(512)),
+        ('family_name', STRING, sqla.Unicode(512)),
+        ('pn_given_name', STRING, sqla.Unicode(512)),
+        ('pn_family_name', STRING, sqla.Unicode(512)),
+        ('author_id', INT, sqla.BigInteger()),
+        ('author_position', SMALLINT, sqla.Integer()),
+        ('affiliation_sequences', STRING, sqla.UnicodeText()),
+    ],
+    'affiliations': [
+        ('affiliation_sequence', SMALLINT, sqla.Integer()),
+        ('affiliation_normalized', STRING, sqla.UnicodeText()),
+        ('affiliation_organization', STRING, sqla.UnicodeText()),
+        ('affiliation_address_part', STRING, sqla.Unicode(2048)),
+        ('affiliation_postal_code', STRING, sqla.Unicode(128)),
+        ('affiliation_city', STRING, sqla.Unicode(512)),
+        ('affiliation_state', STRING, sqla.Unicode(512)),
+        ('country_code', CATEGORY, sqla.Unicode(16)),
+        ('affiliation_ids', STRING, sqla.UnicodeText()),
+        ('affiliation_id', INT, sqla.BigInteger()),
+    ],
+    'topics': [
+        ('topic_id', INT, sqla.BigInteger()),
+        ('keywords', STRING, sqla.UnicodeText()),
+        ('prominence', FLOAT, sqla.Float()),
+    ],
+    'topicclusters': [
+        ('topic_cluster_id', INT, sqla.BigInteger()),
+        ('keywords', STRING, sqla.UnicodeText()),
+        ('prominence', FLOAT, sqla.Float()),
+    ],
+    'asjcs': [
+        ('asjc', CATEGORY, sqla.Unicode(16)),
+        ('label', CATEGORY, sqla.Unicode(512)),
+    ],
+    'ufcs': [
+        ('concept_id', INT, sqla.BigInteger()),
+        ('concept_name', STRING, sqla.Unicode(1024)),
+        ('rank', FLOAT, sqla.Float()),
+        ('a_freq', SMALLINT, sqla.Integer()),
+    ],
+    'datasets': [
+        ('alias', STRING, sqla.Unicode(1024)),
+        ('alias_id', INT, sqla.BigInteger()),
+        ('parent_alias_id', INT, sqla.BigInteger()),
+        ('alias_type', CATEGORY, sqla.Unicode(64)),
+    ],
+}
+
+
+def columns(kind):
+    return [name for name, _, _ in SCHEMA[kind]]
+
+
+def dtypes(kind):
+    return {name: dtype for name, dtype, _ in SCHEMA[kind]}
+
+
+def sql_types(kind):
+    # sql types of the table as written with its eid index, for to_sql
+    types = {name: sql_type for name, _, sql_type in SCHEMA[kind]}
+    if kind != 'datasets':
+        types[EID[0]] = EID[2]
+    return types
+
+
+def apply_schema(kind, frame):
+    # the frame with exactly the declared columns of kind, in order and of the declared types. Missing columns are
+    # added empty, undeclared ones are dropped.
+    undeclared = [i for i in frame.columns if i not in dtypes(kind)]
+    if undeclared:
+        logger.warning(f'dropping undeclared columns {undeclared} from {kind}')
+    return frame.reindex(columns=columns(kind)).astype(dtypes(kind))
@@ -0,0 +1,118 @@
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+
+def file_digest(path, block_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def code_version():
+    # cached tables are only valid for the code that produced them
+    digest = hashlib.sha256()
+    for module in ['flattener.py', 'jsonloader.py']:
+        digest.update(Path(__file__).with_name(module).read_bytes())
+    return digest.hexdigest()[:16]
+
+
+class ShardCache:
+    # local cache of the flattened tables of publication shards, stored as one parquet file per table and keyed by
+    # the shard content and loader code version. Least recently used entries are evicted beyond max_bytes.
+
+    index_column = '__eid__'
+
+    def __init__(self, path, max_bytes=None):
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            raise ImportError('the shard cache requires pyarrow, install with susdingest[cache]')
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.version = code_version()
+        self._keys = {}
+
+    def key(self, shard):
+        # shards read from s3 are identified by their location and etag instead of reading their content
+        if not isinstance(shard, (str, os.PathLike)):
+            return f'{hashlib.sha256(f"{shard!r}:{shard.etag}".encode()).hexdigest()}-{self.version}'
+        # content hashes are remembered per file size and modification time to avoid rereading unchanged shards
+        stat = os.stat(shard)
+        ident = (str(shard), stat.st_size, stat.st_mtime_ns)
+        if ident not in self._keys:
+            self._keys[ident] = f'{file_digest(shard)}-{self.version}'
+        return self._keys[ident]
+
+    def entry(self, shard):
+        return self.path.joinpath(self.key(shard))
+
+    def __contains__(self, shard):
+        return self.entry(shard).is_dir()
+
+    def get(self, shard):
+        import pyarrow.parquet as pq
+        entry = self.entry(shard)
+        if not entry.is_dir():
+            return None
+        batch = {}
+        for table_file in entry.glob('*.parquet'):
+            columns = pq.read_table(table_file).to_pydict()
+            batch[table_file.stem] = (columns.pop(self.index_column), columns)
+        os.utime(entry)
+        logger.debug(f'read cached tables for {shard} from {entry}')
+        return batch
+
+    def put(self, shard, batch, keep=()):
+        # entries of the shards in keep are not evicted to make room for the batch
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        entry = self.entry(shard)
+        tmpdir = Path(tempfile.mkdtemp(dir=self.path, prefix='.tmp-'))
+        try:
+            for kind, (index, columns) in batch.items():
+                # records parsed by pandas mark missing values as NaN, stored as nulls
+                table = pa.table({self.index_column: pa.array(index, from_pandas=True),
+                                  **{k: pa.array(v, from_pandas=True) for k, v in columns.items()}})
+                pq.write_table(table, tmpdir.joinpath(f'{kind}.parquet'))
+            os.replace(tmpdir, entry)
+        except (pa.ArrowException, OSError) as e:
+            logger.warning(f'could not cache tables for {shard}: {e}')
+            shutil.rmtree(tmpdir, ignore_errors=True)
+            return
+        logger.debug(f'cached tables for {shard} in {entry}')
+        self.evict(keep)
+
+    def entries(self):
+        entries = []
+        for entry in self.path.iterdir():
+            if entry.is_dir() and not entry.name.startswith('.'):
+                size = sum(i.stat().st_size for i in entry.iterdir())
+                entries.append((entry.stat().st_mtime, size, entry))
+        return sorted(entries)
+
+    def size(self):
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self, keep=()):
+        if self.max_bytes is None:
+            return
+        kept = {self.entry(i) for i in keep}
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in entries:
+            if total <= self.max_bytes:
+                break
+            if entry in kept:
+                continue
+            logger.info(f'evicting cached tables {entry.name} from shard cache')
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
@@ -11,6 +11,7 @@ delete from {SCHEMA}.author_affiliation WHERE run_id={RUN_ID}
 delete from {SCHEMA}.publication_asjc WHERE run_id={RUN_ID}
 delete from {SCHEMA}.publication_author WHERE run_id={RUN_ID}
 delete from {SCHEMA}.publication_affiliation WHERE run_id={RUN_ID}
+delete from {SCHEMA}.publication_ufc WHERE run_id={RUN_ID}
 delete from {SCHEMA}.publication WHERE run_id={RUN_ID}
 delete from {SCHEMA}.journal WHERE run_id={RUN_ID}
 delete from {SCHEMA}.publisher WHERE run_id={RUN_ID}
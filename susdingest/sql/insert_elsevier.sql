@@ -1,14 +1,23 @@
+-- each step starts with a step marker, followed by the steps it depends on, all steps before it if not given. Steps
+-- restricted to an eid range are run once per batch of publications when copying in batches, the others once with the
+-- first batch
+-- step: dataset_alias
+-- depends:
 INSERT INTO {SCHEMA}.dataset_alias (run_id, alias_id,
   parent_alias_id,alias,alias_type)
 SELECT {RUN_ID},alias_id,parent_alias_id,alias,alias_type
   FROM {ELSEVIER_SCHEMA}.{ELSEVIER_PREFIX}datasets
 ;
 
+-- step: publisher
+-- depends:
 INSERT INTO {SCHEMA}.publisher (run_id,external_id, name)
 SELECT DISTINCT {RUN_ID},NULL, journal_publishername
 FROM {ELSEVIER_SCHEMA}.{ELSEVIER_PREFIX}publications
 ;
 
+-- step: journal
+-- depends: publisher
 INSERT INTO {SCHEMA}.journal(run_id,publisher_id,title,external_id,cite_score)
 SELECT DISTINCT {RUN_ID},p.id as publisher_id, journal_title
 ,     journal_scopus_source_id, journal_citescore_value
@@ -18,6 +27,8 @@ SELECT DISTINCT {RUN_ID},p.id as publisher_id, journal_title
    and p.run_id={RUN_ID}
 ;
 
+-- step: issn
+-- depends: journal
 INSERT INTO {SCHEMA}.issn (run_id,journal_id, issn)
 SELECT DISTINCT {RUN_ID},j.id, f.value as issn
 FROM {ELSEVIER_SCHEMA}.{ELSEVIER_PREFIX}publications epm
@@ -29,6 +40,8 @@ CROSS APPLY string_split(epm.journal_issn_isbn, '|') as f
 WHERE f.value IS NOT NULL and rtrim(f.value) != ''
 ;
 
+-- step: publication
+-- depends: journal
 with journal_publisher as (
 select distinct j.*,p.name as publisher
   from {SCHEMA}.journal j
@@ -45,8 +58,11 @@ INSERT INTO {SCHEMA}.publication (run_id,journal_id, external_id, title, doi,
     on epm.journal_title=jp.title
    and epm.journal_scopus_source_id=jp.external_id
    and (epm.journal_publishername=jp.publisher or (epm.journal_publishername is null and jp.publisher is null))
+  WHERE {EID_RANGE:epm.eid}
 
 
+-- step: dyad
+-- depends: publication, dataset_alias
 INSERT INTO {SCHEMA}.dyad (
   run_id, publication_id, dataset_alias_id, alias_id, fuzzy_score, is_fuzzy,mention_candidate, snippet)
 SELECT DISTINCT {RUN_ID} as run_id, p.id as publication_id,da.id,pda.alias_id as alias_id
@@ -56,7 +72,10 @@ SELECT DISTINCT {RUN_ID} as run_id, p.id as publication_id,da.id,pda.alias_id as
     FROM {ELSEVIER_SCHEMA}.{ELSEVIER_PREFIX}dyads pda
     INNER JOIN {SCHEMA}.publication p ON p.external_id = pda.eid and p.run_id={RUN_ID}
     LEFT OUTER JOIN {SCHEMA}.dataset_alias da ON da.alias_id = pda.alias_id and da.run_id={RUN_ID}
+    WHERE {EID_RANGE:pda.eid}
 
+-- step: dyad_model
+-- depends: dyad
 INSERT INTO {SCHEMA}.dyad_model ( run_id, dyad_id, model_id, score)
 SELECT distinct {RUN_ID} as run_id,pda.id ,m.id,d.score
     FROM {ELSEVIER_SCHEMA}.{ELSEVIER_PREFIX}dyads d
@@ -69,39 +88,54 @@ SELECT distinct {RUN_ID} as run_id,pda.id ,m.id,d.score
        and pda.mention_candidate=d.alias
        and isnull(pda.snippet,'')=isnull(d.snippet,'')
     INNER JOIN {SCHEMA}.model m on m.name=d.model
+    WHERE {EID_RANGE:d.eid}
 ;
 
+-- step: topic
+-- depends:
 INSERT INTO {SCHEMA}.topic(run_id,keywords, external_topic_id,prominence)
 SELECT DISTINCT {RUN_ID}, etk.keywords,etk.Topic_Id,prominence
 from {ELSEVIER_SCHEMA}.{ELSEVIER_PREFIX}topics etk
 ;
 
+-- step: publication_topic
+-- depends: publication, topic
 INSERT INTO {SCHEMA}.publication_topic(run_id, publication_id, topic_id, score)
 SELECT DISTINCT {RUN_ID},p.id, t.id , NULL as score
 from {SCHEMA}.publication p
 inner join {ELSEVIER_SCHEMA}.{ELSEVIER_PREFIX}topics et on et.eid=p.external_id
 inner join {SCHEMA}.topic t on t.external_topic_id = et.topic_id and t.run_id={RUN_ID}
-where p.run_id={RUN_ID}
+where p.run_id={RUN_ID} and {EID_RANGE:et.eid}
 ;
 
+-- step: publication_ufc
+-- depends: publication
 insert into {SCHEMA}.publication_ufc(run_id,publication_id,concept_id,concept_name,rank,a_freq)
 select distinct {RUN_ID}, p.id, u.concept_id, u.concept_name, u.rank, u.a_freq
   from {ELSEVIER_SCHEMA}.{ELSEVIER_PREFIX}ufcs u
   join {SCHEMA}.publication p
     on p.run_id={RUN_ID} and p.external_id=u.eid
+ where {EID_RANGE:u.eid}
 ;
 
+-- step: asjc
+-- depends:
 INSERT INTO {SCHEMA}.asjc (run_id,code,label)
 SELECT DISTINCT {RUN_ID},ASJC,Label
   FROM {ELSEVIER_SCHEMA}.{ELSEVIER_PREFIX}asjcs a
 
+-- step: publication_asjc
+-- depends: publication, asjc
 INSERT INTO {SCHEMA}.publication_asjc(run_id,publication_id,asjc_id)
 SELECT {RUN_ID}, p.id, a.id
 FROM {ELSEVIER_SCHEMA}.{ELSEVIER_PREFIX}asjcs epm
 INNER JOIN {SCHEMA}.publication p ON p.external_id = epm.EID and p.run_id={RUN_ID}
 join {SCHEMA}.asjc a on cast(a.code as varchar(20))=epm.asjc and a.run_id={RUN_ID}
+WHERE {EID_RANGE:epm.eid}
 ;
 
+-- step: author
+-- depends:
 WITH epa as (
 SELECT author_id, pn_given_name, pn_family_name
 ,      row_number() over (partition by author_id order by len(pn_given_name+pn_family_name) desc) as rank
@@ -113,6 +147,8 @@ SELECT DISTINCT {RUN_ID},cast(author_id as varchar(128)) as external_id, pn_give
 FROM epa
 WHERE rank=1
 
+-- step: publication_author
+-- depends: publication, author
 INSERT INTO {SCHEMA}.publication_author (run_id,publication_id, author_id,given_name,family_name,author_position)
 SELECT DISTINCT {RUN_ID}, p.id, a.id,epa.given_name,epa.family_name,epa.author_position
 FROM {ELSEVIER_SCHEMA}.{ELSEVIER_PREFIX}authors epa
@@ -120,7 +156,10 @@ INNER JOIN {SCHEMA}.publication p ON p.external_id = epa.Eid and p.run_id={RUN_I
 LEFT OUTER JOIN {SCHEMA}.author a
      ON a.external_id = cast(epa.author_id as varchar(128))
     and a.run_id={RUN_ID}
+WHERE {EID_RANGE:epa.eid}
 
+-- step: publication_affiliation
+-- depends: publication
 SET ANSI_WARNINGS OFF
 INSERT INTO {SCHEMA}.publication_affiliation (
    run_id, publication_id,sequence_number,external_id, institution_name,
@@ -132,9 +171,12 @@ SELECT  distinct {RUN_ID}
 ,      affiliation_address_part, country_code, affiliation_state, affiliation_city , affiliation_postal_code
  FROM {ELSEVIER_SCHEMA}.{ELSEVIER_PREFIX}affiliations a
  join {SCHEMA}.publication p on p.run_id={RUN_ID} and p.external_id=a.eid
+ WHERE {EID_RANGE:a.eid}
 SET ANSI_WARNINGS ON
 
 
+-- step: author_affiliation
+-- depends: publication_author, publication_affiliation
 INSERT INTO {SCHEMA}.author_affiliation (run_id, publication_author_id, publication_affiliation_id)
 SELECT DISTINCT {RUN_ID}, pa.id, af.id
 FROM {ELSEVIER_SCHEMA}.{ELSEVIER_PREFIX}authors epa
@@ -154,3 +196,4 @@ INNER JOIN {SCHEMA}.publication_affiliation af
     ON af.publication_id=p.id
     and af.sequence_number=cast(af_s.Value as integer)
     and af.run_id={RUN_ID}
+WHERE {EID_RANGE:epa.eid}
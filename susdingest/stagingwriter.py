@@ -0,0 +1,87 @@
+import csv
+import io
+import logging
+import time
+import pandas as pd
+import sqlalchemy as sqla
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = 10000
+# sql server allows at most 2100 parameters per statement and 1000 rows per insert values list
+MSSQL_MAX_PARAMS = 2099
+MSSQL_MAX_ROWS = 1000
+
+
+def copy_rows(table, conn, keys, data_iter):
+    # pandas to_sql insert method using postgresql COPY, rows are sent as csv where unquoted empty fields are null
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(data_iter)
+    buffer.seek(0)
+    name = f'"{table.schema}"."{table.name}"' if table.schema else f'"{table.name}"'
+    columns = ', '.join(f'"{i}"' for i in keys)
+    with conn.connection.cursor() as cursor:
+        cursor.copy_expert(f'COPY {name} ({columns}) FROM STDIN WITH CSV', buffer)
+
+
+def column_types(frame):
+    # explicit sql types for the pandas column types, text is always stored as unicode
+    types = {}
+    for column, dtype in frame.dtypes.items():
+        if pd.api.types.is_bool_dtype(dtype):
+            types[column] = sqla.Boolean()
+        elif pd.api.types.is_integer_dtype(dtype):
+            types[column] = sqla.BigInteger()
+        elif pd.api.types.is_float_dtype(dtype):
+            types[column] = sqla.Float()
+        elif pd.api.types.is_datetime64_any_dtype(dtype):
+            types[column] = sqla.DateTime()
+        else:
+            types[column] = sqla.UnicodeText()
+    return types
+
+
+def log_summary(stats):
+    for table_name, (rows, seconds) in stats.items():
+        logger.info(f'loaded {rows} rows to {table_name} in {seconds:0.2f}s '
+                    f'({rows / seconds if seconds else 0:0.0f} rows/s)')
+
+
+class StagingWriter:
+    # bulk writes of data frames to staging tables on a connection, using the fastest insert path of the database:
+    # COPY for postgresql, executemany for sqlite and others, and multi row inserts for sql server. Table creation
+    # and if_exists handling are left to pandas.
+
+    def __init__(self, connection, batch_size=None, stats=None):
+        self.connection = connection
+        self.batch_size = batch_size or DEFAULT_BATCH_SIZE
+        dialect = getattr(getattr(connection, 'dialect', None), 'name', None)
+        self.dialect = dialect if isinstance(dialect, str) else None
+        # rows and seconds written per table, may be shared between writers
+        self.stats = {} if stats is None else stats
+
+    def insert_method(self):
+        if self.dialect == 'postgresql':
+            return copy_rows
+        if self.dialect == 'mssql':
+            return 'multi'
+        return None
+
+    def rows_per_batch(self, ncols):
+        if self.dialect == 'mssql':
+            return max(1, min(self.batch_size, MSSQL_MAX_ROWS, MSSQL_MAX_PARAMS // max(ncols, 1)))
+        return self.batch_size
+
+    def write(self, frame, table_name, if_exists='fail', dtype=None):
+        start = time.perf_counter()
+        frame.to_sql(table_name, index=False, con=self.connection, if_exists=if_exists,
+                     chunksize=self.rows_per_batch(len(frame.columns)), method=self.insert_method(),
+                     dtype={**column_types(frame), **{k: v for k, v in (dtype or {}).items() if k in frame}})
+        elapsed = time.perf_counter() - start
+        rows, seconds = self.stats.get(table_name, (0, 0.0))
+        self.stats[table_name] = (rows + len(frame), seconds + elapsed)
+        logger.debug(f'wrote {len(frame)} rows to {table_name} in {elapsed:0.2f}s')
+        return len(frame)
+
+    def log_summary(self):
+        log_summary(self.stats)
@@ -3,6 +3,7 @@ import networkx as nx
 import os
 import pandas
 import sqlalchemy as sqla
+from contextlib import contextmanager
 
 MSSQL = 'MSSQL'
 PSQL = 'PSQL'
@@ -51,6 +52,13 @@ class SUSDDatabase:
             with connection.begin():
                 connection.execute(sqla.text(statement))
 
+    @contextmanager
+    def transaction(self):
+        # a connection whose statements are committed together
+        with self.ENGINE.connect() as connection:
+            with connection.begin():
+                yield connection
+
     def __create_engine(self):
         if self.KIND == MSSQL:
             return sqla.create_engine(
@@ -0,0 +1,212 @@
+import gzip
+import json
+import logging
+import random
+from argparse import ArgumentParser
+from collections import Counter
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+WORDS = ('data survey panel household income bank credit rate model estimate effect policy growth market labour '
+         'health child education regional firm price trade monetary statistics sample analysis results evidence '
+         'cross section time series using based we our this of the and in for with').split()
+MODELS = [('model1', 126), ('model3', 71), ('model2', 41)]
+MODEL_COUNTS = [(1, 126), (2, 32), (3, 7), (4, 1)]
+SNIPPET_COUNTS = [(0, 63), (1, 55), (2, 20), (3, 6), (4, 2), (5, 20)]
+PUBLICATION_TYPES = [('Article', 80), ('Review', 8), ('Conference Paper', 6), ('Book Chapter', 4), ('Note', 2)]
+OPEN_ACCESS = ['all', 'publisherfullgold', 'repository', 'repositoryam', 'repositoryvor']
+YEARS = range(2012, 2023)
+
+
+def weighted(rng, choices):
+    values, weights = zip(*choices)
+    return rng.choices(values, weights)[0]
+
+
+def zipf(rng, n, exponent=1.0):
+    # an id in [0, n) from a Zipf distribution over n ids, like authors, journals or institutions in real exports.
+    # Drawn by inverting the cdf of its continuous approximation, so the share of the most common ids shrinks as the
+    # pool grows.
+    u = rng.random()
+    if exponent == 1:
+        x = (n + 1) ** u
+    else:
+        x = (1 + u * ((n + 1) ** (1 - exponent) - 1)) ** (1 / (1 - exponent))
+    return min(int(x) - 1, n - 1)
+
+
+def zipf_sample(rng, n, k, exponent=1.0):
+    # k distinct ids in [0, n) from a Zipf distribution, like the authors or concepts of a single publication
+    ids = {}
+    while len(ids) < min(k, n):
+        ids.setdefault(zipf(rng, n, exponent))
+    return list(ids)
+
+
+def lognormal_count(rng, mu, sigma, low=1, high=None):
+    count = max(low, round(rng.lognormvariate(mu, sigma)))
+    return min(count, high) if high else count
+
+
+class ExportGenerator:
+    # builds a synthetic export of any number of publications with the structure of a real one, with distributions
+    # of dyads, snippets, authors and affiliations similar to real exports, and export metadata that matches the
+    # publications. The same seed always produces the same export.
+
+    def __init__(self, publications=10000, seed=0, aliases=40, snippet_length=300):
+        self.publications = publications
+        self.seed = seed
+        self.aliases = [{'alias_id': 1001 + i, 'alias': f'Synthetic dataset {i}', 'parent_alias_id': 9999,
+                         'alias_type': 'alias'} for i in range(aliases)]
+        self.snippet_length = snippet_length
+        # pools entities are drawn from, scaled with the export like in real exports
+        self.authors = max(100, publications * 2)
+        self.institutions = max(50, publications // 5)
+        self.journals = max(20, publications // 50)
+        self.topics = max(10, min(publications // 10, 100000))
+        # texts are slices of a corpus of random words, much faster than joining words for every text
+        corpus_rng = random.Random(seed)
+        self.corpus = ' '.join(corpus_rng.choice(WORDS) for i in range(20000))
+
+    def text(self, rng, length):
+        start = rng.randrange(len(self.corpus) - length)
+        return self.corpus[start:start + length]
+
+    def dataset(self, rng, linked):
+        # the first dataset of a publication is always linked to an alias, as every exported publication matched one
+        dataset = {
+            'identified_dataset_name': self.text(rng, rng.randint(4, 40)),
+            'models': [{'model': weighted(rng, MODELS), 'score': round(rng.random() * 2, 3)}
+                       for i in range(weighted(rng, MODEL_COUNTS))],
+            'snippets': [self.text(rng, self.snippet_length) for i in range(weighted(rng, SNIPPET_COUNTS))],
+        }
+        if linked:
+            alias = self.aliases[zipf(rng, len(self.aliases))]
+            dataset['linked_alias'] = {'alias': alias['alias'], 'alias_id': alias['alias_id'],
+                                       'is_fuzzy': rng.random() < 0.5, 'fuzzy_score': round(rng.uniform(0.6, 1), 2)}
+        return dataset
+
+    def affiliation(self, rng, sequence):
+        institution = zipf(rng, self.institutions, 0.7)
+        return {
+            'affiliation_sequence': sequence,
+            'affiliation_normalized': [{'name': f'Institution {institution}', 'country': 'usa',
+                                        'id': 700000 + institution}],
+            'affiliation_text': {
+                'affiliation_organization': [f'Department {rng.randint(1, 20)}', f'Institution {institution}'],
+                'affiliation_city': f'City {institution % 500}',
+                'country_code': 'usa',
+                'affiliation_ids': [60000000 + institution],
+            },
+        }
+
+    def publication(self, rng, n):
+        n_authors = lognormal_count(rng, 0.8, 0.8, high=500)
+        n_affiliations = lognormal_count(rng, 0.4, 0.7, high=max(1, n_authors))
+        journal = zipf(rng, self.journals, 0.5)
+        topic = zipf(rng, self.topics, 0.5)
+        record = {
+            'eid': f'2-s2.0-{85000000000 + n}',
+            'open_access_list': OPEN_ACCESS[:rng.randint(1, len(OPEN_ACCESS))] if rng.random() < 0.5 else None,
+            'publication_title': self.text(rng, rng.randint(40, 160)),
+            'publication_year': rng.choice(YEARS),
+            'publication_month': rng.randint(1, 12),
+            'publication_type': weighted(rng, PUBLICATION_TYPES),
+            'asjcs': [{'asjc': str(1000 + asjc), 'label': f'Subject area {asjc}'}
+                      for asjc in zipf_sample(rng, 300, lognormal_count(rng, 0.7, 0.5, high=10), 0.8)],
+            'journal_title': f'Journal {journal}',
+            'journal_citescore': {'citescore_year': 2021, 'citescore_value': round(rng.uniform(0, 20), 1)},
+            'journal_scopus_source_id': 100000 + journal,
+            'journal_publishername': f'Publisher {journal % 200}',
+            'journal_issn_isbn': [f'{10000000 + journal}', f'{20000000 + journal}'],
+            'authors': [{
+                'given_name': f'Given{author}', 'family_name': f'Family{author}',
+                'pn_given_name': f'Given{author}', 'pn_family_name': f'Family{author}',
+                'author_id': 6000000000 + author, 'author_position': position + 1,
+                'affiliation_sequences': sorted(rng.sample(range(1, n_affiliations + 1),
+                                                           min(n_affiliations, weighted(rng, [(1, 109), (2, 14),
+                                                                                              (3, 3)])))),
+            } for position, author in enumerate(zipf_sample(rng, self.authors, n_authors, 0.5))],
+            'affiliations': [self.affiliation(rng, i + 1) for i in range(n_affiliations)],
+            'citation_count': int(rng.paretovariate(1.1)) - 1,
+            'field_weighted_citation_impact': rng.lognormvariate(-0.5, 1),
+            'topic': {'topic_id': topic, 'keywords': [rng.choice(WORDS) for i in range(3)],
+                      'prominence': rng.uniform(0, 100)},
+            'topic_cluster': {'topic_cluster_id': topic % 1500, 'keywords': [rng.choice(WORDS) for i in range(3)],
+                              'prominence': rng.uniform(0, 100)},
+            'unified_fingerprint_concepts': [{'concept_id': concept, 'concept_name': rng.choice(WORDS),
+                                              'rank': round(rng.random(), 6), 'a_freq': rng.randint(1, 9)}
+                                             for concept in zipf_sample(rng, 50000, lognormal_count(rng, 3.5, 0.4,
+                                                                                                    high=100), 0.8)],
+            'identified_datasets': [self.dataset(rng, i == 0 or rng.random() < 0.2)
+                                    for i in range(lognormal_count(rng, 0.6, 0.8, high=60))],
+            'expressions': [{'expression': alias['alias'], 'matched': False} for alias in self.aliases[:5]],
+        }
+        # like real exports, some publications have no doi
+        if rng.random() > 0.07:
+            record['doi'] = f'10.{1000 + journal}/synthetic.{n}'
+        return record
+
+    def records(self):
+        rng = random.Random(self.seed)
+        for n in range(self.publications):
+            yield self.publication(rng, n)
+
+    def metadata(self, agency, version, year_counts, alias_counts, authors, topics):
+        return {
+            'metadata': {'agency': agency, 'run_id': version, 'export_format_version': '009', 'synthetic': True},
+            'stats': {
+                'overall': {
+                    'unique_documents_exported': sum(year_counts.values()),
+                    'unique_topics_exported': len(topics),
+                    'unique_authors_exported': len(authors),
+                    'unique_documents_per_year': [{'publication_year': year, 'documents': count}
+                                                  for year, count in sorted(year_counts.items())],
+                },
+                'documents_per_alias': [{**alias, 'unique_documents_exported': alias_counts[alias['alias_id']]}
+                                        for alias in self.aliases],
+            },
+        }
+
+    def write(self, path, agency='agency', version='version', shard_size=50000):
+        # writes the export below path/agency/version in the layout of the S3 mirror, returns that directory
+        run_dir = Path(path).joinpath(agency, version)
+        shard_dir = run_dir.joinpath('json', 'publications')
+        shard_dir.mkdir(parents=True, exist_ok=True)
+        run_dir.joinpath('stat').mkdir(exist_ok=True)
+        year_counts, alias_counts, authors, topics = Counter(), Counter(), set(), set()
+        shard = None
+        for n, record in enumerate(self.records()):
+            if n % shard_size == 0:
+                if shard:
+                    shard.close()
+                shard = gzip.open(shard_dir.joinpath(f'publications_part-{n // shard_size:05d}.json.gz'), 'wt',
+                                  compresslevel=6)
+            shard.write(json.dumps(record) + '\n')
+            year_counts[record['publication_year']] += 1
+            alias_counts.update({i['linked_alias']['alias_id'] for i in record['identified_datasets']
+                                 if 'linked_alias' in i})
+            authors.update(i['author_id'] for i in record['authors'])
+            topics.add(record['topic']['topic_id'])
+        if shard:
+            shard.close()
+        with open(run_dir.joinpath('stat', 'export_metadata.json'), 'w') as f:
+            json.dump(self.metadata(agency, version, year_counts, alias_counts, authors, topics), f)
+        logger.info(f'wrote {self.publications} synthetic publications to {run_dir}')
+        return run_dir
+
+
+if __name__ == '__main__':
+    ap = ArgumentParser(description='generate a synthetic export')
+    ap.add_argument('path')
+    ap.add_argument('-n', '--publications', type=int, default=10000)
+    ap.add_argument('-a', '--agency', default='agency')
+    ap.add_argument('-r', '--run-version', default='version')
+    ap.add_argument('--shard-size', type=int, default=50000)
+    ap.add_argument('--aliases', type=int, default=40)
+    ap.add_argument('--seed', type=int, default=0)
+    args = ap.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    ExportGenerator(args.publications, seed=args.seed, aliases=args.aliases) \
+        .write(args.path, args.agency, args.run_version, shard_size=args.shard_size)
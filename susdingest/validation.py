@@ -0,0 +1,76 @@
+import logging
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+
+
+class Validator:
+    # incremental validation of an export against its metadata, fed one chunk of tables at a time. Keeps running
+    # document counts per publication year and per alias and the set of eids seen, so that a duplicate eid fails on
+    # the chunk it first appears in. Alias counts are only logged unless strict_aliases is set.
+
+    def __init__(self, metadata, raise_exception=True, strict_aliases=False, name=None):
+        if not metadata:
+            raise ValueError('need metadata to validate!')
+        self.metadata = metadata
+        self.raise_exception = raise_exception
+        self.strict_aliases = strict_aliases
+        self.name = name
+        self.year_counts = Counter()
+        self.alias_counts = Counter()
+        self.eids = set()
+        self.duplicates = []
+
+    def fail(self, message):
+        if self.raise_exception:
+            raise AssertionError(f'input validation failed for {self.name}: {message}')
+        logger.error(f'input validation failed for {self.name}: {message}')
+
+    def add(self, publications, dyads=None):
+        eids = publications.index
+        duplicated = eids[eids.duplicated()].tolist()
+        if not self.eids.isdisjoint(eids):
+            duplicated.extend(i for i in eids.unique() if i in self.eids)
+        if duplicated:
+            self.duplicates.extend(duplicated)
+            self.fail(f'duplicate eid {duplicated[0]}')
+        self.eids.update(eids)
+        self.year_counts.update(publications['publication_year'].dropna().value_counts().to_dict())
+        if dyads is not None:
+            alias_documents = dyads.reset_index()[['eid', 'alias_id']].dropna().drop_duplicates()
+            self.alias_counts.update(alias_documents['alias_id'].value_counts().to_dict())
+        return self
+
+    def check_years(self):
+        expected = Counter({i['publication_year']: i['documents']
+                            for i in self.metadata['stats']['overall']['unique_documents_per_year']})
+        # counters ignore years without documents
+        mismatched = {year: (expected[year], self.year_counts[year]) for year in set(expected) | set(self.year_counts)
+                      if expected[year] != self.year_counts[year]}
+        if mismatched:
+            logger.info(f'publication counts by year differ from metadata (expected, observed): {mismatched}')
+        return not mismatched
+
+    def check_aliases(self):
+        expected = Counter({i['alias_id']: i['unique_documents_exported']
+                            for i in self.metadata['stats'].get('documents_per_alias', [])})
+        mismatched = {alias: (expected[alias], self.alias_counts[alias])
+                      for alias in set(expected) | set(self.alias_counts)
+                      if expected[alias] != self.alias_counts[alias]}
+        if mismatched:
+            logger.log(logging.INFO if self.strict_aliases else logging.WARNING,
+                       f'documents per alias differ from metadata for {len(mismatched)} aliases')
+            logger.debug(f'documents per alias (expected, observed): {mismatched}')
+        return not mismatched
+
+    def check(self):
+        year_counts_valid = self.check_years()
+        alias_counts_valid = self.check_aliases()
+        eid_no_duplicates = not self.duplicates
+        logger.info(f'input validation of publications by year: {year_counts_valid}')
+        logger.info(f'input validation of documents per alias: {alias_counts_valid}')
+        logger.info(f'input validation Eid uniqueness: {eid_no_duplicates}')
+        valid = year_counts_valid and eid_no_duplicates and (alias_counts_valid or not self.strict_aliases)
+        if not valid:
+            self.fail('counts or eids do not match metadata')
+        return valid
@@ -0,0 +1,182 @@
+import networkx as nx
+import pandas as pd
+import re
+import threading
+import time
+from contextlib import contextmanager
+from unittest import TestCase
+from unittest.mock import MagicMock
+from susdingest.datamodelloader import DatamodelLoader, EID_RANGE, eid_range, eid_range_tables, read_steps, \
+    step_graph
+from susdingest.metrics import Metrics
+
+BATCHED_STEPS = ['publication', 'dyad', 'dyad_model', 'publication_topic', 'publication_ufc', 'publication_asjc',
+                 'publication_author', 'publication_affiliation', 'author_affiliation']
+
+
+class TestDatamodelLoader(TestCase):
+
+    def setUp(self):
+        self.database = MagicMock(SCHEMA='dbo', DATABASE='final')
+        self.database.get_run_id.return_value = 7
+        self.transactions = []
+        self.bounds, self.copied = [], None
+
+        @contextmanager
+        def transaction():
+            statements = []
+            connection = MagicMock()
+            connection.execute.side_effect = lambda statement: statements.append(str(statement)) or MagicMock(
+                rowcount=3)
+            yield connection
+            self.transactions.append(statements)
+
+        def execute_query(sql):
+            if 'row_number' in sql:
+                self.bounds_query = sql
+                return pd.DataFrame({'eid': self.bounds})
+            return pd.DataFrame({'eid': [self.copied]})
+
+        self.database.transaction.side_effect = transaction
+        self.database.execute_query.side_effect = execute_query
+        self.loader = DatamodelLoader(self.database, 'staging', metrics=Metrics())
+
+    def test_script_steps(self):
+        steps = read_steps(f'{self.loader.file_path}/sql/insert_elsevier.sql')
+        names = [name for name, sql in steps]
+        assert(names[0] == 'dataset_alias' and len(names) == len(set(names)) == 16)
+        assert([name for name, sql in steps if EID_RANGE.search(sql)] == BATCHED_STEPS)
+        for name, sql in self.loader.copy_steps('agency', 'version', 7):
+            assert('{' not in EID_RANGE.sub('', sql))
+
+    def test_eid_range(self):
+        assert(eid_range('where {EID_RANGE:p.eid}') == 'where 1=1')
+        assert(eid_range('where {EID_RANGE:p.eid}', "a'", 'b') == "where p.eid > 'a''' and p.eid <= 'b'")
+
+    def test_copy_in_single_transaction(self):
+        self.loader.copy_from_staging('agency', 'version')
+        assert(len(self.transactions) == 1 and len(self.transactions[0]) == 16)
+        assert(all('EID_RANGE' not in i for i in self.transactions[0]))
+        steps = [i.labels['step'] for i in self.loader.metrics.records if i.name == 'final_insert']
+        assert(steps[0] == 'dataset_alias' and len(steps) == 16)
+        assert(all(i.rows == 3 for i in self.loader.metrics.records))
+
+    def test_copy_in_batches(self):
+        self.bounds = ['2-s2.0-b', '2-s2.0-d']
+        self.loader.copy_from_staging('agency', 'version', batch_size=2)
+        assert('/ 2 AS batch' in self.bounds_query and '1=1' in self.bounds_query)
+        first, second = self.transactions
+        assert(len(first) == 16 and len(second) == len(BATCHED_STEPS))
+        assert("epm.eid <= '2-s2.0-b'" in ''.join(first) and '>' not in first[-1])
+        assert(all("> '2-s2.0-b' and" in i and "<= '2-s2.0-d'" in i for i in second))
+
+    def test_batched_copy_indexes_staging_eids(self):
+        steps = read_steps(f'{self.loader.file_path}/sql/insert_elsevier.sql')
+        assert(eid_range_tables(steps) == ['affiliations', 'asjcs', 'authors', 'dyads', 'publications', 'topics',
+                                           'ufcs'])
+        self.loader.copy_from_staging('agency', 'version', batch_size=2, resume=True)
+        indexes = [i.args[0] for i in self.database.execute_update.call_args_list if 'CREATE INDEX' in i.args[0]]
+        assert(len(indexes) == 7)
+        assert(any('CREATE INDEX [ix_agency_version_dyads_eid] ON staging.dbo.agency_version_dyads(eid)' in i
+                   for i in indexes))
+        self.database.execute_update.reset_mock()
+        self.loader.copy_from_staging('agency', 'version')
+        assert(not any('CREATE INDEX' in i.args[0] for i in self.database.execute_update.call_args_list))
+
+    def test_copy_resumes_after_last_batch(self):
+        self.copied, self.bounds = '2-s2.0-b', ['2-s2.0-d']
+        self.loader.copy_from_staging('agency', 'version', batch_size=2, resume=True)
+        assert("eid > '2-s2.0-b'" in self.bounds_query)
+        assert(len(self.transactions) == 1 and len(self.transactions[0]) == len(BATCHED_STEPS))
+        assert("epm.eid > '2-s2.0-b' and epm.eid <= '2-s2.0-d'" in self.transactions[0][0])
+
+    def test_resumed_copy_of_copied_run_does_nothing(self):
+        self.copied = '2-s2.0-d'
+        self.loader.copy_from_staging('agency', 'version', batch_size=2, resume=True)
+        assert(self.transactions == [])
+        assert(not any('delete from' in i.args[0] for i in self.database.execute_update.call_args_list))
+
+    def test_copy_replaces_copied_run(self):
+        self.copied, self.bounds = '2-s2.0-d', ['2-s2.0-b', '2-s2.0-d']
+        self.loader.copy_from_staging('agency', 'version', batch_size=2)
+        assert('delete from dbo.agency_run' in self.database.execute_update.call_args_list[0].args[0])
+        assert(len(self.transactions) == 2 and len(self.transactions[0]) == 16)
+        assert('1=1' in self.bounds_query)
+
+    def test_script_step_dependencies(self):
+        graph = step_graph(read_steps(f'{self.loader.file_path}/sql/insert_elsevier.sql'))
+        assert({i for i in graph if graph.in_degree(i) == 0} == {'dataset_alias', 'publisher', 'topic', 'asjc',
+                                                                  'author'})
+        assert(set(graph.predecessors('publication_ufc')) == {'publication'})
+        assert(nx.ancestors(graph, 'author_affiliation') == {'publisher', 'journal', 'publication', 'author',
+                                                             'publication_author', 'publication_affiliation'})
+
+    def test_steps_without_dependencies_run_in_order(self):
+        graph = step_graph([('a', 'select 1'), ('b', '-- depends:\nselect 2'), ('c', 'select 3')])
+        assert(set(graph.edges) == {('a', 'c'), ('b', 'c')})
+        with self.assertRaises(ValueError):
+            step_graph([('a', '-- depends: b\nselect 1'), ('b', '-- depends: a\nselect 2')])
+        with self.assertRaises(ValueError):
+            step_graph([('a', '-- depends: x\nselect 1')])
+
+    def record_steps(self, fail=None):
+        lock, self.running, self.peak, self.completed = threading.Lock(), 0, 0, []
+
+        def execute_steps(steps, AGENCY, VERSION):
+            (name, sql), = steps
+            with lock:
+                self.running += 1
+                self.peak = max(self.peak, self.running)
+            time.sleep(0.01)
+            with lock:
+                self.running -= 1
+                if name == fail:
+                    raise RuntimeError(f'{name} failed')
+                self.completed.append(name)
+        self.loader.execute_steps = execute_steps
+
+    def test_copy_steps_in_parallel(self):
+        self.record_steps()
+        self.loader.copy_from_staging('agency', 'version', parallelism=4)
+        graph = step_graph(self.loader.copy_steps('agency', 'version', 7))
+        assert(sorted(self.completed) == sorted(graph))
+        for before, after in graph.edges:
+            assert(self.completed.index(before) < self.completed.index(after))
+        assert(1 < self.peak <= 4)
+
+    def test_failed_parallel_copy_deletes_new_run(self):
+        self.database.get_run_id.side_effect = [None, 7, 7]
+        self.record_steps(fail='publication')
+        with self.assertRaises(RuntimeError):
+            self.loader.copy_from_staging('agency', 'version', parallelism=4)
+        assert('dyad' not in self.completed and 'author_affiliation' not in self.completed)
+        assert(any('delete from dbo.agency_run' in str(i) for i in self.database.execute_update.call_args_list))
+
+    def test_failed_parallel_copy_deletes_existing_run(self):
+        # the run is cleared before the copy, and again after a failure once publication_ufc has committed rows
+        self.record_steps(fail='author_affiliation')
+        with self.assertRaises(RuntimeError):
+            self.loader.copy_from_staging('agency', 'version', parallelism=4)
+        assert('publication_ufc' in self.completed)
+        deletes = [i.args[0] for i in self.database.execute_update.call_args_list if 'delete from' in i.args[0]]
+        assert(len(deletes) == 2)
+        assert(deletes[1].index('delete from dbo.publication_ufc ') < deletes[1].index('delete from dbo.publication '))
+
+    def test_delete_script_respects_foreign_keys(self):
+        # every table the copy writes is deleted from before the tables it references
+        with open(f'{self.loader.file_path}/sql/initialize-dm-database.sql') as f:
+            ddl = f.read()
+        references = {}
+        for table, body in re.findall(r'CREATE TABLE \{SCHEMA\}\.(\w+)\s*\((.*?)\n\)', ddl, re.DOTALL):
+            references[table] = set(re.findall(r'REFERENCES \{SCHEMA\}\.(\w+)\(', body)) - {table}
+        with open(f'{self.loader.file_path}/sql/delete_agency_run.sql') as f:
+            deleted = re.findall(r'delete from \{SCHEMA\}\.(\w+) ', f.read())
+        copied = {name for name, sql in read_steps(f'{self.loader.file_path}/sql/insert_elsevier.sql')}
+        assert(copied <= set(deleted))
+        for table in copied:
+            for referenced in references[table] & set(deleted):
+                assert(deleted.index(table) < deleted.index(referenced))
+
+    def test_batches_not_copied_in_parallel(self):
+        with self.assertRaises(ValueError):
+            self.loader.copy_from_staging('agency', 'version', batch_size=10, parallelism=2)
@@ -0,0 +1,56 @@
+import pandas as pd
+from pathlib import Path
+from unittest import TestCase
+from susdingest.jsonloader import JSONLoader
+from susdingest.flattener import RecordFlattener
+
+
+class TestRecordFlattener(TestCase):
+
+    def setUp(self):
+        examples = Path(__file__).with_name('example_data').joinpath('agency', 'version')
+        self.json_files = list(examples.joinpath('json', 'publications').glob('publication*.json.gz'))
+        self.meta_file = examples.joinpath('stat', 'export_metadata.json')
+
+    def test_flatten_matches_table_properties(self):
+        jl = JSONLoader(self.json_files, metadata_file=self.meta_file)
+        tables = jl.flatten()
+        assert(set(tables) == set(JSONLoader.export_kinds))
+        for kind in JSONLoader.export_kinds:
+            pd.testing.assert_frame_equal(tables[kind], getattr(jl, kind))
+
+    def test_flatten_subset_of_kinds(self):
+        jl = JSONLoader(self.json_files)
+        tables = jl.flatten(['dyads', 'ufcs'])
+        assert(set(tables) == {'dyads', 'ufcs'})
+        pd.testing.assert_frame_equal(tables['dyads'], jl.dyads)
+
+    def test_flatten_does_not_modify_records(self):
+        jl = JSONLoader(self.json_files)
+        authors = jl.data['authors'].iloc[0]
+        jl.flatten()
+        assert(isinstance(authors[0]['affiliation_sequences'], list))
+
+    def test_records_with_missing_and_empty_fields(self):
+        records = [
+            ('a', {'publication_year': 2020, 'identified_datasets': [], 'authors': None}),
+            ('b', {'publication_year': 2021, 'identified_datasets': [{'identified_dataset_name': 'x',
+                                                                      'models': [], 'snippets': ['Not Available']}],
+                   'affiliations': [{'affiliation_sequence': 1, 'affiliation_text': {'affiliation_ids': []}}]}),
+        ]
+        tables = RecordFlattener().add_records(records).tables()
+        assert(list(tables['publications'].index) == ['a', 'b'])
+        assert(tables['publications'].loc['a', 'publication_year'] == 2020)
+        assert(len(tables['dyads']) == 1)
+        assert(tables['dyads']['snippet'].isna().all())
+        assert(tables['affiliations']['affiliation_id'].isna().all())
+        assert(len(tables['authors']) == 0)
+
+    def test_flatten_matches_table_properties_at_scale(self):
+        jl = JSONLoader(self.json_files, metadata_file=self.meta_file)
+        # scale up the example data with distinct eids
+        jl.data = pd.concat([jl.data.set_index(jl.data.index + f'-{i}') for i in range(50)])
+        tables = jl.flatten()
+        jl.invalidate()
+        for kind in JSONLoader.export_kinds:
+            pd.testing.assert_frame_equal(tables[kind], getattr(jl, kind))
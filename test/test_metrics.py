@@ -0,0 +1,65 @@
+import json
+import tempfile
+from pathlib import Path
+from unittest import TestCase
+from susdingest.metrics import Metrics, measure, measure_each
+
+
+class TestMetrics(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_stage_records_time_rows_and_memory(self):
+        metrics = Metrics()
+        with metrics.stage('parse', agency='agency', version=None) as record:
+            record.add(10, 100)
+            sum(range(100000))
+        record = metrics.records[0]
+        assert(record.name == 'parse' and record.labels == {'agency': 'agency'})
+        assert((record.rows, record.bytes) == (10, 100))
+        assert(record.wall > 0 and record.cpu >= 0 and record.peak_rss > 0)
+
+    def test_failed_stage_recorded(self):
+        metrics = Metrics()
+        with self.assertRaises(ZeroDivisionError):
+            with metrics.stage('parse'):
+                1 / 0
+        assert(len(metrics.records) == 1)
+
+    def test_measure_without_metrics(self):
+        with measure(None, 'parse') as record:
+            record.add(1, 1)
+
+    def test_measure_each_records_each_item(self):
+        metrics = Metrics()
+        items = list(measure_each(metrics, 'chunk', [[1, 2], [3]], count=lambda i: (len(i), 0)))
+        assert(items == [[1, 2], [3]])
+        assert([i.rows for i in metrics.records] == [2, 1])
+        assert(list(measure_each(None, 'chunk', [1, 2])) == [1, 2])
+
+    def test_json_report(self):
+        metrics = Metrics()
+        with metrics.stage('parse', agency='agency') as record:
+            record.add(5)
+        path = Path(self.tmpdir.name).joinpath('report.json')
+        metrics.write_json(path, runs=[{'agency': 'agency'}])
+        report = json.loads(path.read_text())
+        assert(report['stages'][0]['stage'] == 'parse' and report['stages'][0]['rows'] == 5)
+        assert(report['runs'] == [{'agency': 'agency'}])
+        assert(report['wall_seconds'] >= report['stages'][0]['wall_seconds'])
+
+    def test_prometheus_textfile_totals_stages(self):
+        metrics = Metrics()
+        for rows in [1, 2]:
+            with metrics.stage('staging_write', table='a"b') as record:
+                record.add(rows)
+        path = Path(self.tmpdir.name).joinpath('susdingest.prom')
+        metrics.write_prometheus(path)
+        lines = path.read_text().splitlines()
+        assert('# TYPE susdingest_stage_rows counter' in lines)
+        assert('susdingest_stage_rows{stage="staging_write",table="a\\"b"} 3' in lines)
+        assert(not Path(f'{path}.tmp').exists())
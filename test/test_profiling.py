@@ -0,0 +1,88 @@
+import pstats
+import tempfile
+import tracemalloc
+import sqlalchemy
+import sqlalchemy.inspection
+from pathlib import Path
+from unittest import TestCase
+from susdingest.jsonloader import JSONLoader
+from susdingest.profiling import Profiler, profile
+
+
+def outer_work():
+    return sum(range(1000))
+
+
+def inner_work():
+    return [i * 2 for i in range(1000)]
+
+
+def functions(path):
+    return {name: stats[0] for (filename, line, name), stats in pstats.Stats(str(path)).stats.items()}
+
+
+class TestProfiler(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.directory = Path(self.tmpdir.name)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_unknown_stage_or_mode(self):
+        with self.assertRaises(ValueError):
+            Profiler(['parse'])
+        with self.assertRaises(ValueError):
+            Profiler(['load_db'], modes=['perf'])
+
+    def test_unselected_stage_not_profiled(self):
+        profiler = Profiler(['load_db'], self.directory)
+        with profile(profiler, 'load_json', agency='agency', version='version'):
+            outer_work()
+        with profile(None, 'load_db'):
+            outer_work()
+        profiler.close()
+        assert(list(self.directory.iterdir()) == [])
+
+    def test_stage_profile_per_run(self):
+        profiler = Profiler(['load_db'], self.directory)
+        for i in range(2):
+            with profiler.stage('load_db', agency='agency', version='version'):
+                outer_work()
+        profiler.close()
+        assert(functions(self.directory.joinpath('agency_version_load_db.prof'))['outer_work'] == 2)
+
+    def test_nested_stage_profiled_on_its_own(self):
+        profiler = Profiler(['all'], self.directory)
+        with profiler.stage('load_db', agency='agency', version='version'):
+            outer_work()
+            with profiler.stage('table_dyads', agency='agency', version='version'):
+                inner_work()
+            outer_work()
+        profiler.close()
+        outer = functions(self.directory.joinpath('agency_version_load_db.prof'))
+        inner = functions(self.directory.joinpath('agency_version_table_dyads.prof'))
+        assert(outer['outer_work'] == 2 and 'inner_work' not in outer)
+        assert('inner_work' in inner and 'outer_work' not in inner)
+
+    def test_tracemalloc_snapshot(self):
+        profiler = Profiler(['s3_sync'], self.directory, modes=['tracemalloc'])
+        with profiler.stage('s3_sync'):
+            held = inner_work()
+        profiler.close()
+        assert(not tracemalloc.is_tracing())
+        snapshot = tracemalloc.Snapshot.load(str(self.directory.joinpath('s3_sync.tracemalloc')))
+        assert(any(__file__ in i.traceback[0].filename for i in snapshot.statistics('filename')))
+        assert(len(held) == 1000)
+
+    def test_loader_stages_profiled(self):
+        sqlalchemy.inspect = sqlalchemy.inspection.inspect
+        examples = Path(__file__).with_name('example_data')
+        profiler = Profiler(['load_json', 'tables', 'load_db'], self.directory)
+        JSONLoader.from_path(examples, 'agency', 'version', conn_str=f'sqlite:///{self.tmpdir.name}/staging.db',
+                             profiler=profiler).load_db()
+        profiler.close()
+        names = {i.name for i in self.directory.glob('*.prof')}
+        assert({'agency_version_load_json.prof', 'agency_version_flatten.prof', 'agency_version_load_db.prof',
+                'agency_version_table_datasets.prof'} <= names)
@@ -1,7 +1,17 @@
+import boto3
 import json
+import os
+import pathlib
+import sqlite3
+import tempfile
+import threading
+import time
+from botocore.exceptions import ClientError
+from moto import mock_aws
 from unittest import TestCase
 from unittest.mock import MagicMock, mock_open, patch
 from susdingest import s3loader
+from susdingest.mirrormanifest import MirrorManifest
 
 
 fakecreds = {'aws_access_key_id': 'id', 'aws_secret_access_key': 'key'}
@@ -71,3 +81,371 @@ class TestS3Loader(TestCase):
         print(self.s3objmock.Object().download_file.call_count)
         # this is not the greatest test as nondeterministic...
         assert(self.s3objmock.Object().download_file.call_count < len(self.s3objlist))
+
+
+class TestS3LoaderManifest(TestCase):
+
+    def setUp(self):
+        s3loader.boto3 = boto3
+        s3loader.Path = pathlib.Path
+        self.mock_aws = mock_aws()
+        self.mock_aws.start()
+        self.s3 = boto3.client('s3', region_name='us-east-1')
+        self.s3.create_bucket(Bucket='bucket')
+        self.keys = ['prefix/agency/v1/json/publications/part-0.json.gz',
+                     'prefix/agency/v1/json/publications/part-1.json.gz',
+                     'prefix/agency/v2/stat/export_metadata.json']
+        for key in self.keys:
+            self.s3.put_object(Bucket='bucket', Key=key, Body=key.encode())
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.mirror = pathlib.Path(self.tmpdir.name)
+        self.manifest_file = self.mirror.joinpath('.manifest.sqlite')
+
+    def tearDown(self):
+        self.mock_aws.stop()
+        self.tmpdir.cleanup()
+
+    def loader(self):
+        return s3loader.S3Loader('bucket', 'prefix', str(self.mirror), manifest=self.manifest_file)
+
+    def test_sync_records_manifest(self):
+        updated = self.loader().load_s3()
+        assert(updated == {('agency', 'v1'), ('agency', 'v2')})
+        entries = MirrorManifest(self.manifest_file).entries()
+        assert(set(entries) == set(self.keys))
+        assert(entries[self.keys[0]][1] == len(self.keys[0]))
+        assert(self.mirror.joinpath('agency', 'v2', 'stat', 'export_metadata.json').read_text() == self.keys[2])
+
+    def test_unchanged_objects_are_skipped(self):
+        self.loader().load_s3()
+        with patch.object(s3loader.S3Loader, '_download_object') as download:
+            assert(self.loader().load_s3() == set())
+            assert(not download.called)
+
+    def test_changed_objects_are_downloaded(self):
+        self.loader().load_s3()
+        self.s3.put_object(Bucket='bucket', Key=self.keys[1], Body=b'changed')
+        assert(self.loader().load_s3() == {('agency', 'v1')})
+        assert(self.mirror.joinpath('agency', 'v1', 'json', 'publications', 'part-1.json.gz').read_bytes() == b'changed')
+
+    def test_existing_mirror_is_adopted_unless_truncated(self):
+        s3loader.S3Loader('bucket', 'prefix', str(self.mirror)).load_s3()
+        self.mirror.joinpath('agency', 'v1', 'json', 'publications', 'part-0.json.gz').write_bytes(b'trunc')
+        assert(self.loader().load_s3() == {('agency', 'v1')})
+        assert(set(MirrorManifest(self.manifest_file).entries()) == set(self.keys))
+        assert(self.loader().load_s3() == set())
+
+    def test_download_restarts_run_stages(self):
+        ldr = self.loader()
+        ldr.load_s3()
+        assert(set(ldr.run_stages('agency', 'v1')) == {'downloaded'})
+        for stage in ['parsed', 'validated', 'staged']:
+            ldr.record_stage('agency', 'v1', stage)
+        ldr.record_stage('agency', 'v2', 'final')
+        assert(ldr.unfinished_runs() == [('agency', 'v1')])
+        assert(('agency', 'v2') in ldr.manifest.ingested())
+        self.s3.put_object(Bucket='bucket', Key=self.keys[1], Body=b'changed')
+        ldr.load_s3()
+        assert(set(ldr.run_stages('agency', 'v1')) == {'downloaded'})
+        with self.assertRaises(ValueError):
+            ldr.record_stage('agency', 'v1', 'unknown')
+        ldr.reset_run('agency', 'v1')
+        assert(ldr.unfinished_runs() == [])
+
+    def test_record_without_download(self):
+        assert(self.loader().load_s3(download=False) == {('agency', 'v1'), ('agency', 'v2')})
+        assert(set(MirrorManifest(self.manifest_file).entries()) == set(self.keys))
+        assert(not self.mirror.joinpath('agency').exists())
+        self.s3.put_object(Bucket='bucket', Key=self.keys[2], Body=b'changed')
+        assert(self.loader().load_s3(download=False) == {('agency', 'v2')})
+
+    def test_run_completion_reported_once_run_is_mirrored(self):
+        completed = []
+
+        def on_run_complete(agency, version):
+            run_dir = self.mirror.joinpath(agency, version)
+            keys = [i for i in self.keys if i.startswith(f'prefix/{agency}/{version}/')]
+            assert(all(run_dir.parent.parent.joinpath(*i.split('/')[1:]).exists() for i in keys))
+            assert(set(keys) <= set(MirrorManifest(self.manifest_file).entries()))
+            completed.append((agency, version))
+
+        updated = self.loader().load_s3(on_run_complete=on_run_complete)
+        assert(sorted(completed) == sorted(updated))
+        completed.clear()
+        self.s3.put_object(Bucket='bucket', Key=self.keys[2], Body=b'changed')
+        self.loader().load_s3(on_run_complete=on_run_complete)
+        assert(completed == [('agency', 'v2')])
+
+    def test_run_completion_not_reported_for_failed_run(self):
+        completed = []
+        original = s3loader.S3Loader._download_object
+
+        def download(ldr, s3object, dest_file, size=None):
+            if s3object.key == self.keys[1]:
+                raise Exception('download failed')
+            return original(ldr, s3object, dest_file, size)
+
+        with patch.object(s3loader.S3Loader, '_download_object', download):
+            with self.assertRaises(Exception):
+                self.loader().load_s3(on_run_complete=lambda *run: completed.append(run))
+        assert(('agency', 'v1') not in completed)
+
+
+class TestS3LoaderListing(TestCase):
+
+    def setUp(self):
+        s3loader.boto3 = boto3
+        s3loader.Path = pathlib.Path
+        self.mock_aws = mock_aws()
+        self.mock_aws.start()
+        self.s3 = boto3.client('s3', region_name='us-east-1')
+        self.s3.create_bucket(Bucket='bucket')
+        self.keys = ['prefix/agency_1/readme.txt', 'prefix/agency_1/2021/json/publications/part-0.json.gz',
+                     'prefix/agency_1/2022/json/publications/part-0.json.gz',
+                     'prefix/agency_1/2022/json/publications/part-1.json.gz',
+                     'prefix/agency_2/2022/stat/export_metadata.json', 'prefix/agency_2/2023/stat/export_metadata.json']
+        for key in self.keys:
+            self.s3.put_object(Bucket='bucket', Key=key, Body=key.encode())
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.mirror = pathlib.Path(self.tmpdir.name)
+
+    def tearDown(self):
+        self.mock_aws.stop()
+        self.tmpdir.cleanup()
+
+    def mirrored(self):
+        return sorted(str(i.relative_to(self.mirror)) for i in self.mirror.rglob('*') if i.is_file())
+
+    def test_concurrent_listing_mirrors_everything(self):
+        ldr = s3loader.S3Loader('bucket', 'prefix', str(self.mirror), list_concurrency=4)
+        completed = []
+        updated = ldr.load_s3(on_run_complete=lambda *run: completed.append(run))
+        assert(self.mirrored() == sorted(i[len('prefix/'):] for i in self.keys))
+        assert(updated == {('agency_1', '2021'), ('agency_1', '2022'), ('agency_2', '2022'), ('agency_2', '2023')})
+        assert(sorted(completed) == sorted(updated))
+
+    def test_listing_limited_to_agencies(self):
+        ldr = s3loader.S3Loader('bucket', 'prefix', str(self.mirror), agencies=['agency_2'])
+        assert(ldr.load_s3() == {('agency_2', '2022'), ('agency_2', '2023')})
+        assert(self.mirrored() == ['agency_2/2022/stat/export_metadata.json',
+                                   'agency_2/2023/stat/export_metadata.json'])
+
+    def test_listing_limited_to_version_range(self):
+        ldr = s3loader.S3Loader('bucket', 'prefix', str(self.mirror), min_version='2022', max_version='2022')
+        assert(ldr.load_s3() == {('agency_1', '2022'), ('agency_2', '2022')})
+        ldr = s3loader.S3Loader('bucket', 'prefix', str(self.mirror), min_version='2023')
+        assert(ldr.load_s3() == {('agency_2', '2023')})
+        assert('agency_1/2021/json/publications/part-0.json.gz' not in self.mirrored())
+
+
+class TestMirrorRetention(TestCase):
+
+    def setUp(self):
+        s3loader.boto3 = boto3
+        s3loader.Path = pathlib.Path
+        self.mock_aws = mock_aws()
+        self.mock_aws.start()
+        self.s3 = boto3.client('s3', region_name='us-east-1')
+        self.s3.create_bucket(Bucket='bucket')
+        self.runs = [('agency_1', '2021'), ('agency_1', '2022'), ('agency_1', '2023'), ('agency_2', '2021')]
+        for agency, version in self.runs:
+            self.s3.put_object(Bucket='bucket', Key=f'prefix/{agency}/{version}/json/publications/part-0.json.gz',
+                               Body=b'x' * 1000)
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.mirror = pathlib.Path(self.tmpdir.name)
+        self.ldr = s3loader.S3Loader('bucket', 'prefix', str(self.mirror), manifest=self.mirror.joinpath('.manifest'))
+        self.ldr.load_s3()
+        for run in self.runs:
+            self.ldr.record_ingested(*run)
+            time.sleep(0.001)
+
+    def tearDown(self):
+        self.mock_aws.stop()
+        self.tmpdir.cleanup()
+
+    def mirrored(self):
+        return set(self.ldr.mirrored_runs())
+
+    def test_keep_latest_versions(self):
+        assert(sorted(self.ldr.prune_mirror(keep_versions=1)) == [('agency_1', '2021'), ('agency_1', '2022')])
+        assert(self.mirrored() == {('agency_1', '2023'), ('agency_2', '2021')})
+        assert(len(self.ldr.manifest.entries()) == 2)
+        # evicted objects are not downloaded again unless they change
+        assert(self.ldr.load_s3() == set())
+        self.s3.put_object(Bucket='bucket', Key='prefix/agency_1/2021/json/publications/part-0.json.gz', Body=b'y')
+        assert(self.ldr.load_s3() == {('agency_1', '2021')})
+        assert(('agency_1', '2021') in self.mirrored())
+
+    def test_keep_more_versions_than_mirrored(self):
+        assert(self.ldr.prune_mirror(keep_versions=4) == [])
+        assert(self.mirrored() == set(self.runs))
+
+    def test_size_budget_evicts_least_recently_ingested(self):
+        self.ldr.record_ingested('agency_1', '2021')
+        assert(self.ldr.prune_mirror(max_bytes=2500) == [('agency_1', '2022'), ('agency_1', '2023')])
+        assert(self.mirrored() == {('agency_1', '2021'), ('agency_2', '2021')})
+
+    def test_in_flight_forced_and_not_ingested_runs_are_kept(self):
+        self.ldr.manifest.connection.execute("DELETE FROM runs WHERE agency = 'agency_2'")
+        self.mirror.joinpath('agency_1', '2022', '.force_reload').touch()
+        assert(self.ldr.prune_mirror(max_bytes=0, in_flight=[('agency_1', '2023')]) == [('agency_1', '2021')])
+        assert(self.mirrored() == {('agency_1', '2022'), ('agency_1', '2023'), ('agency_2', '2021')})
+
+    def test_forced_reload_downloads_evicted_run(self):
+        self.ldr.prune_mirror(keep_versions=0)
+        assert(self.mirrored() == set())
+        self.mirror.joinpath('agency_2', '2021').mkdir(parents=True)
+        self.mirror.joinpath('agency_2', '2021', '.force_reload').touch()
+        assert(self.ldr.load_s3() == {('agency_2', '2021')})
+        assert(self.mirror.joinpath('agency_2', '2021', 'json', 'publications', 'part-0.json.gz').exists())
+
+    def test_manifest_without_eviction_is_upgraded(self):
+        path = self.mirror.joinpath('old.sqlite')
+        with sqlite3.connect(str(path)) as connection:
+            connection.execute('CREATE TABLE objects (key TEXT PRIMARY KEY, etag TEXT, size INTEGER, '
+                               'last_modified TEXT, synced REAL)')
+            connection.execute("INSERT INTO objects VALUES ('key', 'etag', 1, NULL, 0)")
+        manifest = MirrorManifest(path)
+        assert(manifest.entries() == {'key': ('etag', 1)})
+        manifest.evict('k')
+        assert(manifest.entries() == {} and manifest.evicted() == {'key': ('etag', 1)})
+
+
+class TestS3LoaderTransfers(TestCase):
+
+    def setUp(self):
+        s3loader.boto3 = boto3
+        s3loader.Path = pathlib.Path
+        self.mock_aws = mock_aws()
+        self.mock_aws.start()
+        self.s3 = boto3.client('s3', region_name='us-east-1')
+        self.s3.create_bucket(Bucket='bucket')
+        self.body = os.urandom(3 << 20)
+        self.s3.put_object(Bucket='bucket', Key='prefix/agency/v1/json/publications/large.json.gz', Body=self.body)
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.mirror = pathlib.Path(self.tmpdir.name)
+        self.dest = self.mirror.joinpath('agency', 'v1', 'json', 'publications', 'large.json.gz')
+
+    def tearDown(self):
+        self.mock_aws.stop()
+        self.tmpdir.cleanup()
+
+    def test_ranged_multipart_download(self):
+        ldr = s3loader.S3Loader('bucket', 'prefix', str(self.mirror), max_concurrent=2, part_size=1 << 20,
+                                multipart_threshold=1 << 20, part_concurrency=3)
+        assert(ldr.transfer_config.multipart_chunksize == 1 << 20)
+        assert(ldr.transfer_config.max_request_concurrency == 3)
+        with self.assertLogs('susdingest.s3loader', level='INFO') as logs:
+            assert(ldr.load_s3() == {('agency', 'v1')})
+        assert(self.dest.read_bytes() == self.body)
+        assert(any('MB/s' in i for i in logs.output))
+
+    def test_adaptive_download_backs_off_when_throttled(self):
+        ldr = s3loader.S3Loader('bucket', 'prefix', str(self.mirror), max_concurrent=4, adaptive=True)
+        assert(ldr.session_config().retries['mode'] == 'adaptive')
+        throttle = ClientError({'Error': {'Code': 'SlowDown'}}, 'GetObject')
+        original = boto3.s3.inject.object_download_file
+        calls = []
+
+        def download_file(obj, *args, **kwargs):
+            calls.append(obj.key)
+            if len(calls) == 1:
+                raise throttle
+            return original(obj, *args, **kwargs)
+
+        with patch('boto3.s3.inject.object_download_file', download_file), patch('time.sleep'):
+            ldr.load_s3()
+        assert(len(calls) == 2)
+        assert(ldr.limiter.limit == 2)
+        assert(self.dest.read_bytes() == self.body)
+
+    def test_interrupted_download_resumes_missing_parts(self):
+        ldr = s3loader.S3Loader('bucket', 'prefix', str(self.mirror), part_size=1 << 20, multipart_threshold=1 << 20,
+                                part_concurrency=1)
+        original = s3loader.S3Loader._download_range
+        ranges = []
+
+        def interrupted(ldr, s3object, part_file, start, end, etag, marker):
+            if start >= 2 << 20:
+                raise KeyboardInterrupt
+            ranges.append(start)
+            return original(ldr, s3object, part_file, start, end, etag, marker)
+
+        s3object = boto3.resource('s3').Object('bucket', 'prefix/agency/v1/json/publications/large.json.gz')
+        self.dest.parent.mkdir(parents=True)
+        with patch.object(s3loader.S3Loader, '_download_range', interrupted):
+            with self.assertRaises(KeyboardInterrupt):
+                ldr._download_object(s3object, self.dest, len(self.body), s3object.e_tag)
+        assert(not self.dest.exists())
+        assert(self.dest.with_name('large.json.gz.part').exists())
+        ranges.clear()
+
+        def counted(ldr, s3object, part_file, start, end, etag, marker):
+            ranges.append(start)
+            return original(ldr, s3object, part_file, start, end, etag, marker)
+
+        with patch.object(s3loader.S3Loader, '_download_range', counted):
+            assert(ldr.load_s3() == {('agency', 'v1')})
+        assert(ranges == [2 << 20])
+        assert(self.dest.read_bytes() == self.body)
+        assert(sorted(i.name for i in self.dest.parent.iterdir()) == ['large.json.gz'])
+
+    def test_changed_object_restarts_partial_download(self):
+        ldr = s3loader.S3Loader('bucket', 'prefix', str(self.mirror), part_size=1 << 20, multipart_threshold=1 << 20)
+        parts_dir = self.dest.with_name('large.json.gz.parts')
+        parts_dir.mkdir(parents=True)
+        parts_dir.joinpath('etag').write_text('"stale"')
+        parts_dir.joinpath('00000').touch()
+        self.dest.with_name('large.json.gz.part').write_bytes(bytes(len(self.body)))
+        ldr.load_s3()
+        assert(self.dest.read_bytes() == self.body)
+
+    def test_download_verified_before_publishing(self):
+        def corrupt(obj, filename, *args, **kwargs):
+            with open(filename, 'wb') as f:
+                f.write(b'x' * len(self.body))
+
+        ldr = s3loader.S3Loader('bucket', 'prefix', str(self.mirror), verify_etag=True)
+        with patch('boto3.s3.inject.object_download_file', corrupt):
+            with self.assertRaises(IOError):
+                ldr.load_s3()
+        assert(not self.dest.exists())
+        with patch('boto3.s3.inject.object_download_file', lambda obj, filename, *a, **k: open(filename, 'wb').close()):
+            with self.assertRaises(IOError):
+                s3loader.S3Loader('bucket', 'prefix', str(self.mirror)).load_s3()
+        assert(not self.dest.exists())
+        ldr.load_s3()
+        assert(self.dest.read_bytes() == self.body)
+
+
+class TestAdaptiveLimiter(TestCase):
+
+    def test_aimd(self):
+        limiter = s3loader.AdaptiveLimiter(8)
+        limiter.throttled()
+        limiter.throttled()
+        assert(limiter.limit == 2)
+        for i in range(2):
+            limiter.success()
+        assert(limiter.limit == 3)
+        for i in range(100):
+            limiter.throttled()
+        assert(limiter.limit == 1)
+
+    def test_limits_concurrency(self):
+        limiter = s3loader.AdaptiveLimiter(2)
+        active, peak = [], []
+
+        def work():
+            with limiter:
+                active.append(1)
+                peak.append(len(active))
+                time.sleep(0.01)
+                active.pop()
+
+        threads = [threading.Thread(target=work) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert(max(peak) <= 2)
@@ -0,0 +1,52 @@
+import threading
+import time
+from unittest import TestCase
+from susdingest.scheduler import RunScheduler
+
+
+class TestRunScheduler(TestCase):
+
+    def test_runs_concurrently(self):
+        scheduler = RunScheduler(max_runs=3)
+        barrier = threading.Barrier(3, timeout=10)
+        for n in range(3):
+            scheduler.submit(('agency', str(n)), lambda: barrier.wait() is not None)
+        assert(all(scheduler.wait().values()))
+
+    def test_stages_limited_separately(self):
+        scheduler = RunScheduler(max_runs=4, limits={'parse': 2, 'db': 1})
+        lock = threading.Lock()
+        active, peak = {'parse': 0, 'db': 0}, {'parse': 0, 'db': 0}
+
+        def work(run, name, limit=None):
+            with scheduler.stage(run, name, limit):
+                with lock:
+                    active[limit or name] += 1
+                    peak[limit or name] = max(peak[limit or name], active[limit or name])
+                time.sleep(0.02)
+                with lock:
+                    active[limit or name] -= 1
+
+        def ingest(run):
+            work(run, 'parse')
+            work(run, 'staging', 'db')
+            work(run, 'final', 'db')
+            return True
+
+        for n in range(4):
+            scheduler.submit(('agency', str(n)), ingest, ('agency', str(n)))
+        scheduler.wait()
+        assert(peak == {'parse': 2, 'db': 1})
+        timings = scheduler.timings[('agency', '0')]
+        assert(set(timings) == {'parse', 'staging', 'final', 'waiting', 'total'})
+        assert(timings['total'] >= timings['parse'] + timings['staging'] + timings['final'])
+
+    def test_failed_run_is_isolated(self):
+        scheduler = RunScheduler(max_runs=2)
+        scheduler.submit(('agency', 'fails'), lambda: 1 / 0)
+        scheduler.submit(('agency', 'works'), lambda: True)
+        results = scheduler.wait()
+        assert(results == {('agency', 'fails'): False, ('agency', 'works'): True})
+        with self.assertLogs('susdingest.scheduler', level='INFO') as logs:
+            scheduler.log_summary(results)
+        assert(any('failed' in i and 'fails' in i for i in logs.output))
@@ -0,0 +1,46 @@
+import pandas as pd
+import sqlalchemy
+from pathlib import Path
+from unittest import TestCase
+from susdingest.jsonloader import JSONLoader
+from susdingest.flattener import RecordFlattener
+from susdingest.schema import SCHEMA, apply_schema, columns, dtypes, sql_types
+
+
+class TestSchema(TestCase):
+
+    def setUp(self):
+        examples = Path(__file__).with_name('example_data').joinpath('agency', 'version')
+        self.json_files = list(examples.joinpath('json', 'publications').glob('publication*.json.gz'))
+        self.meta_file = examples.joinpath('stat', 'export_metadata.json')
+
+    def test_schema_covers_export_kinds(self):
+        assert(set(SCHEMA) == set(JSONLoader.export_kinds))
+
+    def test_tables_follow_schema(self):
+        jl = JSONLoader(self.json_files, metadata_file=self.meta_file)
+        for kind, table in jl.flatten().items():
+            assert(list(table.columns) == columns(kind))
+            assert(table.dtypes.astype(str).to_dict() == dtypes(kind))
+        assert(isinstance(jl.publications['publication_type'].dtype, pd.CategoricalDtype))
+
+    def test_types_stable_for_missing_and_extra_columns(self):
+        records = [('a', {'publication_year': None, 'unexpected': 1}), ('b', {'publication_year': 2020.0})]
+        publications = RecordFlattener(['publications']).add_records(records).tables()['publications']
+        assert(list(publications.columns) == columns('publications'))
+        assert(str(publications['publication_year'].dtype) == 'Int32')
+        assert(publications['journal_citescore_value'].isna().all())
+        empty = RecordFlattener(['dyads']).tables()['dyads']
+        assert(empty.dtypes.astype(str).to_dict() == dtypes('dyads'))
+
+    def test_apply_schema(self):
+        frame = pd.DataFrame({'asjc': ['1000', '1000'], 'other': [1, 2]})
+        asjcs = apply_schema('asjcs', frame)
+        assert(list(asjcs.columns) == ['asjc', 'label'])
+        assert(list(asjcs['asjc'].cat.categories) == ['1000'])
+
+    def test_sql_types(self):
+        types = sql_types('publications')
+        assert(set(types) == set(columns('publications')) | {'eid'})
+        assert(isinstance(types['doi'], sqlalchemy.Unicode))
+        assert('eid' not in sql_types('datasets'))
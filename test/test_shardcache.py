@@ -0,0 +1,109 @@
+import gzip
+import os
+import pandas as pd
+import shutil
+import tempfile
+from pathlib import Path
+from unittest import TestCase
+from unittest.mock import patch
+from susdingest import jsonloader
+from susdingest.jsonloader import JSONLoader, flatten_shard
+from susdingest.shardcache import ShardCache
+
+
+class TestShardCache(TestCase):
+
+    def setUp(self):
+        examples = Path(__file__).with_name('example_data').joinpath('agency', 'version')
+        self.json_file = next(examples.joinpath('json', 'publications').glob('publication*.json.gz'))
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache_dir = Path(self.tmpdir).joinpath('cache')
+        # split the example shard in two
+        with gzip.open(self.json_file, 'rt') as f:
+            lines = f.readlines()
+        self.json_files = []
+        for i in range(2):
+            shard = Path(self.tmpdir).joinpath(f'publication_{i}.json.gz')
+            with gzip.open(shard, 'wt') as f:
+                f.writelines(lines[i::2])
+            self.json_files.append(shard)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_roundtrip(self):
+        cache = ShardCache(self.cache_dir)
+        batch = flatten_shard(self.json_file)
+        assert(self.json_file not in cache)
+        assert(cache.get(self.json_file) is None)
+        cache.put(self.json_file, batch)
+        assert(self.json_file in cache)
+        cached = cache.get(self.json_file)
+        assert(set(cached) == set(batch))
+        assert(cached['publications'][0] == batch['publications'][0])
+
+    def test_key_by_content_and_version(self):
+        cache = ShardCache(self.cache_dir)
+        copy = Path(self.tmpdir).joinpath('copy.json.gz')
+        shutil.copy(self.json_file, copy)
+        assert(cache.key(copy) == cache.key(self.json_file))
+        assert(cache.key(self.json_files[0]) != cache.key(self.json_files[1]))
+        other = ShardCache(self.cache_dir)
+        other.version = 'other'
+        assert(other.key(copy) != cache.key(copy))
+
+    def test_loader_reuses_cache(self):
+        reference = JSONLoader(self.json_files)
+        cache = ShardCache(self.cache_dir)
+        first = JSONLoader(self.json_files, cache=cache)
+        assert(all(i in cache for i in self.json_files))
+        with patch.object(jsonloader, 'flatten_shard', side_effect=AssertionError('shard parsed')) as parse:
+            second = JSONLoader(self.json_files, cache=ShardCache(self.cache_dir))
+            assert(not parse.called)
+        for kind in JSONLoader.export_kinds:
+            pd.testing.assert_frame_equal(first.flatten()[kind], getattr(reference, kind))
+            pd.testing.assert_frame_equal(second.flatten()[kind], first.flatten()[kind])
+
+    def test_streaming_with_cache(self):
+        cache = ShardCache(self.cache_dir)
+        cache.put(self.json_files[0], flatten_shard(self.json_files[0]))
+        jl = JSONLoader(self.json_files, streaming=True, cache=cache)
+        chunks = list(jl.iter_chunks())
+        assert(len(chunks) == 2)
+        assert(sum(len(i.publications) for i in chunks) == 40)
+        assert(self.json_files[1] in cache)
+
+    def test_lru_eviction(self):
+        cache = ShardCache(self.cache_dir)
+        for json_file in self.json_files:
+            cache.put(json_file, flatten_shard(json_file))
+        sizes = {i.name: size for _, size, i in cache.entries()}
+        # touch the first entry so that the second is least recently used
+        os.utime(cache.entry(self.json_files[1]), (0, 0))
+        cache.get(self.json_files[0])
+        cache.max_bytes = max(sizes.values())
+        cache.evict()
+        assert(self.json_files[0] in cache)
+        assert(self.json_files[1] not in cache)
+        assert(cache.size() <= cache.max_bytes)
+
+    def test_eviction_keeps_unread_hits_of_run(self):
+        reference = JSONLoader(self.json_files)
+        cache = ShardCache(self.cache_dir)
+        cache.put(self.json_files[1], flatten_shard(self.json_files[1]))
+        # room for one and a half entries, caching the first shard would evict the second before it is read
+        cache.max_bytes = cache.size() * 3 // 2
+        jl = JSONLoader(self.json_files, cache=cache)
+        assert(self.json_files[1] in cache)
+        pd.testing.assert_frame_equal(jl.publications, reference.publications)
+        # the cache is pruned to its budget again by the next shard cached
+        cache.put(self.json_file, flatten_shard(self.json_file))
+        assert(cache.size() <= cache.max_bytes)
+
+    def test_missing_cached_tables_parsed_again(self):
+        reference = JSONLoader(self.json_files)
+        cache = ShardCache(self.cache_dir)
+        JSONLoader(self.json_files, cache=cache)
+        with patch.object(cache, 'get', return_value=None):
+            jl = JSONLoader(self.json_files, cache=cache)
+        pd.testing.assert_frame_equal(jl.publications, reference.publications)
@@ -0,0 +1,78 @@
+import pandas as pd
+import sqlalchemy
+import sqlalchemy.inspection
+import tempfile
+from unittest import TestCase
+from unittest.mock import MagicMock
+from susdingest.stagingwriter import StagingWriter, copy_rows, column_types
+
+
+class TestStagingWriter(TestCase):
+
+    def setUp(self):
+        sqlalchemy.inspect = sqlalchemy.inspection.inspect
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.engine = sqlalchemy.create_engine(f'sqlite:///{self.tmpdir.name}/staging.db')
+        self.frame = pd.DataFrame({
+            'eid': ['a', 'b', 'c'],
+            'year': [2020, None, 2022],
+            'score': [0.5, 1.5, None],
+            'fuzzy': [True, False, None],
+            'title': ['x', None, 'ü'],
+        }).convert_dtypes()
+
+    def tearDown(self):
+        self.engine.dispose()
+        self.tmpdir.cleanup()
+
+    def test_write_to_sqlite(self):
+        with self.engine.connect() as connection:
+            writer = StagingWriter(connection, batch_size=2)
+            assert(writer.dialect == 'sqlite')
+            assert(writer.write(self.frame, 'test_table') == 3)
+            writer.write(self.frame, 'test_table', if_exists='append')
+            result = pd.read_sql('select * from test_table', connection)
+        assert(len(result) == 6)
+        assert(result['title'].tolist()[:3] == ['x', None, 'ü'])
+        assert(writer.stats['test_table'][0] == 6)
+
+    def test_existing_table_fails_without_replace(self):
+        with self.engine.connect() as connection:
+            writer = StagingWriter(connection)
+            writer.write(self.frame, 'test_table')
+            with self.assertRaises(ValueError):
+                writer.write(self.frame, 'test_table')
+            writer.write(self.frame.iloc[:1], 'test_table', if_exists='replace')
+            assert(len(pd.read_sql('select * from test_table', connection)) == 1)
+
+    def test_explicit_column_types(self):
+        types = column_types(self.frame)
+        assert(isinstance(types['year'], sqlalchemy.BigInteger))
+        assert(isinstance(types['score'], sqlalchemy.Float))
+        assert(isinstance(types['fuzzy'], sqlalchemy.Boolean))
+        assert(isinstance(types['title'], sqlalchemy.UnicodeText))
+        with self.engine.connect() as connection:
+            StagingWriter(connection).write(self.frame, 'test_table')
+            columns = {i['name']: i['type'] for i in sqlalchemy.inspect(connection).get_columns('test_table')}
+        assert(isinstance(columns['year'], sqlalchemy.BigInteger))
+
+    def test_mssql_batches_respect_parameter_limit(self):
+        connection = MagicMock()
+        connection.dialect.name = 'mssql'
+        writer = StagingWriter(connection, batch_size=5000)
+        assert(writer.insert_method() == 'multi')
+        assert(writer.rows_per_batch(2) == 1000)
+        assert(writer.rows_per_batch(30) * 30 < 2100)
+
+    def test_postgresql_copy(self):
+        connection = MagicMock()
+        connection.dialect.name = 'postgresql'
+        assert(StagingWriter(connection).insert_method() is copy_rows)
+        table = MagicMock()
+        table.schema = None
+        table.name = 'agency_version_publications'
+        copy_rows(table, connection, ['eid', 'title'], iter([('a', 'x, y'), ('b', None)]))
+        cursor = connection.connection.cursor.return_value.__enter__.return_value
+        statement, buffer = cursor.copy_expert.call_args[0]
+        assert(statement == 'COPY "agency_version_publications" ("eid", "title") FROM STDIN WITH CSV')
+        assert(buffer.read() == 'a,"x, y"\r\nb,\r\n')
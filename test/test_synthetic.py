@@ -0,0 +1,94 @@
+import json
+import tempfile
+from collections import Counter
+import sqlalchemy
+import sqlalchemy.inspection
+from pathlib import Path
+from unittest import TestCase
+from susdingest import benchmark
+from susdingest.jsonloader import JSONLoader
+from susdingest.synthetic import ExportGenerator
+
+
+class TestExportGenerator(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        sqlalchemy.inspect = sqlalchemy.inspection.inspect
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_generated_export_validates(self):
+        ExportGenerator(300).write(self.tmpdir.name, 'agency', 'version', shard_size=100)
+        shards = list(Path(self.tmpdir.name).glob('agency/version/json/publications/*.json.gz'))
+        assert(len(shards) == 3)
+        jl = JSONLoader.from_path(self.tmpdir.name, 'agency', 'version', strict_aliases=True)
+        assert(jl.validate())
+        assert(len(jl.publications) == 300)
+        for kind in JSONLoader.export_kinds:
+            assert(len(getattr(jl, kind)) > 0)
+        # like real exports, with several authors and dyads for most publications
+        assert(len(jl.authors) > len(jl.publications) and len(jl.dyads) > len(jl.publications))
+
+    def test_generated_export_streams(self):
+        ExportGenerator(200).write(self.tmpdir.name, 'agency', 'version', shard_size=70)
+        assert(JSONLoader.from_path(self.tmpdir.name, 'agency', 'version', chunk_size=30).validate())
+
+    def test_entities_spread_over_pools(self):
+        records = list(ExportGenerator(2000).records())
+        for record in records:
+            for field, key in [('authors', 'author_id'), ('asjcs', 'asjc'), ('unified_fingerprint_concepts',
+                                                                              'concept_id')]:
+                ids = [i[key] for i in record[field]]
+                assert(len(ids) == len(set(ids)))
+        authors = Counter(i['author_id'] for record in records for i in record['authors'])
+        journals = Counter(record['journal_title'] for record in records)
+        assert(authors.most_common(1)[0][1] < 0.02 * sum(authors.values()) and len(authors) > len(records))
+        assert(journals.most_common(1)[0][1] < 0.1 * len(records))
+
+    def test_same_seed_same_export(self):
+        assert(list(ExportGenerator(20, seed=1).records()) == list(ExportGenerator(20, seed=1).records()))
+        assert(list(ExportGenerator(20, seed=1).records()) != list(ExportGenerator(20, seed=2).records()))
+
+
+class TestBenchmark(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        sqlalchemy.inspect = sqlalchemy.inspection.inspect
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_benchmark_stages(self):
+        ExportGenerator(100).write(self.tmpdir.name, 'agency', 'version')
+        results = benchmark.run_benchmark(self.tmpdir.name, 'agency', 'version',
+                                          f'sqlite:///{self.tmpdir.name}/staging.db')
+        assert(results['publications'] == 100)
+        assert(set(results['stages']) == {'parse', 'validate', 'staging'})
+        assert(all(i['publications_per_second'] > 0 for i in results['stages'].values()))
+
+    def test_comparisons_reported(self):
+        ExportGenerator(100).write(self.tmpdir.name, 'synthetic', '100')
+        report = Path(self.tmpdir.name).joinpath('report.json')
+        assert(benchmark.main_with_args(['-n', '100', '--data-dir', self.tmpdir.name, '--compare', 'flatten',
+                                         'decoders', '--report', str(report)]))
+        comparisons = json.loads(report.read_text())['synthetic/100']['comparisons']
+        assert(set(comparisons['flatten']) == {'properties', 'flatten'})
+        assert('json' in comparisons['decoders'])
+        assert(all(i > 0 for timings in comparisons.values() for i in timings.values()))
+
+    def test_regressions_flagged(self):
+        results = {'stages': {'parse': {'publications_per_second': 70}, 'staging': {'publications_per_second': 95}}}
+        baseline = {'parse': 100, 'staging': 100, 'final': 100}
+        assert(benchmark.regressions(results, baseline, tolerance=0.2) == [('parse', 100, 70)])
+
+    def test_baselines_saved_and_compared(self):
+        data_dir, baseline = Path(self.tmpdir.name), Path(self.tmpdir.name).joinpath('baselines.json')
+        argv = ['-n', '50', '--data-dir', str(data_dir), '--baseline', str(baseline)]
+        assert(benchmark.main_with_args(argv + ['--save-baseline']))
+        assert(set(json.loads(baseline.read_text())['synthetic/50']) == {'parse', 'validate', 'staging'})
+        baseline.write_text(json.dumps({'synthetic/50': {'parse': 1e12}}))
+        with self.assertLogs('susdingest.benchmark', level='ERROR'):
+            assert(not benchmark.main_with_args(argv))
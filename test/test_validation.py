@@ -0,0 +1,74 @@
+import sqlalchemy
+import sqlalchemy.inspection
+import tempfile
+from pathlib import Path
+from unittest import TestCase
+from susdingest.jsonloader import JSONLoader
+from susdingest.validation import Validator
+
+
+class TestValidator(TestCase):
+
+    def setUp(self):
+        examples = Path(__file__).with_name('example_data').joinpath('agency', 'version')
+        self.json_files = list(examples.joinpath('json', 'publications').glob('publication*.json.gz'))
+        self.meta_file = examples.joinpath('stat', 'export_metadata.json')
+        self.jl = JSONLoader(self.json_files, metadata_file=self.meta_file)
+
+    def test_counts(self):
+        validator = Validator(self.jl.metadata).add(self.jl.publications, self.jl.dyads)
+        assert(sum(validator.year_counts.values()) == len(self.jl.publications))
+        alias_documents = self.jl.dyads.reset_index().groupby('alias_id')['eid'].nunique()
+        assert(validator.alias_counts == alias_documents.to_dict())
+        assert(validator.check())
+
+    def test_fails_on_first_duplicate(self):
+        validator = Validator(self.jl.metadata)
+        validator.add(self.jl.publications.iloc[:10])
+        with self.assertRaises(AssertionError):
+            validator.add(self.jl.publications.iloc[9:20])
+        validator = Validator(self.jl.metadata, raise_exception=False)
+        validator.add(self.jl.publications.iloc[:10]).add(self.jl.publications.iloc[9:20])
+        assert(validator.duplicates == [self.jl.publications.index[9]])
+        assert(not validator.check())
+
+    def test_strict_alias_counts(self):
+        # the example metadata stems from the full export
+        validator = Validator(self.jl.metadata, strict_aliases=True).add(self.jl.publications, self.jl.dyads)
+        assert(not validator.check_aliases())
+        with self.assertRaises(AssertionError):
+            validator.check()
+
+    def test_requires_metadata(self):
+        with self.assertRaises(ValueError):
+            Validator(None)
+
+
+class TestValidationDuringLoad(TestCase):
+
+    def setUp(self):
+        examples = Path(__file__).with_name('example_data').joinpath('agency', 'version')
+        self.json_files = list(examples.joinpath('json', 'publications').glob('publication*.json.gz'))
+        self.meta_file = examples.joinpath('stat', 'export_metadata.json')
+        sqlalchemy.inspect = sqlalchemy.inspection.inspect
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.conn_str = f'sqlite:///{self.tmpdir.name}/staging.db'
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_streaming_validation_during_load(self):
+        jl = JSONLoader(self.json_files, metadata_file=self.meta_file, agency='agency', run_version='version',
+                        conn_str=self.conn_str, chunk_size=7)
+        assert(jl.with_validation() is jl)
+        assert(jl.pending_validation is not None)
+        jl.load_db()
+        assert(len(jl.pending_validation.eids) == 40)
+
+    def test_streaming_duplicates_fail_load(self):
+        jl = JSONLoader(self.json_files * 2, metadata_file=self.meta_file, agency='agency', run_version='version',
+                        conn_str=self.conn_str, streaming=True).with_validation()
+        with self.assertRaises(AssertionError):
+            jl.load_db()
+        engine = sqlalchemy.create_engine(self.conn_str)
+        assert(sqlalchemy.inspect(engine).get_table_names() == [])